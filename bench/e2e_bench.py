@@ -0,0 +1,339 @@
+'''
+Measure the daemon end to end against a fake Stream Deck and a fake browser.
+
+This starts daemon.py the way Stream Deck would, talking to the fake Stream
+Deck in `streamdeck_workrooms.fakes.streamdeck`, with the fake browser worker
+in `streamdeck_workrooms.fakes.worker` scripted through its state file and
+analytics going to the fake collector. It then measures
+
+  - CPU time and wakeups of the daemon and its worker while there is no call
+    and while in a call
+  - messages and bytes sent to Stream Deck for each change of call state
+  - latency from a key press to the `setImage` showing its effect
+
+and writes the results as JSON to stdout so that they can be compared across
+commits, e.g.
+
+    python bench/e2e_bench.py > before.json
+    python bench/e2e_bench.py --daemon-arg=--optimistic > after.json
+
+Wakeups are counted as voluntary context switches. CPU and wakeups are
+measured with psutil if it's installed, or from /proc on Linux, and are null
+otherwise.
+'''
+
+from argparse import ArgumentParser, Namespace
+import asyncio
+import glob
+import json
+import os
+import os.path
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from aiohttp import web
+from streamdeck_workrooms.fakes import analytics as fake_analytics
+from streamdeck_workrooms.fakes.streamdeck import FakeStreamDeck
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+ACTIONS = ['mic', 'camera', 'hand', 'call']
+
+# Call states written to the fake worker's state file
+NO_CALL = 'NONE'
+IN_CALL = 'ON OFF NONE ON'
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        'runs': len(times),
+        'mean_ms': statistics.mean(times) * 1000,
+        'p50_ms': times[len(times) // 2] * 1000,
+        'p95_ms': times[int(len(times) * 0.95)] * 1000,
+        'max_ms': times[-1] * 1000,
+    }
+
+
+def _proc_children(pid):
+    children = []
+    for path in glob.glob(f'/proc/{pid}/task/*/children'):
+        with open(path) as f:
+            children += [int(c) for c in f.read().split()]
+
+    return children + [g for c in children for g in _proc_children(c)]
+
+
+def usage(pid):
+    '''
+    Return the total (CPU seconds, voluntary context switches) of process
+    `pid` and its descendants, or (None, None) if we can't tell.
+    '''
+
+    if psutil is not None:
+        p = psutil.Process(pid)
+        procs = [p] + p.children(recursive=True)
+        cpu = sum(q.cpu_times().user + q.cpu_times().system for q in procs)
+        switches = sum(q.num_ctx_switches().voluntary for q in procs)
+        return (cpu, switches)
+
+    if not os.path.exists(f'/proc/{pid}'):
+        return (None, None)
+
+    cpu = 0
+    switches = 0
+    for p in [pid] + _proc_children(pid):
+        with open(f'/proc/{p}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+        for path in glob.glob(f'/proc/{p}/task/*/status'):
+            with open(path) as f:
+                for line in f:
+                    if line.startswith('voluntary_ctxt_switches:'):
+                        switches += int(line.split()[1])
+
+    return (cpu, switches)
+
+
+async def measure_steady(sd, seconds):
+    '''
+    Measure the daemon's resource usage over `seconds`.
+    '''
+
+    cpu_start, switches_start = usage(sd.proc.pid)
+    msgs_start = len(sd.received)
+    start = time.time()
+
+    await asyncio.sleep(seconds)
+
+    cpu_end, switches_end = usage(sd.proc.pid)
+    elapsed = time.time() - start
+
+    result = {
+        'seconds': elapsed,
+        'cpu_percent': None,
+        'wakeups_per_minute': None,
+        'messages': len(sd.received) - msgs_start,
+    }
+    if cpu_start is not None:
+        result['cpu_percent'] = 100 * (cpu_end - cpu_start) / elapsed
+        result['wakeups_per_minute'] = 60 * (switches_end - switches_start) / elapsed
+
+    return result
+
+
+def is_image_for(context):
+    return lambda msg: msg.get('event') == 'setImage' and msg.get('context') == context
+
+
+async def wait_for_images(sd, contexts, since, timeout=10):
+    '''
+    Wait until each of `contexts` has been sent a setImage since `since`.
+    '''
+
+    for c in contexts:
+        await sd.wait_for(is_image_for(c), since=since, timeout=timeout)
+
+
+async def measure_changes(sd, state_file, contexts, count):
+    '''
+    Flip the camera in the browser `count` times and count what is sent to
+    Stream Deck for each change.
+    '''
+
+    msgs = []
+    sizes = []
+    camera = 'OFF'
+
+    for _ in range(count):
+        camera = {'ON': 'OFF', 'OFF': 'ON'}[camera]
+        statuses = IN_CALL.split(' ')
+        statuses[ACTIONS.index('camera')] = camera
+
+        start = time.time()
+        msgs_start = len(sd.received)
+        bytes_start = sd.bytes_received
+        with open(state_file, 'w') as f:
+            f.write(' '.join(statuses))
+
+        await wait_for_images(sd, contexts['camera'], since=start)
+
+        # Give anything else caused by this change time to arrive
+        await asyncio.sleep(0.5)
+
+        msgs.append(len(sd.received) - msgs_start)
+        sizes.append(sd.bytes_received - bytes_start)
+
+    # Leave the browser as we found it
+    with open(state_file, 'w') as f:
+        f.write(IN_CALL)
+    await asyncio.sleep(1.5)
+
+    return {
+        'changes': count,
+        'messages_per_change': statistics.mean(msgs),
+        'bytes_per_change': statistics.mean(sizes),
+    }
+
+
+async def measure_presses(sd, contexts, count):
+    '''
+    Press the mic key `count` times, timing how long it takes for its new
+    image to show up.
+    '''
+
+    context = contexts['mic'][0]
+    latencies = []
+
+    for _ in range(count):
+        pressed = await sd.press('mic', context)
+        t, _ = await sd.wait_for(is_image_for(context), since=pressed)
+        latencies.append(t - pressed)
+
+        # Stay clear of the toggle coalescing window and confirmation polling
+        await asyncio.sleep(1)
+
+    return summarize(latencies)
+
+
+async def main_async():
+    ap = ArgumentParser(
+        description='Measure the daemon end to end against a fake Stream Deck '
+                    'and a fake browser.')
+    ap.add_argument(
+        '--idle-seconds', type=float, default=20,
+        help='how long to measure resource usage with no call (default: %(default)s)')
+    ap.add_argument(
+        '--call-seconds', type=float, default=20,
+        help='how long to measure resource usage in a call (default: %(default)s)')
+    ap.add_argument(
+        '--changes', type=int, default=10,
+        help='number of browser state changes to make (default: %(default)s)')
+    ap.add_argument(
+        '--presses', type=int, default=20,
+        help='number of key presses to time (default: %(default)s)')
+    ap.add_argument(
+        '--keys', type=int, default=2,
+        help='number of keys showing each action (default: %(default)s)')
+    ap.add_argument(
+        '--daemon-arg', action='append', default=[], metavar='ARG',
+        help='extra argument to pass to the daemon; may be repeated')
+    ap.add_argument(
+        '--log',
+        help='file to write the daemon\'s log to (default: discard it)')
+
+    args = ap.parse_args()
+
+    results = {
+        'commit': None,
+        'config': {
+            'keys': args.keys,
+            'daemon_args': args.daemon_arg,
+        },
+    }
+
+    try:
+        results['commit'] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+            check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    # Lay out a directory like an installed plugin for the daemon to run in
+    plugin_dir = tempfile.mkdtemp(prefix='e2e_bench.')
+    shutil.copy(os.path.join(ROOT_DIR, 'manifest.json'), plugin_dir)
+    for fn in glob.glob(os.path.join(ROOT_DIR, 'assets', '*.png')):
+        shutil.copy(fn, plugin_dir)
+
+    state_file = os.path.join(plugin_dir, 'state')
+    with open(state_file, 'w') as f:
+        f.write(NO_CALL)
+
+    # Collect analytics locally
+    runner = web.AppRunner(fake_analytics.make_app(Namespace(delay=0)))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    analytics_port = runner.addresses[0][1]
+
+    worker = [
+        sys.executable, '-m', 'streamdeck_workrooms.fakes.worker',
+        '--state-file', state_file]
+    argv = [
+        sys.executable, os.path.join(ROOT_DIR, 'daemon.py'), '-vv',
+        '--browser-worker', shlex.join(worker),
+        '--no-push',
+        '--image-cache', '',
+        '--analytics-spool', '',
+        '--analytics-endpoint', f'http://127.0.0.1:{analytics_port}',
+    ] + args.daemon_arg
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT_DIR] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+
+    log = open(args.log or os.devnull, 'w')
+    sd = FakeStreamDeck()
+    await sd.start()
+
+    try:
+        launched = time.time()
+        await sd.launch(argv, cwd=plugin_dir, env=env, stderr=log)
+
+        contexts = {
+            a: [f'{a.upper()}{k + 1}' for k in range(args.keys)] for a in ACTIONS}
+        for a in ACTIONS:
+            for c in contexts[a]:
+                await sd.appear(a, c)
+
+        await wait_for_images(sd, [c for cs in contexts.values() for c in cs], since=launched)
+        results['startup_seconds'] = time.time() - launched
+
+        # Let the poller back off fully before measuring
+        await asyncio.sleep(10)
+        results['idle'] = await measure_steady(sd, args.idle_seconds)
+
+        start = time.time()
+        with open(state_file, 'w') as f:
+            f.write(IN_CALL)
+        await wait_for_images(sd, contexts['mic'], since=start, timeout=30)
+        await asyncio.sleep(2)
+        results['in_call'] = await measure_steady(sd, args.call_seconds)
+
+        results['state_changes'] = await measure_changes(sd, state_file, contexts, args.changes)
+        results['press_to_set_image'] = await measure_presses(sd, contexts, args.presses)
+
+        results['totals'] = {
+            'messages': len(sd.received),
+            'bytes': sd.bytes_received,
+        }
+    finally:
+        await sd.stop()
+        await runner.cleanup()
+        log.close()
+        shutil.rmtree(plugin_dir, ignore_errors=True)
+
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+def main():
+    asyncio.run(main_async())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+'''
+Measure how long query.js takes to scan a saved call page.
+
+This opens `fixtures/call.html` in a new tab of a browser with remote
+debugging enabled (e.g. started with `--remote-debugging-port=9222`), runs
+query.js against it repeatedly, and writes timings as JSON to stdout. Each
+scan is timed inside the page, so this measures only the time that the page's
+main thread is blocked.
+
+Scans are timed both "cold", with query.js's cache of buttons cleared before
+each one, and "warm", as they would be on successive polls. To compare against
+another version of the scanner, pass it with `--query`, e.g.
+
+    git show HEAD~:bin/query.js > /tmp/query.js
+    python bench/query_bench.py --query /tmp/query.js
+'''
+
+from argparse import ArgumentParser
+import asyncio
+import json
+import os.path
+import statistics
+import sys
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+from streamdeck_workrooms.cdp import http_json
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+async def evaluate(ws, expression):
+    await ws.send(json.dumps({
+        'id': 1,
+        'method': 'Runtime.evaluate',
+        'params': {
+            'expression': expression,
+            'returnByValue': True,
+            'awaitPromise': True,
+        },
+    }))
+
+    while True:
+        resp = json.loads(await ws.recv())
+        if resp.get('id') == 1:
+            break
+
+    result = resp['result']
+    if 'exceptionDetails' in result:
+        raise RuntimeError(result['exceptionDetails'])
+
+    return result['result'].get('value')
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        'runs': len(times),
+        'mean_ms': statistics.mean(times),
+        'p50_ms': times[len(times) // 2],
+        'p95_ms': times[int(len(times) * 0.95)],
+        'max_ms': times[-1],
+    }
+
+
+async def main_async():
+    ap = ArgumentParser(
+        description='Measure how long query.js takes to scan a saved call page.')
+    ap.add_argument(
+        '--port', type=int, default=9222,
+        help='remote debugging port of the browser (default: %(default)s)')
+    ap.add_argument(
+        '--query', default=os.path.join(BENCH_DIR, os.path.pardir, 'bin', 'query.js'),
+        help='query script to measure (default: bin/query.js)')
+    ap.add_argument(
+        '--fixture', default=os.path.join(BENCH_DIR, 'fixtures', 'call.html'),
+        help='saved page to scan (default: fixtures/call.html)')
+    ap.add_argument(
+        '-n', type=int, default=200,
+        help='number of scans of each kind (default: %(default)s)')
+
+    args = ap.parse_args()
+
+    with open(args.query, encoding='utf-8') as f:
+        query_text = f.read()
+
+    # The fragment makes this look like a call tab to the daemon, too
+    url = 'file://' + os.path.abspath(args.fixture) + '#/LINK:query-bench'
+    target = await http_json('127.0.0.1', args.port, f'/json/new?{url}', method='PUT')
+
+    try:
+        async with websockets.connect(target['webSocketDebuggerUrl'], max_size=None) as ws:
+            await evaluate(ws, '''
+                new Promise((resolve) => {
+                    if (document.readyState === "complete") {
+                        resolve();
+                    } else {
+                        window.addEventListener("load", resolve);
+                    }
+                })''')
+
+            results = {}
+            for kind in ['cold', 'warm']:
+                value = await evaluate(ws, f'''
+                    (() => {{
+                        let query = ({query_text});
+                        let times = [];
+                        let result = null;
+
+                        delete window.streamdeckWorkroomsQueryCache;
+                        for (let i = 0; i < {args.n}; i++) {{
+                            if ({json.dumps(kind == 'cold')}) {{
+                                delete window.streamdeckWorkroomsQueryCache;
+                            }}
+
+                            let start = performance.now();
+                            result = query();
+                            times.push(performance.now() - start);
+                        }}
+
+                        return JSON.stringify({{times: times, result: result}});
+                    }})()''')
+
+                jo = json.loads(value)
+                results[kind] = summarize(jo['times'])
+                results['result'] = jo['result']
+
+            results['nodes'] = await evaluate(
+                ws, 'document.getElementsByTagName("*").length')
+    finally:
+        # This responds with plain text rather than JSON
+        try:
+            await http_json('127.0.0.1', args.port, f'/json/close/{target["id"]}')
+        except ValueError:
+            pass
+
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+def main():
+    asyncio.run(main_async())
+
+
+if __name__ == '__main__':
+    main()
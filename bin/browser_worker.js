@@ -0,0 +1,201 @@
+// Long-lived worker for querying and toggling browser state.
+//
+// Run this as `osascript -l JavaScript browser_worker.js <bin dir>`. Requests
+// are read from stdin as newline-delimited JSON objects and responses are
+// written to stdout in the same format, one per request, e.g.
+//
+//  > {"id": 1, "op": "query"}
+//  < {"id": 1, "ok": true, "result": [{"tab": "1:2", "result": "<query.js result>"}]}
+//
+//  > {"id": 2, "op": "toggle", "target": "mic", "tab": "1:2"}
+//  < {"id": 2, "ok": true, "result": true}
+//
+//  > {"id": 3, "op": "ensure", "targets": [{"action": "mic", "state": "OFF"}], "tab": "1:2"}
+//  < {"id": 3, "ok": true, "result": "{\"mic\": \"CLICKED\"}"}
+//
+//  > {"id": 4, "op": "observe", "port": 50123, "token": "...", "heartbeatMs": 2000, "tab": "1:2"}
+//  < {"id": 4, "ok": true, "result": "INSTALLED"}
+//
+// Failures are reported as {"id": N, "ok": false, "error": "<message>"}. If
+// the tab isn't showing a call any more, or Chrome isn't running, requests
+// other than queries return null, and so toggles don't return true.
+//
+// A query runs query.js in every call tab in one go; the other requests act on
+// the tab that the daemon picked from those results. The text of query.js /
+// toggle.js / ensure.js / observe.js is read once at startup and the set of
+// call tabs is remembered between requests so that we don't have to walk every
+// window and tab each time.
+//
+// NOTES:
+//
+//   * Chrome only
+//
+//   * User must enable this in Chrome via the menu View->Developer->Apple
+//     JavaScript from Apple Events
+
+ObjC.import('Foundation');
+
+function readFile(path) {
+    return $.NSString.stringWithContentsOfFileEncodingError(
+        path, $.NSUTF8StringEncoding, null).js;
+}
+
+function writeLine(obj) {
+    let s = $(JSON.stringify(obj) + '\n');
+    $.NSFileHandle.fileHandleWithStandardOutput.writeData(
+        s.dataUsingEncoding($.NSUTF8StringEncoding));
+}
+
+// Return the next line from stdin, or null on EOF
+let stdinBuffer = '';
+function readLine() {
+    let stdin = $.NSFileHandle.fileHandleWithStandardInput;
+
+    while (stdinBuffer.indexOf('\n') < 0) {
+        let data = stdin.availableData;
+        if (data.length === 0) {
+            return null;
+        }
+
+        stdinBuffer += $.NSString.alloc.initWithDataEncoding(
+            data, $.NSUTF8StringEncoding).js;
+    }
+
+    let i = stdinBuffer.indexOf('\n');
+    let line = stdinBuffer.slice(0, i);
+    stdinBuffer = stdinBuffer.slice(i + 1);
+    return line;
+}
+
+function run(argv) {
+    let binDir = argv[0];
+    let queryText = readFile(binDir + '/query.js');
+    let toggleText = readFile(binDir + '/toggle.js');
+    let ensureText = readFile(binDir + '/ensure.js');
+    let observeText = readFile(binDir + '/observe.js');
+
+    let chrome = Application('Google Chrome');
+
+    // Call tabs that we last found, as {key, window, tab}, and when we looked
+    // for them. A non-empty list is re-used for DISCOVERY_MS before looking
+    // again, unless a tab turns out to have gone away.
+    let DISCOVERY_MS = 10000;
+    let tabs = [];
+    let tabsTime = 0;
+
+    let findTabs = () => {
+        let now = Date.now();
+        if (tabs.length > 0 && now - tabsTime < DISCOVERY_MS) {
+            return tabs;
+        }
+
+        // Fetch the IDs and URLs of every tab using a handful of Apple Events
+        // in total rather than a few per tab
+        let windowIds = chrome.windows.id();
+        let tabIds = chrome.windows.tabs.id();
+        let urls = chrome.windows.tabs.url();
+
+        tabs = [];
+        for (let i = 0; i < windowIds.length; i++) {
+            for (let j = 0; j < tabIds[i].length; j++) {
+                if (urls[i][j].indexOf('/LINK:') >= 0) {
+                    tabs.push({
+                        key: windowIds[i] + ':' + tabIds[i][j],
+                        window: windowIds[i],
+                        tab: tabIds[i][j],
+                    });
+                }
+            }
+        }
+
+        tabsTime = now;
+        return tabs;
+    };
+
+    // Run `js` in the given tab, returning null without running it if the tab
+    // has navigated away from the call
+    let execute = (t, js) => {
+        return chrome.windows.byId(t.window).tabs.byId(t.tab).execute({
+            javascript: '(location.href.indexOf("/LINK:") < 0) ? null : ' + js,
+        });
+    };
+
+    // Query every call tab, returning a list of {tab, result}. Picking which
+    // of these is the active call is left to browser.py.
+    let query = () => {
+        let results = [];
+        let err = null;
+
+        for (let t of findTabs()) {
+            try {
+                let result = execute(t, '(' + queryText + ')()');
+                if (result !== null && result !== undefined) {
+                    results.push({tab: t.key, result: result});
+                    continue;
+                }
+            } catch (e) {
+                err = err || e;
+            }
+
+            // The tab went away or navigated elsewhere; look again next time
+            tabsTime = 0;
+        }
+
+        // If we couldn't query anything, report why
+        if (results.length === 0 && err !== null) {
+            throw err;
+        }
+
+        return results;
+    };
+
+    let handle = (req) => {
+        // Don't start Chrome if it's not already running. Not having a
+        // browser is the same as not having any rooms.
+        if (!chrome.running()) {
+            return (req.op === 'query') ? [] : null;
+        }
+
+        if (req.op === 'query') {
+            return query();
+        }
+
+        let js =
+            (req.op === 'toggle') ? '((' + toggleText + ')(' + JSON.stringify(req.target) + '), true)' :
+            (req.op === 'ensure') ? '(' + ensureText + ')(' + JSON.stringify(req.targets) + ')' :
+            (req.op === 'observe') ?
+                '(' + observeText + ')((' + queryText + '), ' +
+                JSON.stringify(req.port) + ', ' + JSON.stringify(req.token) + ', ' +
+                JSON.stringify(req.heartbeatMs) + ', ' + JSON.stringify(req.tab) + ')' :
+            null;
+        if (js === null) {
+            throw new Error('unknown op ' + req.op);
+        }
+
+        // Act on the tab that browser.py picked, without re-scanning
+        let t = findTabs().find((t) => { return t.key === req.tab; });
+        if (t === undefined) {
+            return null;
+        }
+
+        try {
+            return execute(t, js);
+        } catch (e) {
+            tabsTime = 0;
+            throw e;
+        }
+    };
+
+    for (let line = readLine(); line !== null; line = readLine()) {
+        if (line.trim() === '') {
+            continue;
+        }
+
+        let req = JSON.parse(line);
+        try {
+            writeLine({id: req.id, ok: true, result: handle(req)});
+        } catch (e) {
+            writeLine({id: req.id, ok: false, error: String(e)});
+        }
+    }
+}
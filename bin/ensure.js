@@ -0,0 +1,100 @@
+// Bring several actions to the given states in one go, e.g. for a macro key.
+//
+// Takes a list of steps, e.g.
+//
+//   [{"action": "mic", "state": "OFF"}, {"action": "call", "state": "OFF"}]
+//
+// where the states are those reported by query.js. Steps are carried out in
+// order, clicking an action's button only if it isn't already in the target
+// state, so running this twice is the same as running it once. Returns a JSON
+// string saying what happened to each action:
+//
+//   CLICKED       the button was clicked
+//   ALREADY       the action was already in the target state
+//   NOT_FOUND     no button was found
+//   UNRECOGNIZED  the button was found but its label wasn't understood
+(steps) => {
+    // Regular expressions to idetify buttons. These must be kept in-sync
+    // between toggle.js <=> query.js <=> ensure.js
+    // ***** BEGIN *****
+    let micButtonRegex = /^(mute|unmute) microphone$/i;
+    let cameraButtonRegex = /^turn (off|on) (video|camera)$/i;
+    let handButtonRegex = /^(raise|lower) hand$/i;
+    let callButtonRegex = /^(join as )|(join room)|(end call)/i;
+    // ***** END *****
+
+    let actions = {
+        mic: {
+            button: micButtonRegex,
+            off: /^unmute microphone$/i,
+            on: /^mute microphone$/i,
+        },
+        camera: {
+            button: cameraButtonRegex,
+            off: /^turn on (camera|video)$/i,
+            on: /^turn off (camera|video)$/i,
+        },
+        hand: {
+            button: handButtonRegex,
+            off: /^raise hand$/i,
+            on: /^lower hand$/i,
+        },
+        call: {
+            button: callButtonRegex,
+            off: /^(join as )|(join room)/i,
+            on: /^end call$/i,
+        },
+    };
+
+    // Use the leaf spans that query.js found last time if they're still around,
+    // and otherwise look at every leaf span, at most once
+    let cache = window.streamdeckWorkroomsQueryCache;
+    let spans = null;
+    let find = (name) => {
+        let re = actions[name].button;
+        let cached = (cache && cache.nodes) ?
+            cache.nodes[name].filter((n) => { return n.childElementCount === 0; }) :
+            [];
+        if (cached.length > 0 && cached.every((n) => {
+            return n.isConnected && re.test(n.textContent);
+        })) {
+            return cached;
+        }
+
+        if (spans === null) {
+            spans = Array.from(document.querySelectorAll('span'))
+                .filter((n) => { return n.childElementCount === 0; });
+        }
+
+        return spans.filter((n) => {
+            return n.isConnected && re.test(n.textContent);
+        });
+    };
+
+    let result = {};
+    for (let step of steps) {
+        let a = actions[step.action];
+        let found = (a === undefined) ? [] : find(step.action);
+        if (found.length === 0) {
+            result[step.action] = "NOT_FOUND";
+            continue;
+        }
+
+        let text = found[0].textContent;
+        let state =
+            a.off.test(text) ? "OFF" :
+            a.on.test(text) ? "ON" :
+            null;
+
+        if (state === null) {
+            result[step.action] = "UNRECOGNIZED";
+        } else if (state === step.state) {
+            result[step.action] = "ALREADY";
+        } else {
+            found.forEach((b) => { b.click(); });
+            result[step.action] = "CLICKED";
+        }
+    }
+
+    return JSON.stringify(result);
+}
@@ -0,0 +1,91 @@
+// Install an observer in the call tab which pushes state changes to the daemon.
+//
+// The `query` argument is the function from query.js. Whenever the DOM
+// changes, we re-run it and, if the result differs from what we last sent,
+// send it to the daemon's WebSocket listener on `port` as
+//
+//   {"token": "<token>", "tab": "<tab>", "state": "<query.js result>"}
+//
+// where `tab` is the daemon's identifier for this tab.
+//
+// The last result is also re-sent every `heartbeatMs` so that the daemon can
+// tell that we're still alive; if it stops hearing from us it falls back to
+// polling and tries to install the observer again.
+//
+// Returns "RUNNING" if an observer for the given port and token is already
+// installed, or "INSTALLED" otherwise.
+(query, port, token, heartbeatMs, tab) => {
+    let existing = window.streamdeckWorkroomsObserver;
+    if (existing && existing.port === port && existing.token === token) {
+        return "RUNNING";
+    }
+
+    // An observer from an earlier daemon; replace it
+    if (existing) {
+        existing.stop();
+    }
+
+    let obs = {
+        port: port,
+        token: token,
+        last: null,
+        scheduled: false,
+    };
+
+    let send = (state) => {
+        if (obs.ws.readyState === WebSocket.OPEN) {
+            obs.ws.send(JSON.stringify({token: token, tab: tab, state: state}));
+        }
+    };
+
+    let check = () => {
+        obs.scheduled = false;
+
+        let state = query();
+        if (state !== obs.last) {
+            obs.last = state;
+            send(state);
+        }
+    };
+
+    // Mutations tend to arrive in bursts; coalesce them into a single query
+    let mo = new MutationObserver(() => {
+        if (!obs.scheduled) {
+            obs.scheduled = true;
+            setTimeout(check, 50);
+        }
+    });
+
+    obs.stop = () => {
+        mo.disconnect();
+        clearInterval(obs.heartbeat);
+        obs.ws.onclose = null;
+        obs.ws.close();
+
+        if (window.streamdeckWorkroomsObserver === obs) {
+            delete window.streamdeckWorkroomsObserver;
+        }
+    };
+
+    obs.ws = new WebSocket("ws://127.0.0.1:" + port + "/");
+    obs.ws.onopen = () => {
+        obs.last = query();
+        send(obs.last);
+    };
+
+    // The daemon has gone away. Don't bother reconnecting; it will install a
+    // new observer when it comes back.
+    obs.ws.onclose = obs.stop;
+
+    mo.observe(document.body, {
+        subtree: true,
+        childList: true,
+        characterData: true,
+        attributes: true,
+        attributeFilter: ["aria-label"],
+    });
+    obs.heartbeat = setInterval(() => { send(obs.last); }, heartbeatMs);
+
+    window.streamdeckWorkroomsObserver = obs;
+    return "INSTALLED";
+}
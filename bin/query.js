@@ -1,10 +1,28 @@
-// The order of states returned [mic, camera] and the text of the states must
-// match the Python code which interprets this. This function returns an array
-// of values rather than a single one so that we can avoid issuing multiple
-// queries per tick.
+// Query the state of the call in this tab.
+//
+// Returns a JSON string describing the call, e.g.
+//
+//   {"state": "CALL",
+//    "actions": {"mic": {"state": "ON", "reason": "OK"}, ...}}
+//
+// The action names and the text of the states must match the Python code
+// which interprets this. Each action has a "reason" explaining its state:
+//
+//   OK            the button was found and its label understood
+//   NOT_FOUND     no button was found
+//   AMBIGUOUS     several buttons were found and they disagree
+//   UNRECOGNIZED  the button was found but its label wasn't understood
+//
+// If this is a post-call screen rather than a call, returns
+// {"state": "NONE", "reason": "SURVEY" | "LEFT"} instead.
+//
+// Post-call screens are looked for on every call. The spans on the page are
+// looked at at most once per call, and the buttons that were found are
+// remembered on the window so that later calls can usually skip them
+// altogether.
 () => {
     // Regular expressions to idetify buttons. These must be kept in-sync
-    // between toggle.js <=> query.js
+    // between toggle.js <=> query.js <=> ensure.js
     // ***** BEGIN *****
     let micButtonRegex = /^(mute|unmute) microphone$/i;
     let cameraButtonRegex = /^turn (off|on) (video|camera)$/i;
@@ -12,82 +30,127 @@
     let callButtonRegex = /^(join as )|(join room)|(end call)/i;
     // ***** END *****
 
-    // Detect post-call screens and short-circuit the rest of the checks.
-    // Return the sentinel NONE value so that the daemon can handle this
-    // appropriately.
-    //
-    // There are two variants of this
+    let actions = {
+        mic: {
+            button: micButtonRegex,
+            off: /^unmute microphone$/i,
+            on: /^mute microphone$/i,
+        },
+        camera: {
+            button: cameraButtonRegex,
+            off: /^turn on (camera|video)$/i,
+            on: /^turn off (camera|video)$/i,
+        },
+        hand: {
+            button: handButtonRegex,
+            leafOnly: true,
+            off: /^raise hand$/i,
+            on: /^lower hand$/i,
+        },
+        call: {
+            button: callButtonRegex,
+            leafOnly: true,
+            off: /^(join as )|(join room)/i,
+            on: /^end call$/i,
+        },
+    };
+    let names = Object.keys(actions);
+
+    // Markers for the two variants of post-call screens
     //
     //  1. A post-call survey with a bunch of buttons.
     //
     //  2. A splash page indicates that the call is no longer active.
     let ratingButtonRegex = /^very good$/i;
-    let svgText = Array.from(document.querySelectorAll("svg"))
-        .map((n) => { return n.getAttribute("aria-label") || ""; })
-        .filter((t) => { return t.match(ratingButtonRegex); })
-        .join("");
-    if (svgText !== "") {
-        return "NONE";
+    let leftRegex = /^you left the room$/i;
+
+    // Re-walk the DOM every so often even if all cached buttons are still
+    // present, to pick up buttons that appear later (e.g. hand)
+    let RESCAN_INTERVAL = 10;
+
+    let cache = window.streamdeckWorkroomsQueryCache;
+    if (!cache) {
+        cache = window.streamdeckWorkroomsQueryCache = {count: 0, nodes: null};
     }
 
-    let leftButtonRegex = /^you left the room$/i;
-    let leftText = Array.from(document.querySelectorAll("div"))
-        .filter((n) => { return n.textContent.match(leftButtonRegex); })
-        .join("");
-    if (leftText !== "") {
-        return "NONE";
+    // The call's buttons can stay on the page under a post-call screen, so
+    // check for one even when the cached buttons are still there
+    let svgs = document.querySelectorAll("svg[aria-label]");
+    if (Array.from(svgs).some((n) => {
+        return ratingButtonRegex.test(n.getAttribute("aria-label"));
+    })) {
+        cache.nodes = null;
+        return JSON.stringify({state: "NONE", reason: "SURVEY"});
     }
 
-    let micOffRegex = /^unmute microphone$/i;
-    let micOnRegex = /^mute microphone$/i;
-    let micText = Array.from(document.querySelectorAll('span'))
-        .filter((n) => { return n.textContent.match(micButtonRegex); })
-        .map((n) => { return n.textContent; })
-        .join('');
-    let micState =
-        (micText.match(micOffRegex)) ? "OFF" :
-        (micText.match(micOnRegex)) ? "ON" :
-        "UNKNOWN";
+    // Any div containing only this text will do. Rolling up the text of every
+    // div is costly, so only do it if the text is on the page at all.
+    if (/you left the room/i.test(document.documentElement.textContent) &&
+            Array.from(document.querySelectorAll("div")).some((n) => {
+                return leftRegex.test(n.textContent);
+            })) {
+        cache.nodes = null;
+        return JSON.stringify({state: "NONE", reason: "LEFT"});
+    }
+
+    // Can we trust the cached nodes? Only if we found some last time and
+    // they're all still on the page with the labels we expect.
+    let valid = cache.nodes !== null && (cache.count++ % RESCAN_INTERVAL) !== 0;
+    let cachedCount = 0;
+    for (let i = 0; valid && i < names.length; i++) {
+        let found = cache.nodes[names[i]];
+        for (let j = 0; valid && j < found.length; j++) {
+            valid = found[j].isConnected &&
+                actions[names[i]].button.test(found[j].textContent);
+        }
 
-    let cameraOffRegex = /^turn on (camera|video)$/i;
-    let cameraOnRegex = /^turn off (camera|video)$/i;
-    let cameraText = Array.from(document.querySelectorAll('span'))
-        .filter((n) => { return n.textContent.match(cameraButtonRegex); })
-        .map((n) => { return n.textContent; })
-        .join('');
-    let cameraState =
-        (cameraText.match(cameraOffRegex)) ? "OFF" :
-        (cameraText.match(cameraOnRegex)) ? "ON" :
-        "UNKNOWN";
+        cachedCount += found.length;
+    }
+    valid = valid && cachedCount > 0;
 
-    let handOffRegex = /^raise hand$/i;
-    let handOnRegex = /^lower hand$/i;
-    let handText = Array.from(document.querySelectorAll('span'))
-        // Node.textContent rolls up text from all child nodes. If there are
-        // nested spans, this will cause /all/ of the spans to match. Really we
-        // just want the leaf. Strip out all nodes that have children.
-        .filter((n) => { return n.childElementCount === 0 })
-        .filter((n) => { return n.textContent.match(handButtonRegex); })
-        .map((n) => { return n.textContent; })
-        .join('');
-    let handState =
-        (handText.match(handOffRegex)) ? "OFF" :
-        (handText.match(handOnRegex)) ? "ON" :
-        "UNKNOWN";
+    if (!valid) {
+        let nodes = {};
+        names.forEach((n) => { nodes[n] = []; });
 
-    let callOffRegex = /^(join as )|(join room)/i;
-    let callOnRegex = /^end call$/i;
-    let callText = Array.from(document.querySelectorAll('span'))
-        // Node.textContent rolls up text from all child nodes. If there are
-        // nested spans, this will cause /all/ of the spans to match. Really we
-        // just want the leaf. Strip out all nodes that have children.
-        .filter((n) => { return n.childElementCount === 0 })
-        .filter((n) => { return n.textContent.match(callButtonRegex); })
-        .map((n) => { return n.textContent; })
-        .join('');
-    let callState =
-        (callText.match(callOffRegex)) ? "OFF" :
-        (callText.match(callOnRegex)) ? "ON" : "UNKNOWN";
+        // Node.textContent rolls up text from all child nodes, so if there
+        // are nested spans, all of them match. The mic and camera labels are
+        // matched on any span, but for the hand and call buttons we just want
+        // the leaf.
+        for (let n of document.querySelectorAll("span")) {
+            let leaf = n.childElementCount === 0;
+            let text = n.textContent;
+            for (let name of names) {
+                if ((leaf || !actions[name].leafOnly) &&
+                        actions[name].button.test(text)) {
+                    nodes[name].push(n);
+                }
+            }
+        }
+
+        cache.nodes = nodes;
+    }
+
+    let result = {state: "CALL", actions: {}};
+    for (let name of names) {
+        let a = actions[name];
+        let texts = cache.nodes[name].map((n) => { return n.textContent; });
+
+        let state = "UNKNOWN";
+        let reason = "OK";
+        if (texts.length === 0) {
+            reason = "NOT_FOUND";
+        } else if (texts.some((t) => { return t !== texts[0]; })) {
+            reason = "AMBIGUOUS";
+        } else if (texts[0].match(a.off)) {
+            state = "OFF";
+        } else if (texts[0].match(a.on)) {
+            state = "ON";
+        } else {
+            reason = "UNRECOGNIZED";
+        }
+
+        result.actions[name] = {state: state, reason: reason};
+    }
 
-    return [micState, cameraState, handState, callState].join(" ");
+    return JSON.stringify(result);
 }
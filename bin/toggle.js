@@ -1,6 +1,6 @@
 (target) => {
     // Regular expressions to idetify buttons. These must be kept in-sync
-    // between toggle.js <=> query.js
+    // between toggle.js <=> query.js <=> ensure.js
     // ***** BEGIN *****
     let micButtonRegex = /^(mute|unmute) microphone$/i;
     let cameraButtonRegex = /^turn (off|on) (video|camera)$/i;
@@ -19,6 +19,20 @@
         return;
     }
 
+    // Use the buttons that query.js found last time if they're still around.
+    // It also remembers any spans around the mic and camera labels, but only
+    // the leaves should be clicked.
+    let cache = window.streamdeckWorkroomsQueryCache;
+    let cached = (cache && cache.nodes) ?
+        cache.nodes[target].filter((n) => { return n.childElementCount === 0; }) :
+        [];
+    if (cached.length > 0 && cached.every((n) => {
+        return n.isConnected && re.test(n.textContent);
+    })) {
+        cached.forEach((b) => { b.click(); });
+        return;
+    }
+
     Array.from(document.querySelectorAll('span'))
         // Node.textContent rolls up text from all child nodes. If there are
         // nested spans, this will cause /all/ of the spans to match. Really we
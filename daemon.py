@@ -1,55 +1,31 @@
 from streamdeck_workrooms import analytics
 from streamdeck_workrooms import browser
+from streamdeck_workrooms import cdp
+from streamdeck_workrooms import clock
+from streamdeck_workrooms import logs
+from streamdeck_workrooms import metrics
+from streamdeck_workrooms import profiling
+from streamdeck_workrooms import push
 from streamdeck_workrooms import streamdeck
-from streamdeck_workrooms.types import ActionState
+from streamdeck_workrooms.images import ImageCache, scale_for_info
+from streamdeck_workrooms.outbox import Outbox
+from streamdeck_workrooms.replay import Recorder
+from streamdeck_workrooms.settings import SCHEMA, Settings
+from streamdeck_workrooms.spool import Spool
+from streamdeck_workrooms.types import ACTIONS, new_action_metadata
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 import asyncio
-from collections import defaultdict
 import json
-from logging import ERROR, basicConfig, info
+from logging import ERROR, exception, info
 from functools import partial
-import sys
-import time
+import os.path
+import shlex
 from uuid import uuid4
-import websockets
 
 
 # Global state for each action
-action_metadata = {
-    'mic': {
-        'index': 0,
-        'context': None,
-        'current': ActionState(),
-        'next': ActionState(),
-        'next_time': 0,
-        'action_time': None,
-    },
-    'camera': {
-        'index': 1,
-        'context': None,
-        'current': ActionState(),
-        'next': ActionState(),
-        'next_time': 0,
-        'action_time': None,
-    },
-    'hand': {
-        'index': 2,
-        'context': None,
-        'current': ActionState(),
-        'next': ActionState(),
-        'next_time': 0,
-        'action_time': None,
-    },
-    'call': {
-        'index': 3,
-        'context': None,
-        'current': ActionState(),
-        'next': ActionState(),
-        'next_time': 0,
-        'action_time': None,
-    },
-}
+action_metadata = new_action_metadata()
 
 
 # Get the plugin version string from manifest.json
@@ -68,6 +44,116 @@ Command handler for an Elgato Stream Deck plugin for Facebook actions.
     ap.add_argument(
 		'-v', action='count', default=0,
 		help='increase logging verbosity; can be used multiple times')
+    ap.add_argument(
+        '--browser-backend', choices=['worker', 'cdp'], default='worker',
+        help='how to talk to the browser: a worker process using AppleScript, '
+             'or the Chrome DevTools Protocol (default: %(default)s)')
+    ap.add_argument(
+        '--cdp-port', type=int, default=9222,
+        help='remote debugging port of the browser when using the cdp '
+             'backend (default: %(default)s)')
+    ap.add_argument(
+        '--no-push', action='store_true',
+        help='always poll the browser rather than installing an observer in '
+             'the call tab to push state changes')
+    ap.add_argument(
+        '--poll-fast', type=float, default=SCHEMA['poll_fast'].default,
+        metavar='SECONDS',
+        help='interval between polls of the browser while waiting for a '
+             'toggle to take effect, unless set in the global settings '
+             '(default: %(default)s)')
+    ap.add_argument(
+        '--poll-normal', type=float, default=SCHEMA['poll_normal'].default,
+        metavar='SECONDS',
+        help='interval between polls of the browser during a call, unless '
+             'set in the global settings (default: %(default)s)')
+    ap.add_argument(
+        '--poll-idle-max', type=float, default=SCHEMA['poll_idle_max'].default,
+        metavar='SECONDS',
+        help='maximum interval between polls of the browser when there is '
+             'no call; polling backs off exponentially up to this, unless '
+             'set in the global settings (default: %(default)s)')
+    ap.add_argument(
+        '--optimistic', action='store_true',
+        help='update keys as soon as a toggle succeeds rather than waiting '
+             'for the browser to report the new state')
+    ap.add_argument(
+        '--toggle-window', type=float, default=0.15, metavar='SECONDS',
+        help='window in which repeated presses of a key are coalesced into '
+             'their net effect (default: %(default)s)')
+    ap.add_argument(
+        '--browser-timeout', type=float, default=browser.REQUEST_TIMEOUT_SECONDS,
+        metavar='SECONDS',
+        help='how long to wait for the browser to answer a request before '
+             'giving up on it; a stuck browser worker is killed '
+             '(default: %(default)s)')
+    ap.add_argument(
+        '--browser-worker', metavar='CMD',
+        default=f'osascript -l JavaScript browser_worker.js {os.path.curdir}',
+        help='command to run as the browser worker process (default: %(default)s)')
+
+    ap.add_argument(
+        '--image-cache', metavar='PATH',
+        default='~/Library/Caches/in.std.streamdeck.workplace/images.json',
+        help='file in which to cache encoded key images between runs; pass '
+             'an empty string to disable (default: %(default)s)')
+
+    ap.add_argument(
+        '--analytics-endpoint', metavar='URL', default=analytics.ENDPOINT,
+        help='base URL to send analytics to, e.g. a local '
+             'streamdeck_workrooms.fakes.analytics (default: %(default)s)')
+
+    ap.add_argument(
+        '--analytics-spool', metavar='PATH',
+        default='~/Library/Caches/in.std.streamdeck.workplace/analytics.spool',
+        help='file in which to keep analytics that could not be sent, to be '
+             'retried later; pass an empty string to disable '
+             '(default: %(default)s)')
+
+    ap.add_argument(
+        '--metrics-port', type=int, metavar='PORT',
+        help='serve metrics in the Prometheus text format at '
+             'http://127.0.0.1:PORT/metrics; metrics can also be written to '
+             'the log by sending SIGUSR1')
+
+    ap.add_argument(
+        '--log-file', metavar='PATH',
+        help='write the log to PATH rather than stderr, rotating it once it '
+             'gets bigger than {} MB'.format(logs.MAX_BYTES // (1024 * 1024)))
+
+    ap.add_argument(
+        '--startup-profile', action='store_true',
+        help='log how long each phase of startup took, even without -v')
+
+    ap.add_argument(
+        '--profile', action='store_true',
+        help='find out where time goes: log callbacks that block the event '
+             'loop, slow rounds of browser updates and how busy each part of '
+             'the daemon is, and write cProfile stats every so often')
+    ap.add_argument(
+        '--profile-slow-callback', type=float, default=0.1, metavar='SECONDS',
+        help='with --profile, log callbacks that run for longer than this '
+             '(default: %(default)s)')
+    ap.add_argument(
+        '--profile-tick-budget', type=float, default=0.25, metavar='SECONDS',
+        help='with --profile, log browser states that take longer than this '
+             'to get and process (default: %(default)s)')
+    ap.add_argument(
+        '--profile-interval', type=float, default=profiling.REPORT_SECONDS,
+        metavar='SECONDS',
+        help='with --profile, how often to report how busy each part of the '
+             'daemon is and write cProfile stats (default: %(default)s)')
+    ap.add_argument(
+        '--profile-stats', metavar='PATH',
+        default='~/Library/Logs/streamdeck-workrooms.pstats',
+        help='with --profile, file to write cProfile stats to, for reading '
+             'with pstats; older stats are kept in PATH.1, PATH.2 and so on '
+             '(default: %(default)s)')
+
+    ap.add_argument(
+        '--record', metavar='PATH',
+        help='record messages from Stream Deck and states of the browser to '
+             'PATH, to be replayed with streamdeck_workrooms.replay')
 
     # Options defined by the Stream Deck plugin prototol
     ap.add_argument('-port')
@@ -77,94 +163,251 @@ Command handler for an Elgato Stream Deck plugin for Facebook actions.
 
     args = ap.parse_args()
 
-    basicConfig(
-        style='{', format='{asctime} {message}', level=ERROR - args.v * 10,
-        stream=sys.stderr)
+    # Logs are written from a background thread, so that writing them never
+    # holds up the event loop
+    logs.configure(
+        ERROR - args.v * 10,
+        path=os.path.expanduser(args.log_file) if args.log_file else None)
+
+    if args.startup_profile:
+        metrics.STARTUP.level = ERROR
+    metrics.STARTUP.phase('imports')
+
+    # Profiling starts as early as possible so that it covers startup too
+    profiler_tasks = []
+    if args.profile:
+        profiling.enable_slow_callbacks(
+            asyncio.get_running_loop(), args.profile_slow_callback)
+
+        sampler = profiling.Sampler({
+            'streamdeck': [streamdeck.listen],
+            'browser': [browser.listen],
+            'analytics': [analytics.listen],
+        })
+        sampler.start()
+
+        stats = profiling.StatsWriter(os.path.expanduser(args.profile_stats))
+        stats.start()
+
+        profiler_tasks.append(
+            profiling.report(sampler, stats, args.profile_interval))
 
     plugin_version = get_plugin_version()
     info(f'Facebook Workplace version {plugin_version} starting')
 
-    # Load images that we need
-    images = defaultdict(list)
-    for state in ['ON', 'OFF', 'UNKNOWN', 'NONE']:
-        for action in ['mic', 'camera', 'hand', 'call']:
-            images[state] += [
-                streamdeck.load_image_string(
-                    f'state_{action}_{state.lower()}.png')]
+    # Images are loaded as they're needed, in the resolution that best suits
+    # the connected devices
+    images = ImageCache(
+        scale=scale_for_info(args.info),
+        cache_path=os.path.expanduser(args.image_cache) if args.image_cache else None)
 
-    # Daemon main loop
+    # Everything that drives our behavior is written here, if asked for
+    recorder = None
+    if args.record:
+        recorder = Recorder(args.record, {
+            'optimistic': args.optimistic,
+            'toggle_window': args.toggle_window,
+            'poll_fast': args.poll_fast,
+            'poll_normal': args.poll_normal,
+            'poll_idle_max': args.poll_idle_max,
+        })
+
+    # Start up the browser backend; this is shared by all tasks that need to
+    # talk to the browser
+    if args.browser_backend == 'cdp':
+        backend = cdp.CDPBackend(
+            port=args.cdp_port, timeout_seconds=args.browser_timeout)
+    else:
+        backend = browser.WorkerBackend(
+            shlex.split(args.browser_worker),
+            timeout_seconds=args.browser_timeout)
+
+    toggle_queues = streamdeck.new_toggle_queues(args.toggle_window)
+
+    scheduler = browser.PollScheduler(
+        fast_seconds=args.poll_fast,
+        normal_seconds=args.poll_normal,
+        idle_max_seconds=args.poll_idle_max)
+
+    # Listen for state pushed by the observer in the call tab
+    push_listener = None
+    if not args.no_push:
+        push_listener = push.PushListener()
+
+    # Starting the browser side takes a while, e.g. to spawn the worker; do
+    # it while we connect to Stream Deck. If the backend can't be started,
+    # e.g. because the browser is restarting, polling tries again.
+    async def start_browser():
+        try:
+            await backend.start()
+        except Exception:
+            exception('starting the browser backend failed')
+
+        if push_listener is not None:
+            await push_listener.start()
+
+        metrics.STARTUP.phase('browser_started')
+
+    browser_started = asyncio.ensure_future(start_browser())
+
+    # Metrics are always collected, but only served if asked for
+    metrics.install_signal_handler()
+    if args.metrics_port:
+        await metrics.serve(args.metrics_port)
+
+    # Set up analytics
+    #
+    # Tasks interact with the analytics system by getting a callback that
+    # they can use to publich metrics. Set up this callback and associated
+    # infrastructure. Hits wait in the queue until we know our client ID and
+    # can start sending them.
+    analytics_queue = asyncio.Queue(analytics.QUEUE_MAX_HITS)
+
+    # Hits that we couldn't send are kept here until we can
+    analytics_spool = None
+    if args.analytics_spool:
+        analytics_spool = Spool(os.path.expanduser(args.analytics_spool))
+
+    analytics_policy = analytics.Policy()
+    analytics_collect = partial(
+        analytics.collect, analytics_queue, policy=analytics_policy,
+        an='StreamDeckWorkrooms', av=plugin_version, aip=1, npa=1)
+
+    # Settings that can be changed in the Property Inspector. These come with
+    # the global settings, and are applied whenever they change. Until then,
+    # we go with the defaults from the command line.
+    runtime_settings = Settings(scheduler, analytics_policy, defaults={
+        'poll_fast': args.poll_fast,
+        'poll_normal': args.poll_normal,
+        'poll_idle_max': args.poll_idle_max,
+    })
+
+    # Everything that we send to Stream Deck goes through here. It's
+    # connected to the WebSocket while we have one.
+    outbox = Outbox(None, images)
+
+    # Nothing needs the settings from Stream Deck to start polling the
+    # browser and loading images, so do it right away rather than after
+    # connecting. That way keys can show the real state as soon as they
+    # appear.
+    async def listen_browser():
+        await browser_started
+        await browser.listen(
+            outbox, analytics_collect, action_metadata, backend,
+            push_listener, scheduler, recorder=recorder,
+            tick_budget=args.profile_tick_budget if args.profile else None)
+
+    preload = asyncio.ensure_future(images.preload(ACTIONS))
+
+    # Analytics are sent once we know our client ID, from the global settings.
+    # Whether to send them at all is up to the policy, which follows the
+    # analytics_enabled setting.
+    settings_received = asyncio.get_running_loop().create_future()
+
+    async def listen_analytics():
+        settings = await settings_received
+        await analytics.listen(
+            analytics_queue, True, 'UA-18586119-5', settings['client_id'],
+            user_agent=f'StreamDeckWorkroomsBot/{plugin_version}',
+            endpoint=args.analytics_endpoint, spool=analytics_spool)
+
+    # A connection to Stream Deck
     #
-    # Establish the WebSocket connection, do some setup, start up some
-    # coroutines, and then wait for them to exist.
-    async with websockets.connect('ws://127.0.0.1:{}'.format(args.port)) as ws:
-        async_tasks = []
-
-        # Send the handshaking message back
-        await ws.send(
-            json.dumps({'event': args.registerEvent, 'uuid': args.pluginUUID}))
-
-        # Get global plugin settings
-        #
-        # This requires a round-trip to Stream Deck -- we send a
-        # getGlobalSettings message and then get back didReceiveGlobalSettings.
-        # Doing this during startup is a bit tricky since Stream Deck is going
-        # to send us some other messages as part of the process of bringing
-        # things up, e.g. deviceDidConnect and willAppear, etc. Process those
-        # messages inline and then handle didReceiveGlobalSettings directly.
-        await ws.send(
-            json.dumps({'event': 'getGlobalSettings', 'context': args.pluginUUID}))
-
-        settings = {}
-        while not settings:
+    # This is started again each time that we reconnect. Everything else,
+    # including what we know about the browser and keys, carries on in the
+    # meantime.
+    async def session(ws):
+        metrics.STARTUP.phase('connected')
+        outbox.ws = ws
+
+        try:
+            # Send the handshaking message back
+            outbox.send({'event': args.registerEvent, 'uuid': args.pluginUUID})
+
+            # Bring keys up to date with anything that we couldn't send
+            # while we were disconnected
+            outbox.resend()
+
+            if not settings_received.done():
+                await get_settings(ws)
+
+            await outbox.flush()
+            await streamdeck.listen(
+                ws, outbox, analytics_collect, action_metadata, toggle_queues,
+                backend, scheduler, optimistic=args.optimistic,
+                recorder=recorder, settings=runtime_settings)
+        finally:
+            outbox.ws = None
+
+    # Get global plugin settings
+    #
+    # This requires a round-trip to Stream Deck -- we send a
+    # getGlobalSettings message and then get back didReceiveGlobalSettings.
+    # Doing this during startup is a bit tricky since Stream Deck is going
+    # to send us some other messages as part of the process of bringing
+    # things up, e.g. deviceDidConnect and willAppear, etc. Process those
+    # messages inline, along with didReceiveGlobalSettings itself, which
+    # applies the runtime settings.
+    async def get_settings(ws):
+        outbox.send({'event': 'getGlobalSettings', 'context': args.pluginUUID})
+        await outbox.flush()
+
+        settings = None
+        while settings is None:
             msg = json.loads(await ws.recv())
-            now = time.time()
-
-            if msg['event'] != 'didReceiveGlobalSettings':
-                await streamdeck.process_message(msg, now, ws, None, action_metadata)
-                continue
-
-            settings = msg['payload']['settings']
-
-            # We didn't have any settings, create and store them
-            if not settings:
-                settings = {'client_id': str(uuid4())}
-                await ws.send(
-                    json.dumps({
-                        'event': 'setGlobalSettings',
-                        'context': args.pluginUUID,
-                        'payload': settings}))
-
-        # Set up analytics
-        #
-        # Tasks interact with the analytics system by getting a callback that
-        # they can use to publich metrics. Set up this callback and associated
-        # infrastructure.
-        analytics_queue = asyncio.Queue()
-        analytics_collect = partial(
-            analytics.collect, analytics_queue,
-            an='StreamDeckWorkrooms', av=plugin_version, aip=1, npa=1)
-
-        # Start up coroutines
-        async_tasks += [streamdeck.listen(ws, analytics_collect, action_metadata)]
-        async_tasks += [
-            browser.listen(
-                ws, analytics_collect, action_metadata,
-                images['ON'], images['OFF'], images['UNKNOWN'], images['NONE'])]
-        async_tasks += [
-            analytics.listen(
-                analytics_queue, True, 'UA-18586119-5', settings['client_id'],
-                user_agent=f'StreamDeckWorkroomsBot/{plugin_version}')]
-
-        # Wait for tasks to complete
-        done_tasks, pending_tasks = await asyncio.wait(
-            async_tasks,
-            return_when=asyncio.FIRST_EXCEPTION)
-
-        # If one of the tasks exited due to an exception, just re-raise it to
-        # terminate everything and get the stack trace written to stderr
-        for dt in done_tasks:
-            if dt.exception() is not None:
-                raise dt.exception()
+            now = clock.time()
+
+            if recorder is not None:
+                recorder.record('streamdeck', msg=msg)
+
+            await streamdeck.process_message(
+                msg, now, outbox, None, action_metadata, toggle_queues,
+                backend, scheduler, optimistic=args.optimistic,
+                recorder=recorder, settings=runtime_settings)
+            await outbox.flush()
+
+            if msg['event'] == 'didReceiveGlobalSettings':
+                settings = msg['payload']['settings']
+
+        # We didn't have a client ID, create and store it along with any
+        # other settings
+        if 'client_id' not in settings:
+            settings = dict(settings, client_id=str(uuid4()))
+            outbox.send({
+                'event': 'setGlobalSettings',
+                'context': args.pluginUUID,
+                'payload': settings})
+            await outbox.flush()
+
+        metrics.STARTUP.phase('settings')
+        settings_received.set_result(settings)
+
+    # Daemon main loop
+    #
+    # Start up some coroutines and then wait for them to exit. The
+    # connection to Stream Deck is re-established if it drops, and only
+    # gives up if Stream Deck is gone for good.
+    async_tasks = [
+        listen_browser(),
+        listen_analytics(),
+        metrics.monitor_loop_lag(),
+        streamdeck.supervise(
+            'ws://127.0.0.1:{}'.format(args.port), session,
+            analytics_collect=analytics_collect),
+    ] + profiler_tasks
+
+    # Wait for tasks to complete
+    #
+    # Newer versions of Python don't accept bare coroutines here
+    done_tasks, pending_tasks = await asyncio.wait(
+        [asyncio.ensure_future(t) for t in async_tasks],
+        return_when=asyncio.FIRST_EXCEPTION)
+
+    # If one of the tasks exited due to an exception, just re-raise it to
+    # terminate everything and get the stack trace written to stderr
+    for dt in done_tasks:
+        if dt.exception() is not None:
+            raise dt.exception()
 
 
 def main():
@@ -5,16 +5,202 @@ This is implemented using the Google Analytics Measuremnt Protocol (Universal
 Analytics). 
 '''
 
-from aiohttp import ClientSession
-from logging import debug, error, info
-import traceback
+from .ratelimit import TokenBucket
+
+import asyncio
+from collections import Counter
+from logging import debug, error, exception, info
+import random
+import time
 from urllib.parse import urlencode
 
-# TODO: Maybe use the 'qt' paramter to track queue time.
-async def listen(queue, enabled, tid, cid, user_agent=None):
+# Where hits are sent
+ENDPOINT = 'https://www.google-analytics.com'
+
+# Limits imposed by the /batch endpoint on the number of hits per request and
+# the size of the request body
+BATCH_MAX_HITS = 20
+BATCH_MAX_BYTES = 16 * 1024
+
+# Room to leave in each hit for the parameters added when it's sent
+HIT_OVERHEAD_BYTES = 100
+
+# How long to wait for more hits to fill a batch before sending it
+BATCH_SECONDS = 1
+
+# Maximum number of batches being sent at once
+MAX_CONCURRENT_BATCHES = 4
+
+# How long to wait for the collector to answer
+REQUEST_TIMEOUT_SECONDS = 10
+
+# Bounds on the interval between attempts to re-send spooled hits
+RETRY_MIN_SECONDS = 1
+RETRY_MAX_SECONDS = 300
+
+# Maximum number of hits waiting to be batched; beyond this the oldest are
+# dropped
+QUEUE_MAX_HITS = 500
+
+# How long after starting to wait before re-sending spooled hits, so that we
+# don't slow down startup
+REPLAY_DELAY_SECONDS = 30
+
+
+class Session:
+    '''
+    HTTP client session which is only created when first used.
+
+    Importing aiohttp takes longer than the rest of the daemon put together,
+    so we put this off until there's something to send, rather than making
+    every start of the plugin wait for it.
+    '''
+
+    def __init__(self, headers=None, timeout=REQUEST_TIMEOUT_SECONDS):
+        self.headers = headers
+        self.timeout = timeout
+        self.session = None
+
+    def post(self, *args, **kwargs):
+        if self.session is None:
+            from aiohttp import ClientSession, ClientTimeout
+
+            self.session = ClientSession(
+                headers=self.headers,
+                timeout=ClientTimeout(total=self.timeout))
+
+        return self.session.post(*args, **kwargs)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+async def next_batch(queue, carry, max_hits=BATCH_MAX_HITS, max_bytes=BATCH_MAX_BYTES, timeout=BATCH_SECONDS):
+    '''
+    Wait for hits on `queue` and return a batch of them as a list of
+    (enqueue time, params) tuples.
+
+    The batch is returned once it's full or `timeout` seconds after its first
+    hit arrived. A hit that won't fit in `max_bytes` is left in the `carry`
+    list to start the next batch; the size of each hit is estimated from its
+    parameters.
+    '''
+
+    batch = [carry.pop() if carry else await queue.get()]
+    size = len(urlencode(batch[0][1])) + HIT_OVERHEAD_BYTES
+    deadline = time.time() + timeout
+
+    while len(batch) < max_hits:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+
+        try:
+            item = await asyncio.wait_for(queue.get(), remaining)
+        except asyncio.TimeoutError:
+            break
+
+        item_size = len(urlencode(item[1])) + HIT_OVERHEAD_BYTES + 1
+        if size + item_size > max_bytes:
+            carry.append(item)
+            break
+
+        batch.append(item)
+        size += item_size
+
+    return batch
+
+
+async def post_batch(cs, endpoint, batch, common):
+    '''
+    Post `batch` to the /batch endpoint, with `common` added to each hit.
+
+    Returns False if this failed in a way that's worth retrying later, e.g.
+    because we're offline.
+    '''
+
+    try:
+        now = time.time()
+        lines = []
+        for enqueue_time, params in batch:
+            hit = dict(params)
+            hit.update(common)
+            hit['qt'] = int((now - enqueue_time) * 1000)
+            lines.append(urlencode(hit))
+
+        data = '\n'.join(lines).encode('utf-8')
+        async with cs.post(f'{endpoint}/batch', data=data) as resp:
+            if resp.status == 200:
+                return True
+
+            error(f'sending {len(batch)} analytics hits failed with status {resp.status}')
+
+            # The collector didn't like what we sent; trying again won't help
+            return resp.status < 500
+    except Exception:
+        exception('sending analytics hits failed')
+        return False
+
+
+async def send_batch(cs, endpoint, batch, common, semaphore, spool, spooled):
+    '''
+    Post `batch`, adding it to `spool` and setting the `spooled` event if it
+    needs to be retried, and release `semaphore` when done.
+    '''
+
+    try:
+        if not await post_batch(cs, endpoint, batch, common) and spool is not None:
+            info(f'spooling {len(batch)} analytics hits')
+            await spool.append(batch)
+            spooled.set()
+    except Exception:
+        exception('sending analytics hits failed')
+    finally:
+        semaphore.release()
+
+
+async def replay(cs, endpoint, common, spool, spooled):
+    '''
+    Re-send hits from `spool` until it's empty, backing off exponentially
+    with jitter while the collector is unreachable, and then wait for the
+    `spooled` event to say there's more. Nothing is sent for the first
+    `REPLAY_DELAY_SECONDS`.
     '''
-    Listen for analytics events by polling `queue` and using `client_session` to
-    send them to the Google Analytics backend.
+
+    delay = RETRY_MIN_SECONDS
+    await asyncio.sleep(REPLAY_DELAY_SECONDS)
+
+    while True:
+        records = spool.peek(BATCH_MAX_HITS)
+        if not records:
+            spooled.clear()
+            await spooled.wait()
+
+            # These have only just failed; give the network a moment
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+            continue
+
+        batch = [(r.time, r.value) for r in records]
+        if await post_batch(cs, endpoint, batch, common):
+            await spool.consume(records)
+            delay = RETRY_MIN_SECONDS
+            continue
+
+        delay = min(delay * 2, RETRY_MAX_SECONDS)
+        info(f'retrying {len(spool)} spooled analytics hits in about {delay}s')
+        await asyncio.sleep(random.uniform(delay / 2, delay))
+
+
+async def listen(queue, enabled, tid, cid, user_agent=None, endpoint=ENDPOINT, spool=None):
+    '''
+    Listen for analytics events by polling `queue` and sending them to the
+    Google Analytics backend at `endpoint`.
+
+    Hits are sent in batches using the /batch endpoint, with up to
+    `MAX_CONCURRENT_BATCHES` requests in flight at once. The queue time (`qt`)
+    of each hit is filled in when it's sent. If `spool` is not None, it is a
+    `spool.Spool` where batches that couldn't be sent are kept to be retried.
 
     See
     https://developers.google.com/analytics/devguides/collection/protocol/v1/parameters
@@ -25,34 +211,182 @@ async def listen(queue, enabled, tid, cid, user_agent=None):
     if user_agent:
         headers['User-Agent'] = user_agent
 
-    async with ClientSession(headers=headers if headers else None) as cs:
+    common = {
+        'v': 1,
+        'tid': tid,
+        'cid': cid,
+    }
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+    spooled = asyncio.Event()
+    carry = []
+    tasks = set()
+
+    cs = Session(headers=headers if headers else None)
+    try:
+        if enabled and spool is not None:
+            tasks.add(asyncio.create_task(
+                replay(cs, endpoint, common, spool, spooled)))
+
         while True:
-            params = await queue.get()
+            batch = await next_batch(queue, carry)
 
-            info(f'{"not " if not enabled else ""}sending analytics {params}')
+            for _, params in batch:
+                info(f'{"not " if not enabled else ""}sending analytics {params}')
 
             if not enabled:
                 continue
 
-            # Update parameters with the rest of what is required
-            params.update({
-                'v': 1,
-                'tid': tid,
-                'cid': cid,
-            })
+            # Wait for a slot so that a backlog stays in the queue, where
+            # it can be batched, rather than piling up in requests
+            await semaphore.acquire()
+            task = asyncio.create_task(
+                send_batch(cs, endpoint, batch, common, semaphore, spool, spooled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        await cs.close()
+
+
+# Maximum number of hits that we send per session. GA allows 500; stay well
+# clear of that.
+SESSION_MAX_HITS = 450
+
+# Part of the session budget that only high-value hits may use
+SESSION_RESERVED_HITS = 20
+
+# Categories of hits that may use the reserved budget
+HIGH_VALUE_CATEGORIES = {'event:Call'}
+
+# Fraction of hits sent in each category; those not listed are all sent
+SAMPLE_RATES = {
+    'timing:Query': 0.01,
+}
+
+# Token bucket limits for each category as (hits per second, burst size);
+# those not listed use DEFAULT_RATE_LIMIT
+RATE_LIMITS = {
+    'event:Call': (1, 10),
+    'event:Actions': (1, 20),
+    'exception': (1 / 30, 10),
+    'timing:Query': (1 / 10, 5),
+}
+DEFAULT_RATE_LIMIT = (1 / 5, 20)
+
+
+def category(params):
+    '''
+    Return the category of the hit described by `params`, e.g. "event:Call"
+    or "timing:Toggle".
+    '''
+
+    t = params.get('t')
+    if t == 'event':
+        return f'event:{params.get("ec")}'
+    if t == 'timing':
+        return f'timing:{params.get("utc")}'
 
-            data = urlencode(params).encode('utf-8')
-            url = 'https://www.google-analytics.com/collect'
+    return t
 
-            try:
-                await cs.post(url, data=data)
-            except Exception:
-                error(traceback.format_exc())
 
+class Policy:
+    '''
+    Decide which hits to send.
+
+    GA has a limit of 500 hits per session. If you go beyond that, your
+    session (and seemingly client_id) is blackholed. To address this, we
+    define our session as when we're in a call, started and ended by hits
+    with the `sc` parameter set, and only send hits during a session. See #40.
+
+    Within a session, each category of hits is sampled at its rate in
+    `sample_rates` and limited by a token bucket from `rate_limits`, and at
+    most `session_max_hits` are sent in total. The last `reserved_hits` of
+    these are kept for categories in `high_value`. Nothing is sent while
+    `enabled` is False, though sessions are still tracked so that we pick up
+    in the right place if it's turned back on.
 
-async def collect(queue, t, **kwargs):
+    The `enabled` and `sample_rates` attributes may be changed at any time,
+    e.g. by `settings.Settings`.
+
+    The `counts` attribute counts hits by outcome: "sent", "disabled",
+    "no_session", "sampled_out", "rate_limited" and "over_budget".
     '''
-    Collect analytics and enqueue them for sending.
+
+    def __init__(
+            self, session_max_hits=SESSION_MAX_HITS,
+            reserved_hits=SESSION_RESERVED_HITS,
+            high_value=HIGH_VALUE_CATEGORIES, sample_rates=SAMPLE_RATES,
+            rate_limits=RATE_LIMITS, default_rate_limit=DEFAULT_RATE_LIMIT,
+            enabled=True):
+        self.enabled = enabled
+        self.session_max_hits = session_max_hits
+        self.reserved_hits = reserved_hits
+        self.high_value = high_value
+        self.sample_rates = sample_rates
+        self.rate_limits = rate_limits
+        self.default_rate_limit = default_rate_limit
+
+        self.in_session = False
+        self.session_hits = 0
+        self.buckets = {}
+        self.counts = Counter()
+
+    def _decide(self, params, now):
+        cat = category(params)
+
+        # Session boundaries are always sent, and reset the budget
+        if params.get('sc') == 'start':
+            self.in_session = True
+            self.session_hits = 0
+        elif not self.in_session:
+            return 'no_session'
+
+        if not self.enabled:
+            return 'disabled'
+
+        if params.get('sc') is None:
+            if random.random() >= self.sample_rates.get(cat, 1):
+                return 'sampled_out'
+
+            bucket = self.buckets.get(cat)
+            if bucket is None:
+                bucket = self.buckets[cat] = TokenBucket(
+                    *self.rate_limits.get(cat, self.default_rate_limit))
+            if not bucket.take(now):
+                return 'rate_limited'
+
+        budget = self.session_max_hits
+        if cat not in self.high_value:
+            budget -= self.reserved_hits
+        if self.session_hits >= budget:
+            return 'over_budget'
+
+        return 'sent'
+
+    def admit(self, params, now):
+        '''
+        Should the hit described by `params` be sent?
+        '''
+
+        outcome = self._decide(params, now)
+        self.counts[outcome] += 1
+
+        if outcome == 'sent':
+            self.session_hits += 1
+        else:
+            info(f'not sending analytics ({outcome}): {params}')
+
+        if params.get('sc') == 'end':
+            info(f'analytics session ended after {self.session_hits} hits; {dict(self.counts)}')
+            self.in_session = False
+
+        return outcome == 'sent'
+
+
+async def collect(queue, t, policy=None, **kwargs):
+    '''
+    Collect analytics and enqueue them for sending, if the `Policy` in
+    `policy` allows it.
 
     See
     https://developers.google.com/analytics/devguides/collection/protocol/v1/parameters
@@ -63,4 +397,12 @@ async def collect(queue, t, **kwargs):
     params = { 't': t }
     params.update(kwargs)
 
-    await queue.put(params)
\ No newline at end of file
+    if policy is not None and not policy.admit(params, time.time()):
+        return
+
+    # Don't let hits pile up without bound if we can't keep up
+    if queue.full():
+        info(f'dropping analytics {queue.get_nowait()[1]}')
+
+    # Remember when this was enqueued so that we can report its queue time
+    queue.put_nowait((time.time(), params))
\ No newline at end of file
@@ -3,19 +3,34 @@ Communicate with the browser.
 '''
 
 
-from .types import ActionState
+from . import clock
+from . import engine
+from . import metrics
+from . import profiling
+from .push import HEARTBEAT_SECONDS, SILENCE_SECONDS
+from .types import ACTIONS, ActionState
 
 import asyncio
+from collections import deque, namedtuple
 import json
-from logging import error, info
-import os.path
-from random import randint
-import time
-import traceback
+from logging import error, exception, info
 
 
-# Grace period before we show the user an error
-ERROR_GRACE_PERIOD_SECONDS = 5
+# Minimum interval between attempts to install the observer
+OBSERVE_RETRY_SECONDS = 10
+
+# How long we trust a list of call tabs before looking for new ones. While
+# several call tabs are open we also poll at this interval, even if the
+# observer is pushing state, so that we notice a different one becoming active.
+DISCOVERY_SECONDS = 10
+
+# How long to wait for the browser to answer a request before giving up on it,
+# e.g. because Chrome is showing a modal dialog
+REQUEST_TIMEOUT_SECONDS = 5
+
+# Maximum number of polls running at once. A new poll can start while a slow
+# one is still running, but beyond this we wait for one to finish.
+MAX_POLLS_IN_FLIGHT = 2
 
 
 # User-facing error codes
@@ -23,223 +38,745 @@ EC_QUERY_SUBPROCESS_FAILED_STATUS = 'E1'
 EC_QUERY_DOM_FAILED = 'E2'
 EC_CHROME_APPLESCRIPT_DISABLED = 'E3'
 EC_QUERY_SUBPROCESS_FAILED_EXCEPTION = 'E4'
+EC_QUERY_TIMEOUT = 'E5'
+
 
-def is_call_active(action_metadata):
+class BackendError(Exception):
     '''
-    Is there an active call?
+    A failure communicating with the browser.
+
+    The `ec` attribute is the user-facing error code describing the failure.
     '''
 
-    for av in action_metadata.values():
-        if av['current'].status in ['ON', 'OFF']:
-            return True
+    def __init__(self, ec, msg):
+        super().__init__(msg)
+        self.ec = ec
 
-    return False
 
+def select_result(results, current=None):
+    '''
+    Pick the active call from a list of (tab, query result) pairs, one per
+    call tab, and return the pair.
 
-async def listen(ws, analytics_collect, action_metadata, on_images, off_images, unknown_images, none_images):
+    We prefer a tab that is in the call, then one showing call controls at all
+    (e.g. a pre-join screen), then anything else, breaking ties in favor of
+    the `current` tab so that we don't flap between them. Returns
+    (None, 'NONE') if there are no tabs.
     '''
-    Coroutine to listen to state changes from the browser.
+
+    def rank(tr):
+        tab, result = tr
+
+        try:
+            jo = json.loads(result)
+        except ValueError:
+            jo = {}
+
+        if jo.get('state') == 'CALL':
+            if jo['actions']['call']['state'] == 'ON':
+                r = 0
+            else:
+                r = 1
+        else:
+            r = 2
+
+        return (r, tab != current)
+
+    if not results:
+        return (None, 'NONE')
+
+    return min(results, key=rank)
+
+
+class WorkerBackend:
     '''
+    Browser backend that talks to a long-lived worker process.
+
+    The worker is started by running `argv` and reads newline-delimited JSON
+    requests on stdin, writing one JSON response per line to stdout. See
+    `bin/browser_worker.js` for a description of the protocol. If the worker
+    dies it is re-started on the next request.
+
+    Requests are written as soon as they're made rather than waiting for
+    earlier ones to be answered, and responses are matched up with them by
+    ID. The worker handles them in order. If it takes longer than
+    `timeout_seconds` to answer one, we assume that it's stuck, e.g. in an
+    Apple Event that Chrome isn't answering, and kill it.
+    '''
+
+    def __init__(self, argv, timeout_seconds=REQUEST_TIMEOUT_SECONDS):
+        self.argv = argv
+        self.timeout_seconds = timeout_seconds
+        self.proc = None
+        self.reader_task = None
+
+        # Futures for requests awaiting a response from the current worker,
+        # by ID
+        self.pending = {}
+
+        # The call tabs found by the last query, and the one that we picked
+        self.tabs = []
+        self.tab = None
 
-    MIC_INDEX = action_metadata['mic']['index']
-    CAMERA_INDEX = action_metadata['camera']['index']
-    HAND_INDEX = action_metadata['hand']['index']
-    CALL_INDEX = action_metadata['call']['index']
-
-    while True:
-        await asyncio.sleep(1)
-
-        now = time.time()
-        in_call = is_call_active(action_metadata)
-        status_array = [None] * len(action_metadata)
-        errors_array = [None] * len(action_metadata)
-
-        # Only collect analytics if we're in a call.
-        #
-        # GA has a limit of 500 events per session. If you go beyond that, your
-        # session (and seemingly client_id) is blackholed. To address this,
-        # define our session as when we're in a call and only report analytics
-        # when this is true.
-        #
-        # See #40.
-        async def analytics_collect_session(*args, **kwargs):
-            if not in_call:
-                info(f'swallowing analytics for inactive session: {args}, {kwargs}')
+        self.next_id = 0
+        self.starts = 0
+
+        # Requests may be made at the same time; only start one worker
+        self.start_lock = asyncio.Lock()
+
+    async def start(self):
+        '''
+        Start the worker process if it's not already running.
+
+        Raises `BackendError` if it can't be started.
+        '''
+
+        async with self.start_lock:
+            if self.proc is not None and self.proc.returncode is None:
                 return
 
-            await analytics_collect(*args, **kwargs)
+            if self.starts > 0:
+                info(f'restarting browser worker {self.argv}')
+
+            try:
+                self.proc = await asyncio.create_subprocess_exec(
+                    *self.argv,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE)
+            except OSError as e:
+                raise BackendError(
+                    EC_QUERY_SUBPROCESS_FAILED_EXCEPTION,
+                    f'couldn\'t start browser worker: {e}')
+            self.pending = {}
+            self.reader_task = asyncio.create_task(
+                self._read(self.proc, self.pending))
+            self.starts += 1
+
+    async def close(self):
+        '''
+        Shut down the worker process, if any.
+        '''
+
+        proc, self.proc = self.proc, None
+        if proc is None or proc.returncode is not None:
+            return
+
+        proc.stdin.close()
+        try:
+            await asyncio.wait_for(proc.wait(), 1)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+    async def kill(self):
+        '''
+        Kill the worker process, if any, without waiting for it to finish
+        what it's doing.
+        '''
+
+        proc, self.proc = self.proc, None
+        if proc is None or proc.returncode is not None:
+            return
+
+        proc.kill()
+        await proc.wait()
+
+    async def _read(self, proc, pending):
+        '''
+        Dispatch responses from the worker `proc` to the futures in `pending`
+        awaiting them.
+        '''
 
-        # Fill in the *_array values by querying browser
-        #
-        # Error handling here is quite involved, as there are many different
-        # layers in which things could fail. Some of these errors mean that we
-        # can't interpret any results (e.g. failed to execute the query script),
-        # while some are partial (e.g. we can't find the "hand" button).
         try:
-            proc = await asyncio.create_subprocess_exec(
-                os.path.join(os.path.curdir, 'query_browser_state.osa'),
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE)
-
-            out, err = await proc.communicate()
-            out = out.decode('utf-8').strip()
-            err = err.decode('utf-8').strip()
-
-            if proc.returncode == 0:
-                # The 'NONE' sentinel value means no rooms were found. Expand that
-                # to fill each of the actions rather than doing that in query.js
-                if out == 'NONE':
-                    status_array = ['NONE'] * len(action_metadata)
-                else:
-                    status_array = out.split(' ')
-
-                assert len(status_array) == len(action_metadata)
-
-                # Some calls don't have a hand status, which will cause it to
-                # come back from the query as UNKNOWN. In this case, don't show
-                # the user the confusing UNKNOWN icon. Just consider it NONE
-                # since this is expected.
-                if status_array[HAND_INDEX] == 'UNKNOWN' and \
-                        status_array[MIC_INDEX] in ['ON', 'OFF'] and \
-                        status_array[CAMERA_INDEX] in ['ON', 'OFF'] and \
-                        status_array[CALL_INDEX] in ['ON', 'OFF']:
-                    status_array[HAND_INDEX] = 'NONE'
-
-                # Any entries in the status_array that are UNKNOWN mean
-                # that we couldn't find the DOM node. Mark this as an error in
-                # the relevant field.
-                #
-                # XXX: This isn't really true as we could have found the node but
-                #      not been able to interpret its contents. Update query.js to
-                #      differentiate the different failure modes.
-                for index, status in enumerate(status_array):
-                    if status != 'UNKNOWN':
-                        continue
-
-                    errors_array[index] = EC_QUERY_DOM_FAILED
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+
+                try:
+                    resp = json.loads(line)
+                except ValueError:
+                    error(f'bad response from browser worker: {line!r}')
+                    continue
+
+                # Responses to requests that we gave up on have no future
+                fut = pending.pop(resp.get('id'), None)
+                if fut is not None and not fut.done():
+                    fut.set_result(resp)
+        finally:
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(EOFError('browser worker exited'))
+            pending.clear()
+
+    async def _request_once(self, req):
+        await self.start()
+
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[req['id']] = fut
+
+        self.proc.stdin.write(json.dumps(req).encode('utf-8') + b'\n')
+        await self.proc.stdin.drain()
+
+        return await fut
+
+    async def request(self, op, **kwargs):
+        '''
+        Send a request to the worker and return its result.
+
+        A dead worker is restarted and the request retried once. Raises
+        `BackendError` if the request cannot be completed, with
+        `EC_QUERY_TIMEOUT` if the worker didn't answer in time.
+        '''
+
+        for attempt in range(2):
+            self.next_id += 1
+            req = dict(kwargs, id=self.next_id, op=op)
+
+            try:
+                resp = await asyncio.wait_for(
+                    self._request_once(req), self.timeout_seconds)
+                break
+            except asyncio.TimeoutError:
+                error(
+                    f'browser worker didn\'t answer {op} within '
+                    f'{self.timeout_seconds}s; killing it')
+                await self.kill()
+                raise BackendError(
+                    EC_QUERY_TIMEOUT, f'browser worker timed out handling {op}')
+            except (EOFError, ConnectionError):
+                exception('browser worker connection failed')
+                await self.close()
+        else:
+            raise BackendError(
+                EC_QUERY_SUBPROCESS_FAILED_EXCEPTION,
+                f'browser worker failed handling {op}')
+
+        if not resp['ok']:
+            # Compute the error code, defaulting to something generic
+            ec = EC_QUERY_SUBPROCESS_FAILED_STATUS
+            if 'Executing JavaScript through AppleScript is turned off' in resp['error']:
+                ec = EC_CHROME_APPLESCRIPT_DISABLED
+
+            raise BackendError(ec, resp['error'])
+
+        return resp['result']
+
+    async def query(self):
+        '''
+        Query all call tabs, pick the active one and return the raw result of
+        running query.js in it.
+        '''
+
+        results = [(r['tab'], r['result']) for r in await self.request('query')]
+
+        self.tabs = [t for t, _ in results]
+        self.tab, result = select_result(results, self.tab)
+        return result
+
+    async def toggle(self, target):
+        '''
+        Toggle the state of the `target` action in the call tab.
+
+        Returns False if there is no call tab.
+        '''
+
+        return await self.request('toggle', target=target, tab=self.tab) is True
+
+    async def ensure(self, targets):
+        '''
+        Bring each action in `targets`, a list of (action, status) pairs, to
+        its status in the call tab with one request, clicking only the
+        buttons that need it.
+
+        Returns what ensure.js did to each action, by action, or None if
+        there is no call tab.
+        '''
+
+        result = await self.request(
+            'ensure', targets=[{'action': a, 'state': s} for a, s in targets],
+            tab=self.tab)
+        return None if result is None else json.loads(result)
+
+    async def observe(self, port, token, heartbeat_seconds):
+        '''
+        Install observe.js in the call tab, pushing state to the given port.
+
+        Returns None if there is no call tab.
+        '''
+
+        return await self.request(
+            'observe', port=port, token=token,
+            heartbeatMs=int(heartbeat_seconds * 1000), tab=self.tab)
+
+
+# ActionStates that we've seen, so that we don't make new ones on every query
+_states = {}
+
+
+def _state(status, ec=None):
+    state = _states.get((status, ec))
+    if state is None:
+        state = _states[(status, ec)] = ActionState(status, ec)
+
+    return state
+
+
+def parse_result(out):
+    '''
+    Interpret the raw result of query.js, returning an (ActionState, reason)
+    tuple for each action, keyed by action name.
+
+    Actions that we couldn't find or understand on the page are UNKNOWN, with
+    error EC_QUERY_DOM_FAILED. Raises ValueError or KeyError if the result is
+    malformed.
+    '''
+
+    # The 'NONE' sentinel value means no rooms were found. Expand that to fill
+    # each of the actions rather than doing that in query.js
+    if out == 'NONE':
+        return {name: (_state('NONE'), None) for name in ACTIONS}
+
+    result = json.loads(out)
+
+    # A post-call screen; treat this the same as no rooms
+    if result['state'] == 'NONE':
+        return {name: (_state('NONE'), None) for name in ACTIONS}
+
+    statuses = {}
+    reasons = {}
+    for name in ACTIONS:
+        ar = result['actions'][name]
+        statuses[name] = ar['state']
+        reasons[name] = ar['reason']
+
+    # Some calls don't have a hand button, which will cause it to come back
+    # from the query as UNKNOWN. In this case, don't show the user the
+    # confusing UNKNOWN icon. Just consider it NONE since this is expected.
+    if reasons['hand'] == 'NOT_FOUND' and \
+            statuses['mic'] in ['ON', 'OFF'] and \
+            statuses['camera'] in ['ON', 'OFF'] and \
+            statuses['call'] in ['ON', 'OFF']:
+        statuses['hand'] = 'NONE'
+
+    # Any UNKNOWN statuses mean that we couldn't find or understand the DOM
+    # node. Mark this as an error; the reason says which it was.
+    return {
+        name: (
+            _state(status, EC_QUERY_DOM_FAILED if status == 'UNKNOWN' else None),
+            reasons[name])
+        for name, status in statuses.items()}
+
+
+def failed(ec):
+    '''
+    Return what we make of a failure to query the browser with error code
+    `ec`, in the same form as `parse_result()`.
+    '''
+
+    return {name: (_state('UNKNOWN', ec), None) for name in ACTIONS}
+
+
+def is_transition_pending(action_metadata):
+    '''
+    Is there a state change waiting out its grace period?
+    '''
+
+    for a in action_metadata.values():
+        if a.next != a.current:
+            return True
+
+    return False
+
+
+def is_toggle_pending(action_metadata, now, timeout):
+    '''
+    Has the user toggled an action in the last `timeout` seconds without us
+    seeing the state change yet?
+    '''
+
+    for a in action_metadata.values():
+        if a.action_time is not None and now - a.action_time < timeout:
+            return True
+
+    return False
+
+
+# The outcome of polling the browser: the raw result of the query, or the
+# exception raised trying to get it. Polls and pushed states are numbered by
+# `seq` in the order that they started, so that we can tell if a poll has been
+# overtaken by something newer.
+Poll = namedtuple('Poll', ['seq', 'start', 'out', 'error'])
+
+
+class PollScheduler:
+    '''
+    Decide how long to wait before polling the browser again.
+
+    We poll every `fast_seconds` while a toggle is waiting to be confirmed
+    (for up to `confirm_seconds`), every `normal_seconds` while in a call or
+    while a change is waiting out its `grace_seconds`, and back off
+    exponentially from `normal_seconds` to `idle_max_seconds` while there's
+    no call or no browser. While the observer is pushing state to us, we
+    don't poll at all unless a toggle or error is pending.
+
+    The intervals may be changed at any time, e.g. by `settings.Settings`.
+
+    Polls run in the background and hand their results back with
+    `finished()`, to be returned by `wait()`.
+    '''
+
+    def __init__(self, fast_seconds=0.1, normal_seconds=1, idle_max_seconds=8, confirm_seconds=3, grace_seconds=engine.ERROR_GRACE_PERIOD_SECONDS):
+        self.fast_seconds = fast_seconds
+        self.normal_seconds = normal_seconds
+        self.idle_max_seconds = idle_max_seconds
+        self.confirm_seconds = confirm_seconds
+        self.grace_seconds = grace_seconds
+
+        # Current backoff interval while idle, or None if not idle
+        self.idle_seconds = None
+
+        self.woken = asyncio.Event()
+
+        # Set, and replaced, each time that a state has been processed
+        self.done = asyncio.Event()
+
+        # Polls that have finished but haven't been returned by `wait()`
+        self.polls = deque()
+        self.polled = asyncio.Event()
+
+    def interval(self, action_metadata, push, now):
+        '''
+        Return the number of seconds to wait before the next poll.
+        '''
+
+        if is_toggle_pending(action_metadata, now, self.confirm_seconds):
+            self.idle_seconds = None
+            return self.fast_seconds
+
+        # Keep polling while a change is waiting out its grace period so that
+        # it gets flushed on time
+        if is_transition_pending(action_metadata):
+            self.idle_seconds = None
+            return self.normal_seconds
+
+        # Wait on the observer, but not past the point that we'd consider it
+        # silent
+        if push is not None and push.is_alive(now):
+            self.idle_seconds = None
+            return SILENCE_SECONDS
+
+        if all(a.current.status == 'NONE' for a in action_metadata.values()):
+            if self.idle_seconds is None:
+                self.idle_seconds = self.normal_seconds
             else:
-                error('query failed with status {}\nstdout={}\nstderr={}'.format(proc.returncode, out, err))
-
-                # Compute the error code, defaulting to something generic
-                ec = EC_QUERY_SUBPROCESS_FAILED_STATUS
-                if 'Executing JavaScript through AppleScript is turned off' in err:
-                    ec = EC_CHROME_APPLESCRIPT_DISABLED
-
-                status_array = ['UNKNOWN'] * len(action_metadata)
-                errors_array = [ec] * len(action_metadata)
-
-        except Exception:
-            error(traceback.format_exc())
-            status_array = ['UNKNOWN'] * len(action_metadata)
-            errors_array = [EC_QUERY_SUBPROCESS_FAILED_EXCEPTION] * len(action_metadata)
-
-        if randint(0, 100) == 0:
-            await analytics_collect_session(
-                t='timing',
-                utc='Query',
-                utv='Subprocess',
-                utt=int((time.time() - now) * 1000))
-
-        assert len(status_array) == len(action_metadata)
-        assert len(errors_array) == len(action_metadata)
-
-        # Loop over all actions and update the Stream Deck accordingly
-        for name, data in action_metadata.items():
-            index = data['index']
-            context = data['context']
-            prev_state = data['current']
-            current_state = data['current']
-            next_state = data['next']
-            next_time = data['next_time']
-
-            new_state = ActionState(status_array[index], errors_array[index])
-
-            # We have no context; don't update
-            if context is None:
-                continue
+                self.idle_seconds = min(self.idle_seconds * 2, self.idle_max_seconds)
+
+            return self.idle_seconds
+
+        self.idle_seconds = None
+        return self.normal_seconds
+
+    def wake(self):
+        '''
+        Cut short the current (or next) wait, e.g. because the user just
+        toggled something.
+        '''
+
+        self.woken.set()
+
+    def finished(self, poll):
+        '''
+        Hand back a finished `Poll`.
+        '''
+
+        self.polls.append(poll)
+        self.polled.set()
+
+    def processed(self):
+        '''
+        Note that a state from the browser has been processed.
+        '''
+
+        done, self.done = self.done, asyncio.Event()
+        done.set()
+
+    async def wait_processed(self, timeout):
+        '''
+        Wait up to `timeout` seconds for the next state from the browser to be
+        processed. Returns whether it was.
+        '''
+
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        return True
+
+    def _next_poll(self):
+        poll = self.polls.popleft()
+        if not self.polls:
+            self.polled.clear()
+
+        return poll
+
+    async def wait(self, push, timeout):
+        '''
+        Wait up to `timeout` seconds for state to be pushed, for a poll to
+        finish or for `wake()`.
+
+        Returns the pushed state, the `Poll`, or None if it's time to poll.
+        '''
 
-            # Update the next state if it's changed
-            if new_state != next_state:
-                data['next'] = next_state = new_state
-                data['next_time'] = next_time = now
+        if self.polls:
+            return self._next_poll()
 
-            # Nothing has changed, no more work to do
-            if next_state == current_state:
+        waiters = [
+            asyncio.ensure_future(self.woken.wait()),
+            asyncio.ensure_future(self.polled.wait()),
+        ]
+        if push is not None:
+            waiters += [asyncio.ensure_future(push.get(timeout))]
+
+        try:
+            done, pending = await asyncio.wait(
+                waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Clean up even if we're cancelled ourselves
+            for w in waiters:
+                w.cancel()
+
+        # A poll that finished at the same time is returned next time
+        if push is not None and waiters[2] in done:
+            self.woken.clear()
+            return waiters[2].result()
+
+        if self.polls:
+            return self._next_poll()
+
+        self.woken.clear()
+        return None
+
+
+async def _poll(backend, scheduler, seq, start):
+    '''
+    Query the browser, handing the result to `scheduler`.
+    '''
+
+    try:
+        scheduler.finished(Poll(seq, start, await backend.query(), None))
+    except Exception as e:
+        scheduler.finished(Poll(seq, start, None, e))
+
+
+async def listen(outbox, analytics_collect, action_metadata, backend, push, scheduler, recorder=None, tick_budget=None):
+    '''
+    Coroutine to listen to state changes from the browser.
+
+    If `push` is not None, it is a `PushListener` receiving state from an
+    observer installed in the call tab. We only poll `backend` when we aren't
+    hearing from the observer. The `scheduler` is a `PollScheduler` deciding
+    how often to poll. Updates to the keys are sent through `outbox`, an
+    `outbox.Outbox`.
+
+    Polls run in the background so that a slow browser doesn't hold up
+    anything else, e.g. pushed state. Up to `MAX_POLLS_IN_FLIGHT` may run at
+    once, and a poll that finishes after a newer poll or push has been
+    processed is discarded.
+
+    If `recorder` is not None, it is a `replay.Recorder` to which every state
+    that we get from the browser, or failure to get one, is written.
+
+    If `tick_budget` is not None, each state that takes longer than this many
+    seconds to get and process is logged, with a breakdown of where the time
+    went.
+    '''
+
+    observe_time = 0
+    poll_time = 0
+
+    # Sequence number of the last poll or push, and of the last one processed
+    seq = 0
+    processed = 0
+
+    polls = set()
+
+    # Look at the browser right away rather than waiting out an interval
+    scheduler.wake()
+
+    try:
+        while True:
+            # Wait for the next state to process, either pushed to us by the
+            # observer or from a poll, or for it to be time to start a poll
+            got = await scheduler.wait(
+                push, scheduler.interval(action_metadata, push, clock.time()))
+
+            now = clock.time()
+
+            # The observer only tells us about its own tab. If there are
+            # others, check every so often whether one of them has become the
+            # active call.
+            if isinstance(got, str) and len(backend.tabs) > 1 and \
+                    now > poll_time + DISCOVERY_SECONDS:
+                got = None
+
+            if got is None:
+                if len(polls) >= MAX_POLLS_IN_FLIGHT:
+                    info(f'not polling the browser; {len(polls)} polls still running')
+                    continue
+
+                seq += 1
+                poll_time = now
+                task = asyncio.ensure_future(_poll(backend, scheduler, seq, now))
+                polls.add(task)
+                task.add_done_callback(polls.discard)
                 continue
 
-            # All changes are flushed after ERROR_GRACE_PERIOD_SECONDS
-            if now > (next_time + ERROR_GRACE_PERIOD_SECONDS):
-                data['current'] = current_state = next_state
-
-            # Changes to a "good" status cause the entire next state to be
-            # propagated immediately since we want to be in an error state for
-            # as short a time as possible.
-            if next_state.status != current_state.status and next_state.status != 'UNKNOWN':
-                data['current'] = current_state = next_state
-
-            # Update the status if necessary
-            if prev_state.status != current_state.status:
-                info('{} status changed from {} to {}'.format(name, prev_state.status, current_state.status))
-
-                # If we've transitioned to a "good" state and the user has
-                # pressed a button to initate this change, track and report the
-                # time from press to state change.
-                if current_state.status in ['ON', 'OFF'] and \
-                        data['action_time'] is not None:
-                    latency = now - data['action_time']
-                    await analytics_collect_session(
-                        t='timing',
-                        utc='Toggle',
-                        utv=name.title(),
-                        utt=int(latency * 1000))
-
-                # No matter what, any attempt by the user to toggle the state is
-                # now stale; reset it
-                data['action_time'] = None
-
-                msg = {'event': 'setImage', 'context': context, 'payload': {}}
-                if current_state.status == 'OFF':
-                    msg['payload']['image'] = off_images[index]
-                elif current_state.status == 'ON':
-                    msg['payload']['image'] = on_images[index]
+            if isinstance(got, Poll):
+                if got.seq < processed:
+                    info(f'discarding browser state from poll {got.seq}; already have {processed}')
+                    metrics.QUERY_STALE.inc()
+                    continue
+
+                processed = got.seq
+                pushed = None
+            else:
+                seq += 1
+                processed = seq
+                pushed = got
+
+            # Only time things if someone's going to look, since this is
+            # run for every state
+            tick = None
+            collect = analytics_collect
+            if tick_budget is not None:
+                tick = profiling.Tick()
+                collect = tick.wrap('analytics', analytics_collect)
+
+            # When the poll that got this state started, so that replay can
+            # take as long over it
+            start = None
+            if pushed is None:
+                start = got.start
+                if tick is not None:
+                    tick.add('query', now - start)
+
+            in_call = engine.is_call_active(action_metadata)
+
+            # Work out what state the browser is in
+            #
+            # Error handling here is quite involved, as there are many
+            # different layers in which things could fail. Some of these
+            # errors mean that we can't interpret any results (e.g. failed to
+            # execute the query script), while some are partial (e.g. we
+            # can't find the "hand" button).
+            out = None
+            try:
+                if pushed is not None:
+                    out = pushed
                 else:
-                    msg['payload']['image'] = none_images[index]
-
-                    if current_state.status not in ['NONE', 'UNKNOWN']:
-                        error(f'Unexpected status {current_state.status}')
-                        await analytics_collect_session(
-                            t='exception',
-                            exd=f'{name.title()}UnexpectedState{current_state.status}',
-                            exf=0)
-
-                await ws.send(json.dumps(msg))
-
-            # Update the error if necessary
-            if prev_state.error != current_state.error:
-                info('{} error changed from {} to {}'.format(name, prev_state.error, current_state.error))
-
-                if current_state.error is not None:
-                    await analytics_collect_session(
-                        t='exception', exd=f'{name.title()}Error{current_state.error}', exf=0)
-
-                await ws.send(
-                    json.dumps({
-                        'event': 'setTitle',
-                        'context': context,
-                        'payload': {'title': current_state.error}}))
-
-        # Our in-call status has changed. Report this.
-        #
-        # Do this outside of the action_metadata loop above because the in-call
-        # status spans all actions.
-        #
-        # NOTE: We use the Session Control (sc) GA parmeter here to try to
-        #       get tighter control over session lifetimes. Hopefully even if
-        #       there is a blackholed client_id active, setting sc=end will
-        #       allow it to begin reporting events to a new session. See #40.
-        if in_call != is_call_active(action_metadata):
-            await analytics_collect(
-                    t='event',
-                    ec='Call',
-                    ea='End' if in_call else 'Begin',
-                    sc='end' if in_call else 'start')
+                    if got.error is not None:
+                        raise got.error
+
+                    out = got.out
+
+                    # Only listen to the observer in the tab that we picked
+                    if push is not None:
+                        push.tab = backend.tab
+
+                if recorder is not None:
+                    recorder.record(
+                        'browser', result=out, pushed=pushed is not None,
+                        start=start)
+
+                out = out.strip()
+                observed = parse_result(out)
+
+                if any(state.error is not None for state, _ in observed.values()):
+                    metrics.QUERY_ERRORS.inc(ec=EC_QUERY_DOM_FAILED)
+
+            except BackendError as e:
+                error(f'query failed with error {e.ec}: {e}')
+                if recorder is not None:
+                    recorder.record('browser', error=e, start=start)
+
+                observed = failed(e.ec)
+                metrics.QUERY_ERRORS.inc(ec=e.ec)
+
+            except Exception as e:
+                exception('query failed')
+
+                # Failures interpreting a result are reproduced from the result
+                if recorder is not None and out is None:
+                    recorder.record('browser', error=e, start=start)
+
+                observed = failed(EC_QUERY_SUBPROCESS_FAILED_EXCEPTION)
+                metrics.QUERY_ERRORS.inc(ec=EC_QUERY_SUBPROCESS_FAILED_EXCEPTION)
+
+            seen = clock.time()
+            metrics.STARTUP.phase('first_query')
+
+            # This is sampled by the analytics policy
+            if pushed is None:
+                metrics.QUERY_SECONDS.observe(seen - got.start)
+                await collect(
+                    t='timing',
+                    utc='Query',
+                    utv='Subprocess',
+                    utt=int((seen - got.start) * 1000))
+
+            # Work out the new state of each action and update the Stream
+            # Deck accordingly. The state of each action is worked out once
+            # and then sent to all of its keys, with all messages for this
+            # round going out together at the end. Keys that already show the
+            # right thing are skipped by the outbox.
+            new_actions, effects = engine.observe(
+                action_metadata, observed, seen, scheduler.confirm_seconds,
+                scheduler.grace_seconds)
+            action_metadata.update(new_actions)
+            if tick is not None:
+                tick.mark('update')
+
+            await engine.perform(effects, outbox, collect)
+            await outbox.flush()
+            if tick is not None:
+                tick.mark('send')
+            scheduler.processed()
+
+            if any(type(e) is engine.SetImage for e in effects):
+                metrics.STARTUP.phase('keys_ready')
+
+            if in_call != engine.is_call_active(action_metadata):
+                info(
+                    f'sent {outbox.messages} messages ({outbox.bytes} bytes) to '
+                    f'Stream Deck so far; suppressed {outbox.suppressed}')
+
+            # We polled and found a call tab, but the observer isn't talking
+            # to us. Try to install it so that we can stop polling.
+            #
+            # This can fail, e.g. if the page's Content-Security-Policy
+            # doesn't allow connections to localhost, in which case we just
+            # keep polling.
+            if push is not None and pushed is None and \
+                    all(state.error is None for state, _ in observed.values()) and \
+                    out != 'NONE' and \
+                    not push.is_alive(now) and \
+                    now > observe_time + OBSERVE_RETRY_SECONDS:
+                observe_time = now
+
+                try:
+                    result = await backend.observe(
+                        push.port, push.token, HEARTBEAT_SECONDS)
+                    info(f'installing browser observer: {result}')
+                except Exception:
+                    exception('installing browser observer failed')
+
+                if tick is not None:
+                    tick.mark('observe')
+
+            if tick is not None:
+                tick.check('browser tick', tick_budget)
+    finally:
+        for task in polls:
+            task.cancel()
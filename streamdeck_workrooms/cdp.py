@@ -0,0 +1,365 @@
+'''
+Communicate with the browser using the Chrome DevTools Protocol.
+
+This requires the browser to have been started with remote debugging enabled,
+e.g. `--remote-debugging-port=9222`. Any Chromium-based browser (Chrome,
+Chromium, Edge, Brave) works, on any platform.
+
+See https://chromedevtools.github.io/devtools-protocol/.
+'''
+
+from . import clock
+from .browser import (
+    BackendError, DISCOVERY_SECONDS, EC_QUERY_SUBPROCESS_FAILED_EXCEPTION,
+    EC_QUERY_SUBPROCESS_FAILED_STATUS, EC_QUERY_TIMEOUT,
+    REQUEST_TIMEOUT_SECONDS, select_result)
+
+import asyncio
+import json
+from logging import exception, info
+import os.path
+import websockets
+from websockets.exceptions import WebSocketException
+
+
+async def http_json(host, port, path, method='GET'):
+    '''
+    Request `path` from the given HTTP server and return the decoded JSON body.
+
+    The DevTools HTTP endpoints are simple enough that we don't need a full
+    HTTP client for this.
+    '''
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(
+            f'{method} {path} HTTP/1.0\r\nHost: {host}:{port}\r\n\r\n'.encode('ascii'))
+        await writer.drain()
+        resp = await reader.read()
+    finally:
+        writer.close()
+
+    head, _, body = resp.partition(b'\r\n\r\n')
+    status = head.split(b'\r\n', 1)[0].split(b' ')
+    if len(status) < 2 or status[1] != b'200':
+        raise ConnectionError(f'{method} {path} failed: {head!r}')
+
+    return json.loads(body)
+
+
+class CDPBackend:
+    '''
+    Browser backend that talks to the call tabs over the DevTools protocol.
+
+    A single WebSocket connection to the browser is kept open between
+    requests, and each call tab is attached to as a session on it so that all
+    of them can be queried at once. The list of call tabs is re-used for
+    `DISCOVERY_SECONDS` unless one of them goes away. If the connection drops,
+    we reconnect on the next request. Commands that aren't answered within
+    `timeout_seconds` fail, e.g. while a tab is showing a modal dialog.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=9222, bin_dir=os.path.curdir, timeout_seconds=REQUEST_TIMEOUT_SECONDS):
+        self.host = host
+        self.port = port
+        self.timeout_seconds = timeout_seconds
+        self.ws = None
+        self.reader_task = None
+        self.next_id = 0
+        self.pending = {}
+
+        # Session IDs of the tabs that we've attached to, by target ID
+        self.sessions = {}
+
+        # The call tabs found by the last query, when we looked for them, and
+        # the one that we picked
+        self.tabs = []
+        self.tabs_time = 0
+        self.tab = None
+
+        with open(os.path.join(bin_dir, 'query.js'), encoding='utf-8') as f:
+            self.query_text = f.read()
+        with open(os.path.join(bin_dir, 'toggle.js'), encoding='utf-8') as f:
+            self.toggle_text = f.read()
+        with open(os.path.join(bin_dir, 'ensure.js'), encoding='utf-8') as f:
+            self.ensure_text = f.read()
+        with open(os.path.join(bin_dir, 'observe.js'), encoding='utf-8') as f:
+            self.observe_text = f.read()
+
+    async def start(self):
+        '''
+        Connect to the browser, if there is one and we're not connected.
+
+        Returns True if we are connected, or False if there is no browser.
+        Raises `BackendError` if there is one but we can't connect to it.
+        '''
+
+        if self.ws is not None:
+            return True
+
+        try:
+            version = await asyncio.wait_for(
+                http_json(self.host, self.port, '/json/version'),
+                self.timeout_seconds)
+            url = version['webSocketDebuggerUrl']
+        except asyncio.TimeoutError:
+            raise BackendError(
+                EC_QUERY_TIMEOUT,
+                f'DevTools version not answered within {self.timeout_seconds}s')
+        except (OSError, ValueError, KeyError, TypeError):
+            # Nothing is listening; there is no browser
+            return False
+
+        # The browser may be going away, or still starting up
+        info(f'connecting to DevTools at {url}')
+        try:
+            ws = await asyncio.wait_for(
+                websockets.connect(url, max_size=None), self.timeout_seconds)
+        except asyncio.TimeoutError:
+            raise BackendError(
+                EC_QUERY_TIMEOUT,
+                f'DevTools connection not made within {self.timeout_seconds}s')
+        except (OSError, WebSocketException) as e:
+            raise BackendError(
+                EC_QUERY_SUBPROCESS_FAILED_EXCEPTION,
+                f'couldn\'t connect to DevTools: {e}')
+
+        self.ws = ws
+        self.reader_task = asyncio.create_task(self._read(ws))
+
+        return True
+
+    async def close(self):
+        '''
+        Close the connection to the browser, if any.
+        '''
+
+        self.sessions = {}
+        self.tabs_time = 0
+
+        ws, self.ws = self.ws, None
+        if ws is None:
+            return
+
+        await ws.close()
+        self.reader_task.cancel()
+
+    async def _read(self, ws):
+        '''
+        Dispatch responses read from `ws` to the requests awaiting them.
+        '''
+
+        try:
+            async for msg in ws:
+                resp = json.loads(msg)
+
+                # A tab was closed or navigated somewhere that needs a new
+                # renderer; we'll have to attach to it again
+                if resp.get('method') == 'Target.detachedFromTarget':
+                    sid = resp['params'].get('sessionId')
+                    self.sessions = {
+                        t: s for t, s in self.sessions.items() if s != sid}
+                    continue
+
+                fut = self.pending.pop(resp.get('id'), None)
+                if fut is not None and not fut.done():
+                    fut.set_result(resp)
+        except websockets.ConnectionClosed:
+            pass
+        except Exception:
+            exception('reading from DevTools failed')
+        finally:
+            if self.ws is ws:
+                self.ws = None
+                self.sessions = {}
+                self.tabs_time = 0
+
+            for fut in self.pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError('DevTools connection closed'))
+            self.pending.clear()
+
+    async def send(self, method, params=None, session_id=None):
+        '''
+        Send a DevTools command and return its result.
+
+        If `session_id` is given, the command is sent to that attached tab
+        rather than to the browser.
+        '''
+
+        if self.ws is None:
+            raise BackendError(
+                EC_QUERY_SUBPROCESS_FAILED_EXCEPTION, 'DevTools connection closed')
+
+        self.next_id += 1
+        req = {'id': self.next_id, 'method': method, 'params': params or {}}
+        if session_id is not None:
+            req['sessionId'] = session_id
+
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[req['id']] = fut
+
+        try:
+            await self.ws.send(json.dumps(req))
+            resp = await asyncio.wait_for(fut, self.timeout_seconds)
+        except asyncio.TimeoutError:
+            self.pending.pop(req['id'], None)
+            raise BackendError(
+                EC_QUERY_TIMEOUT,
+                f'{method} not answered within {self.timeout_seconds}s')
+        except (ConnectionError, websockets.ConnectionClosed) as e:
+            await self.close()
+            raise BackendError(EC_QUERY_SUBPROCESS_FAILED_EXCEPTION, str(e))
+
+        if 'error' in resp:
+            raise BackendError(
+                EC_QUERY_SUBPROCESS_FAILED_STATUS, resp['error'].get('message'))
+
+        return resp['result']
+
+    async def discover(self):
+        '''
+        Return the target IDs of all call tabs.
+
+        A non-empty list is re-used for `DISCOVERY_SECONDS`.
+        '''
+
+        now = clock.time()
+        if self.tabs and now - self.tabs_time < DISCOVERY_SECONDS:
+            return self.tabs
+
+        result = await self.send('Target.getTargets')
+        tabs = [
+            t['targetId'] for t in result['targetInfos']
+            if t.get('type') == 'page' and '/LINK:' in t.get('url', '')]
+
+        # Forget about tabs that have gone away
+        self.sessions = {t: s for t, s in self.sessions.items() if t in tabs}
+
+        self.tabs = tabs
+        self.tabs_time = now
+        return tabs
+
+    async def evaluate(self, tab, expression):
+        '''
+        Evaluate `expression` in the given tab and return its value.
+        '''
+
+        sid = self.sessions.get(tab)
+        if sid is None:
+            result = await self.send(
+                'Target.attachToTarget', {'targetId': tab, 'flatten': True})
+            sid = self.sessions[tab] = result['sessionId']
+
+        try:
+            result = await self.send(
+                'Runtime.evaluate',
+                {'expression': expression, 'returnByValue': True},
+                session_id=sid)
+        except BackendError:
+            # The session may be stale; attach again next time
+            self.sessions.pop(tab, None)
+            raise
+
+        if 'exceptionDetails' in result:
+            raise BackendError(
+                EC_QUERY_SUBPROCESS_FAILED_STATUS,
+                result['exceptionDetails'].get('text'))
+
+        return result['result'].get('value')
+
+    @staticmethod
+    def _guard(js, fallback):
+        '''
+        Wrap `js` so that it only runs if the tab is still showing a call.
+        '''
+
+        return f'(location.href.indexOf("/LINK:") < 0) ? {fallback} : {js}'
+
+    async def query(self):
+        '''
+        Query all call tabs at once, pick the active one and return the raw
+        result of running query.js in it.
+        '''
+
+        if not await self.start():
+            self.tabs = []
+            self.tab = None
+            return 'NONE'
+
+        tabs = await self.discover()
+        expression = self._guard(f'({self.query_text})()', 'null')
+        values = await asyncio.gather(
+            *[self.evaluate(t, expression) for t in tabs],
+            return_exceptions=True)
+
+        results = []
+        exc = None
+        for tab, value in zip(tabs, values):
+            if isinstance(value, Exception):
+                exc = exc or value
+            elif value is not None:
+                results.append((tab, value))
+                continue
+
+            # The tab went away or navigated elsewhere; look again next time
+            self.tabs_time = 0
+
+        # If we couldn't query anything, report why
+        if not results and exc is not None:
+            raise exc
+
+        self.tab, result = select_result(results, self.tab)
+        return result
+
+    async def toggle(self, target):
+        '''
+        Toggle the state of the `target` action in the call tab.
+
+        Returns False if there is no call tab.
+        '''
+
+        if self.tab is None or not await self.start():
+            return False
+
+        result = await self.evaluate(
+            self.tab,
+            self._guard(f'(({self.toggle_text})({json.dumps(target)}), true)', 'null'))
+        return result is True
+
+    async def ensure(self, targets):
+        '''
+        Bring each action in `targets`, a list of (action, status) pairs, to
+        its status in the call tab with one evaluation, clicking only the
+        buttons that need it.
+
+        Returns what ensure.js did to each action, by action, or None if
+        there is no call tab.
+        '''
+
+        if self.tab is None or not await self.start():
+            return None
+
+        steps = json.dumps([{'action': a, 'state': s} for a, s in targets])
+        result = await self.evaluate(
+            self.tab, self._guard(f'({self.ensure_text})({steps})', 'null'))
+        return None if result is None else json.loads(result)
+
+    async def observe(self, port, token, heartbeat_seconds):
+        '''
+        Install observe.js in the call tab, pushing state to the given port.
+
+        Returns None if there is no call tab.
+        '''
+
+        if self.tab is None or not await self.start():
+            return None
+
+        args = ', '.join(
+            json.dumps(a)
+            for a in [port, token, int(heartbeat_seconds * 1000), self.tab])
+
+        return await self.evaluate(
+            self.tab,
+            self._guard(
+                f'({self.observe_text})(({self.query_text}), {args})', 'null'))
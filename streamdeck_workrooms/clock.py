@@ -0,0 +1,75 @@
+'''
+The time, as far as the daemon is concerned.
+
+Normally this is just the wall clock. When replaying a recording (see
+`replay`), the daemon runs on a `VirtualEventLoop` instead, where time only
+moves forward when there is nothing else to do. Sleeps and timeouts then
+complete instantly rather than in real time, and `time()` reports the virtual
+time, so that hours of behavior can be played back in seconds.
+'''
+
+import asyncio
+import selectors
+import time as _time
+
+
+def time():
+    '''
+    Return the current time in seconds since the epoch, which is virtual if
+    we're running on a `VirtualEventLoop`.
+    '''
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return _time.time()
+
+    if isinstance(loop, VirtualEventLoop):
+        return loop.start + loop.time()
+
+    return _time.time()
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    '''
+    Selector which, rather than blocking until the next timer is due, moves
+    the clock of `loop` forward to it.
+    '''
+
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+
+        # Nothing is scheduled and nothing can happen; we'd block forever
+        if timeout is None:
+            raise RuntimeError('virtual event loop has nothing left to wait for')
+
+        self.loop.elapsed += timeout
+        return events
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    '''
+    Event loop whose clock starts at `start` seconds since the epoch and jumps
+    straight to the next timer whenever the loop would otherwise wait.
+
+    Real I/O still works, but is only checked for and never waited on, so
+    this is only suitable for code that doesn't depend on it.
+    '''
+
+    def __init__(self, start=0):
+        self.start = start
+
+        # The loop's own clock counts from zero rather than from `start`,
+        # keeping it small enough to hit timers exactly
+        self.elapsed = 0
+
+        super().__init__(_VirtualSelector(self))
+
+    def time(self):
+        return self.elapsed
@@ -0,0 +1,370 @@
+'''
+Transitions between action states.
+
+The functions here take the current `types.Action` of one or all actions and
+something that happened, e.g. a new state from the browser or a key
+appearing, and return the new `Action` along with a list of effects: images
+and titles to show on keys, analytics to report and so on. They don't do any
+I/O themselves, apart from logging, and don't change their arguments; the
+callers in `browser` and `streamdeck` store the new state and hand the effects
+to `perform()`.
+'''
+
+from . import metrics
+from .types import Action, ActionState
+
+from collections import namedtuple
+from logging import error, info
+
+
+# Grace period before we show the user an error
+ERROR_GRACE_PERIOD_SECONDS = 5
+
+HELP_URL = 'https://github.com/pgriess/streamdeck-workrooms/wiki/Help'
+ERRORS_URL = 'https://github.com/pgriess/streamdeck-workrooms/wiki/Errors'
+
+
+# Effects
+SetImage = namedtuple('SetImage', ['contexts', 'action', 'status'])
+SetTitle = namedtuple('SetTitle', ['contexts', 'title'])
+OpenUrl = namedtuple('OpenUrl', ['context', 'url'])
+Forget = namedtuple('Forget', ['context'])
+Collect = namedtuple('Collect', ['params'])
+PressToState = namedtuple('PressToState', ['action', 'seconds'])
+Toggle = namedtuple('Toggle', ['action'])
+
+
+def image_status(status):
+    '''
+    Return the status whose image we show for `status`.
+    '''
+
+    return status if status in ['ON', 'OFF'] else 'NONE'
+
+
+def is_call_active(actions):
+    '''
+    Is there an active call?
+    '''
+
+    for a in actions.values():
+        if a.current.status in ['ON', 'OFF']:
+            return True
+
+    return False
+
+
+def appear(name, action, context):
+    '''
+    A key for the action has appeared.
+
+    There may be any number of keys for each action, e.g. across pages or
+    devices. If we already know the state, bring the new one up to date since
+    it won't otherwise be updated until the state changes.
+    '''
+
+    if context not in action.contexts:
+        action = action._replace(contexts=action.contexts + (context,))
+    effects = [Forget(context)]
+
+    state = action.current
+    if state.status is not None:
+        effects += [
+            SetImage((context,), name, image_status(state.status)),
+            SetTitle((context,), state.error),
+        ]
+
+    return action, effects
+
+
+def disappear(name, action, context, now):
+    '''
+    A key for the action has gone away.
+
+    If it was the last one, clear out the state so that things will
+    initialize correctly the next time a key appears.
+    '''
+
+    contexts = tuple(c for c in action.contexts if c != context)
+    effects = [Forget(context)]
+
+    if contexts:
+        return action._replace(contexts=contexts), effects
+
+    return Action(contexts=contexts, next_time=now), effects
+
+
+def press(name, action, context):
+    '''
+    A key for the action has been pressed.
+
+    If we can't toggle the action, we direct the user to the help page for the
+    error or status that it's in. Otherwise the effects include `Toggle`,
+    which the caller must carry out.
+    '''
+
+    state = action.current
+
+    # We have no idea what the current state is; do nothing
+    if state.status is None:
+        return []
+
+    if state.error is not None:
+        info('opening up the help page for error {}'.format(state.error))
+        return [OpenUrl(context, f'{ERRORS_URL}#{state.error.lower()}')]
+
+    if state.status in ['NONE', 'UNKNOWN']:
+        info('opening up the help page')
+        return [OpenUrl(context, HELP_URL)]
+
+    return [Toggle(name)]
+
+
+def toggled(name, action, status, pressed, now, optimistic):
+    '''
+    The action has been toggled in the browser from `status`, by a press at
+    time `pressed`.
+
+    In optimistic mode, we show the status that we expect right away rather
+    than waiting for the browser to report it. `observe()` confirms this or
+    rolls it back.
+    '''
+
+    return ensured(
+        name, action, {'ON': 'OFF', 'OFF': 'ON'}[status], pressed, now, optimistic)
+
+
+def ensured(name, action, expected, pressed, now, optimistic):
+    '''
+    The action has been changed in the browser to status `expected`, by a
+    press at time `pressed`, e.g. by a macro key.
+
+    As with `toggled()`, in optimistic mode we show `expected` right away.
+    '''
+
+    action = action._replace(action_time=pressed)
+    if not optimistic or not action.contexts:
+        return action, []
+
+    action = action._replace(
+        pending=expected,
+        current=ActionState(expected),
+        next=ActionState(expected),
+        next_time=pressed)
+
+    return action, [
+        SetImage(action.contexts, name, expected),
+        Collect({
+            't': 'timing',
+            'utc': 'Toggle',
+            'utv': f'{name.title()}Optimistic',
+            'utt': int((now - pressed) * 1000)}),
+    ]
+
+
+def macro_targets(actions, steps):
+    '''
+    Return the steps of a macro, a list of (action, status) pairs, that it
+    can carry out: those for actions which are on or off.
+    '''
+
+    return [
+        (name, status) for name, status in steps
+        if actions[name].current.status in ['ON', 'OFF'] and
+        actions[name].current.error is None]
+
+
+def macro_done(actions, targets):
+    '''
+    Are the actions in `targets`, a list of (action, status) pairs, known to
+    be in those statuses?
+
+    Optimistic updates don't count until the browser has confirmed them, and
+    an action that has gone away, e.g. because the call ended, is as good as
+    off.
+    '''
+
+    for name, status in targets:
+        action = actions[name]
+        if action.pending is not None:
+            return False
+
+        current = action.current.status
+        if current != status and not (status == 'OFF' and current == 'NONE'):
+            return False
+
+    return True
+
+
+def _observe_one(name, action, new_state, reason, now, confirm_seconds, grace_seconds, effects):
+    contexts = action.contexts
+    prev_state = current_state = action.current
+    next_state = action.next
+    next_time = action.next_time
+    action_time = action.action_time
+    pending = action.pending
+
+    # No keys are showing this action; don't update
+    if not contexts:
+        return action
+
+    # In optimistic mode the key already shows the status that we expect the
+    # user's toggle to produce. Hold it there until the browser agrees,
+    # rolling it back if that doesn't happen in time.
+    if pending is not None:
+        if new_state.status == pending:
+            latency = now - action_time
+            info(f'{name} toggle to {pending} confirmed after {latency:.3f}s')
+            effects += [
+                PressToState(name, latency),
+                Collect({
+                    't': 'timing',
+                    'utc': 'Toggle',
+                    'utv': f'{name.title()}Confirmed',
+                    'utt': int(latency * 1000)}),
+            ]
+
+            pending = None
+            action_time = None
+        elif now < action_time + confirm_seconds:
+            new_state = current_state
+        else:
+            error(
+                f'{name} toggle to {pending} not seen after '
+                f'{confirm_seconds}s; rolling back to {new_state.status}')
+            effects.append(Collect({
+                't': 'event', 'ec': 'Optimistic', 'ea': 'Rollback', 'el': name.title()}))
+
+            pending = None
+            action_time = None
+
+    # Update the next state if it's changed
+    if new_state != next_state:
+        next_state = new_state
+        next_time = now
+
+    if next_state != current_state:
+        # All changes are flushed after the grace period
+        if now > (next_time + grace_seconds):
+            current_state = next_state
+
+        # Changes to a "good" status cause the entire next state to be
+        # propagated immediately since we want to be in an error state for as
+        # short a time as possible.
+        if next_state.status != current_state.status and next_state.status != 'UNKNOWN':
+            current_state = next_state
+
+    # Update the status if necessary
+    if prev_state.status != current_state.status:
+        info('{} status changed from {} to {}'.format(name, prev_state.status, current_state.status))
+
+        effects.append(SetImage(contexts, name, image_status(current_state.status)))
+
+        if current_state.status not in ['ON', 'OFF', 'NONE', 'UNKNOWN']:
+            error(f'Unexpected status {current_state.status}')
+            effects.append(Collect({
+                't': 'exception',
+                'exd': f'{name.title()}UnexpectedState{current_state.status}',
+                'exf': 0}))
+
+        # If we've transitioned to a "good" state and the user has pressed a
+        # button to initate this change, track and report the time from press
+        # to the new image being sent.
+        if current_state.status in ['ON', 'OFF'] and action_time is not None:
+            latency = now - action_time
+            effects += [
+                PressToState(name, latency),
+                Collect({
+                    't': 'timing',
+                    'utc': 'Toggle',
+                    'utv': name.title(),
+                    'utt': int(latency * 1000)}),
+            ]
+
+        # No matter what, any attempt by the user to toggle the state is now
+        # stale; reset it
+        action_time = None
+
+    # Update the error if necessary
+    if prev_state.error != current_state.error:
+        info('{} error changed from {} to {} ({})'.format(
+            name, prev_state.error, current_state.error, reason))
+
+        if current_state.error is not None:
+            effects.append(Collect({
+                't': 'exception', 'exd': f'{name.title()}Error{current_state.error}', 'exf': 0}))
+
+        effects.append(SetTitle(contexts, current_state.error))
+
+    # Don't allocate anything if nothing changed, which is the common case
+    if current_state is prev_state and next_state is action.next and \
+            next_time is action.next_time and \
+            action_time is action.action_time and pending is action.pending:
+        return action
+
+    return action._replace(
+        current=current_state,
+        next=next_state,
+        next_time=next_time,
+        action_time=action_time,
+        pending=pending)
+
+
+def observe(actions, observed, now, confirm_seconds, grace_seconds=ERROR_GRACE_PERIOD_SECONDS):
+    '''
+    The browser has been seen in a new state at time `now`.
+
+    The `actions` map action names to their `Action`, and `observed` maps them
+    to an (ActionState, reason) tuple describing what we saw. Optimistic
+    updates are confirmed or rolled back after `confirm_seconds`, and errors
+    are only shown once they've lasted for `grace_seconds`.
+
+    Returns the new `actions` and the effects of the change.
+    '''
+
+    effects = []
+    new_actions = {
+        name: _observe_one(
+            name, action, observed[name][0], observed[name][1], now,
+            confirm_seconds, grace_seconds, effects)
+        for name, action in actions.items()}
+
+    # Our in-call status has changed. Report this.
+    #
+    # NOTE: We use the Session Control (sc) GA parmeter here to try to
+    #       get tighter control over session lifetimes. Hopefully even if
+    #       there is a blackholed client_id active, setting sc=end will
+    #       allow it to begin reporting events to a new session. See #40.
+    in_call = is_call_active(actions)
+    if in_call != is_call_active(new_actions):
+        effects.append(Collect({
+            't': 'event',
+            'ec': 'Call',
+            'ea': 'End' if in_call else 'Begin',
+            'sc': 'end' if in_call else 'start'}))
+
+    return new_actions, effects
+
+
+async def perform(effects, outbox, analytics_collect):
+    '''
+    Carry out `effects`, queueing messages to Stream Deck in `outbox` and
+    reporting analytics through `analytics_collect`, if it's not None.
+
+    `Toggle` effects are left to the caller.
+    '''
+
+    for e in effects:
+        kind = type(e)
+        if kind is SetImage:
+            outbox.set_image(e.contexts, e.action, e.status)
+        elif kind is SetTitle:
+            outbox.set_title(e.contexts, e.title)
+        elif kind is OpenUrl:
+            outbox.send({'event': 'openUrl', 'context': e.context, 'payload': {'url': e.url}})
+        elif kind is Forget:
+            outbox.forget(e.context)
+        elif kind is PressToState:
+            metrics.PRESS_TO_STATE_SECONDS.observe(e.seconds, action=e.action)
+        elif kind is Collect and analytics_collect:
+            await analytics_collect(**e.params)
@@ -0,0 +1,6 @@
+'''
+Fake implementations of the external systems that the daemon talks to.
+
+These allow the daemon to be exercised on machines without Stream Deck or
+Chrome, e.g. on Linux.
+'''
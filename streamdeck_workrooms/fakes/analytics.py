@@ -0,0 +1,113 @@
+'''
+Fake Google Analytics collector.
+
+This accepts Measurement Protocol hits on `/collect` and `/batch`, checking
+the limits that the real thing enforces, and keeps counts of what it has
+received. `GET /stats` returns these as JSON, which makes it possible to
+check the batching behavior of the daemon without talking to Google.
+
+Run it with `python -m streamdeck_workrooms.fakes.analytics` and point the
+daemon at it using its `--analytics-endpoint` option.
+'''
+
+from ..analytics import BATCH_MAX_BYTES, BATCH_MAX_HITS
+
+from aiohttp import web
+from argparse import ArgumentParser
+import asyncio
+import time
+from urllib.parse import parse_qsl
+
+
+# Parameters which must be present in every hit
+REQUIRED_PARAMS = ['v', 'tid', 'cid', 't']
+
+
+def make_app(args):
+    '''
+    Create the aiohttp application implementing the fake collector.
+    '''
+
+    stats = {
+        'requests': 0,
+        'batches': 0,
+        'hits': 0,
+        'rejected': 0,
+        'in_flight': 0,
+        'max_in_flight': 0,
+        'max_batch_hits': 0,
+        'max_qt': 0,
+        'first_time': None,
+        'last_time': None,
+    }
+    hits = []
+
+    async def receive(lines):
+        now = time.time()
+        stats['requests'] += 1
+        stats['in_flight'] += 1
+        stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+        stats['first_time'] = stats['first_time'] or now
+        stats['last_time'] = now
+
+        try:
+            if args.delay:
+                await asyncio.sleep(args.delay)
+
+            for line in lines:
+                hit = dict(parse_qsl(line))
+                if any(p not in hit for p in REQUIRED_PARAMS):
+                    stats['rejected'] += 1
+                    continue
+
+                stats['hits'] += 1
+                stats['max_qt'] = max(stats['max_qt'], int(hit.get('qt', 0)))
+                hits.append(hit)
+        finally:
+            stats['in_flight'] -= 1
+
+        # Like the real thing, this always succeeds
+        return web.Response(content_type='image/gif', body=b'GIF89a')
+
+    async def handle_collect(request):
+        return await receive([(await request.read()).decode('utf-8')])
+
+    async def handle_batch(request):
+        body = await request.read()
+        lines = [l for l in body.decode('utf-8').split('\n') if l]
+
+        if len(lines) > BATCH_MAX_HITS or len(body) > BATCH_MAX_BYTES:
+            stats['rejected'] += len(lines)
+            return web.Response(status=413, text='batch too large')
+
+        stats['batches'] += 1
+        stats['max_batch_hits'] = max(stats['max_batch_hits'], len(lines))
+        return await receive(lines)
+
+    async def handle_stats(request):
+        return web.json_response(dict(stats, last_hits=hits[-BATCH_MAX_HITS:]))
+
+    app = web.Application()
+    app.router.add_post('/collect', handle_collect)
+    app.router.add_post('/batch', handle_batch)
+    app.router.add_get('/stats', handle_stats)
+
+    return app
+
+
+def main():
+    ap = ArgumentParser(description='Fake Google Analytics collector.')
+    ap.add_argument(
+        '--port', type=int, default=8099,
+        help='port to listen on (default: %(default)s)')
+    ap.add_argument(
+        '--delay', type=float, default=0,
+        help='seconds to wait before answering each request')
+
+    args = ap.parse_args()
+
+    web.run_app(make_app(args), host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
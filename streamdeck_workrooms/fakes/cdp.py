@@ -0,0 +1,219 @@
+'''
+Fake Chrome DevTools Protocol server.
+
+This serves `/json/version` and `/json/list` and answers the `Target.*` and
+`Runtime.evaluate` requests sent by `CDPBackend` on the browser's WebSocket.
+There is one call tab with the state given by `--state`, plus one more for
+each `--extra-tab`. It can't actually run JavaScript, so it recognizes the
+toggle, ensure and observe expressions sent by `CDPBackend` and answers
+everything else with the tab's current query result. Installing the observer
+starts a task which pushes state changes to the daemon just as observe.js
+would.
+
+Run it with `python -m streamdeck_workrooms.fakes.cdp` and point the daemon at
+it using its `--browser-backend=cdp` and `--cdp-port` options.
+'''
+
+from .worker import ensure, query_result, read_state, toggle, write_state
+
+from aiohttp import ClientSession, WSMsgType, web
+from argparse import ArgumentParser
+import asyncio
+import json
+import re
+import time
+
+
+# Matches the trailing call in expressions like `((...)("mic"), true)`
+TOGGLE_RE = re.compile(r'\)\("(\w+)"\), true\)\s*$')
+
+# Matches the trailing call in expressions like
+# `(...)([{"action": "mic", "state": "OFF"}])`
+ENSURE_RE = re.compile(r'\)\((\[.*\])\)\s*$')
+
+# Matches the trailing call in expressions like
+# `(...)((...), 1234, "abc", 2000, "TAB1")`
+OBSERVE_RE = re.compile(r'\), (\d+), "(\w+)", (\d+), "(\w+)"\)\s*$')
+
+
+async def observe(args, state, tab, port, token, heartbeat_ms):
+    '''
+    Push state changes to the daemon, emulating observe.js.
+    '''
+
+    url = f'ws://127.0.0.1:{port}/'
+    async with ClientSession() as cs, cs.ws_connect(url) as ws:
+        last = None
+        last_time = 0
+
+        while not ws.closed:
+            if tab == 'TAB1':
+                state['result'] = read_state(args, state['result'])
+            now = time.time()
+
+            if state['result'] != last or now > last_time + heartbeat_ms / 1000:
+                last = state['result']
+                last_time = now
+                await ws.send_json(
+                    {'token': token, 'tab': tab, 'state': query_result(last)})
+
+            await asyncio.sleep(0.05)
+
+
+def make_app(args):
+    '''
+    Create the aiohttp application implementing the fake server.
+    '''
+
+    # The first tab's state may be scripted using --state-file; the others are
+    # fixed apart from toggles
+    tabs = {'TAB1': {'result': args.state}}
+    for i, extra in enumerate(args.extra_tab, start=2):
+        tabs[f'TAB{i}'] = {'result': extra}
+
+    observers = {}
+    write_state(args, read_state(args, args.state))
+
+    def current(tab):
+        state = tabs[tab]
+        if tab == 'TAB1':
+            state['result'] = read_state(args, state['result'])
+
+        return state
+
+    async def handle_version(request):
+        return web.json_response({
+            'Browser': 'FakeChrome/1.0',
+            'Protocol-Version': '1.3',
+            'webSocketDebuggerUrl': f'ws://{request.host}/devtools/browser/FAKE',
+        })
+
+    async def handle_list(request):
+        return web.json_response([{
+            'id': tab,
+            'type': 'page',
+            'title': 'Fake Workplace Room',
+            'url': args.url,
+            'webSocketDebuggerUrl': f'ws://{request.host}/devtools/page/{tab}',
+        } for tab in tabs])
+
+    async def evaluate(tab, params):
+        state = current(tab)
+
+        if args.error:
+            return {
+                'result': {'type': 'object', 'subtype': 'error'},
+                'exceptionDetails': {'text': args.error}}
+
+        value = query_result(state['result'])
+        expr = params['expression']
+
+        m = OBSERVE_RE.search(expr)
+        if m:
+            port, token, heartbeat_ms = int(m.group(1)), m.group(2), int(m.group(3))
+            key = (tab, port, token)
+            value = 'RUNNING'
+            if key not in observers or observers[key].done():
+                observers[key] = asyncio.create_task(
+                    observe(args, state, m.group(4), port, token, heartbeat_ms))
+                value = 'INSTALLED'
+
+        m = TOGGLE_RE.search(expr)
+        if m:
+            state['result'] = toggle(state['result'], m.group(1))
+            if tab == 'TAB1':
+                write_state(args, state['result'])
+            value = True
+
+        m = ENSURE_RE.search(expr)
+        if m:
+            state['result'], value = ensure(state['result'], json.loads(m.group(1)))
+            if tab == 'TAB1':
+                write_state(args, state['result'])
+
+        return {'result': {'type': 'string', 'value': value}}
+
+    async def handle_browser(request):
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+
+        sessions = {}
+
+        async def respond(req):
+            if args.delay:
+                await asyncio.sleep(args.delay)
+
+            method = req.get('method')
+            params = req.get('params', {})
+            resp = {'id': req['id']}
+
+            if 'sessionId' in req:
+                resp['sessionId'] = req['sessionId']
+
+            if method == 'Target.getTargets':
+                resp['result'] = {'targetInfos': [{
+                    'targetId': tab,
+                    'type': 'page',
+                    'title': 'Fake Workplace Room',
+                    'url': args.url,
+                    'attached': tab in sessions.values(),
+                } for tab in tabs]}
+            elif method == 'Target.attachToTarget' and params.get('targetId') in tabs:
+                sid = f'SESSION{len(sessions) + 1}'
+                sessions[sid] = params['targetId']
+                resp['result'] = {'sessionId': sid}
+            elif method == 'Runtime.evaluate' and req.get('sessionId') in sessions:
+                resp['result'] = await evaluate(sessions[req['sessionId']], params)
+            else:
+                resp['error'] = {'code': -32601, 'message': f'{method} wasn\'t found'}
+
+            await ws.send_json(resp)
+
+        # Answer requests concurrently, as the browser does for different tabs
+        async for msg in ws:
+            if msg.type == WSMsgType.TEXT:
+                asyncio.create_task(respond(json.loads(msg.data)))
+
+        return ws
+
+    app = web.Application()
+    app.router.add_get('/json/version', handle_version)
+    app.router.add_get('/json/list', handle_list)
+    app.router.add_get('/json', handle_list)
+    app.router.add_get('/devtools/browser/{id}', handle_browser)
+
+    return app
+
+
+def main():
+    ap = ArgumentParser(description='Fake Chrome DevTools Protocol server.')
+    ap.add_argument(
+        '--port', type=int, default=9222,
+        help='port to listen on (default: %(default)s)')
+    ap.add_argument(
+        '--url', default='https://fb.workplace.com/groupcall/LINK:fake/',
+        help='URL of the fake call tab (default: %(default)s)')
+    ap.add_argument(
+        '--state', default='ON OFF NONE ON',
+        help='initial state; see fakes.worker.query_result() (default: %(default)s)')
+    ap.add_argument(
+        '--extra-tab', action='append', default=[], metavar='STATE',
+        help='add another call tab with the given state; may be repeated')
+    ap.add_argument(
+        '--state-file',
+        help='file holding the state; re-read on every query and '
+             'updated by toggles so that the state can be scripted externally')
+    ap.add_argument(
+        '--delay', type=float, default=0,
+        help='seconds to wait before answering each request')
+    ap.add_argument(
+        '--error',
+        help='fail every evaluation with this exception text')
+
+    args = ap.parse_args()
+
+    web.run_app(make_app(args), host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
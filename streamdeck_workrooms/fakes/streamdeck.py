@@ -0,0 +1,246 @@
+'''
+Fake Stream Deck application.
+
+This plays the part of the Stream Deck application for a plugin: it listens on
+a WebSocket, starts the plugin with the same arguments that Stream Deck would,
+answers the registration handshake and `getGlobalSettings`, and can send the
+plugin `willAppear`, `willDisappear` and `keyUp` events and changes to the
+global settings. Everything the plugin sends is recorded along with the time
+it arrived.
+
+Run it with `python -m streamdeck_workrooms.fakes.streamdeck -- <plugin command>`
+to watch what a plugin sends, or use `FakeStreamDeck` from a script.
+'''
+
+from argparse import ArgumentParser
+import asyncio
+import json
+import sys
+import time
+from uuid import uuid4
+import websockets
+
+
+PLUGIN_ID = 'in.std.streamdeck.workplace'
+
+# Sent to the plugin as -info; a Stream Deck XL and a Pedal
+DEFAULT_INFO = {
+    'application': {'language': 'en', 'platform': 'mac', 'version': '5.0.0'},
+    'plugin': {'uuid': PLUGIN_ID, 'version': '2.1.0'},
+    'devicePixelRatio': 2,
+    'devices': [
+        {'id': 'DECK1', 'name': 'Stream Deck XL', 'size': {'columns': 8, 'rows': 4}, 'type': 2},
+        {'id': 'DECK2', 'name': 'Stream Deck Pedal', 'size': {'columns': 3, 'rows': 1}, 'type': 5},
+    ],
+}
+
+
+class FakeStreamDeck:
+    '''
+    A fake Stream Deck application talking to a single plugin.
+
+    The `received` attribute holds a (time, message) tuple for each message
+    that the plugin has sent, where `message` is the decoded JSON, and the
+    `bytes_received` attribute counts their total size.
+    '''
+
+    def __init__(self, settings=None, info=DEFAULT_INFO):
+        self.settings = settings if settings is not None else {'client_id': str(uuid4())}
+        self.info = info
+        self.plugin_uuid = str(uuid4()).upper()
+
+        self.server = None
+        self.port = None
+        self.ws = None
+        self.proc = None
+
+        self.received = []
+        self.bytes_received = 0
+        self.registered = asyncio.Event()
+        self.arrived = asyncio.Condition()
+
+    async def start(self):
+        '''
+        Start listening for the plugin on an unused port.
+        '''
+
+        self.server = await websockets.serve(
+            self._handle, '127.0.0.1', 0, max_size=None)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def plugin_args(self):
+        '''
+        Return the arguments that Stream Deck passes to the plugin.
+        '''
+
+        return [
+            '-port', str(self.port),
+            '-pluginUUID', self.plugin_uuid,
+            '-registerEvent', 'registerPlugin',
+            '-info', json.dumps(self.info),
+        ]
+
+    async def launch(self, argv, **kwargs):
+        '''
+        Start the plugin by running `argv` followed by the arguments that
+        Stream Deck would pass, and wait for it to register.
+
+        Any `kwargs` are passed on to `asyncio.create_subprocess_exec()`.
+        '''
+
+        self.proc = await asyncio.create_subprocess_exec(
+            *argv, *self.plugin_args(), **kwargs)
+        await self.registered.wait()
+
+    async def stop(self):
+        '''
+        Stop the plugin, if we started it, and stop listening.
+        '''
+
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.terminate()
+            try:
+                await asyncio.wait_for(self.proc.wait(), 5)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+                await self.proc.wait()
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, ws):
+        self.ws = ws
+
+        try:
+            await self._receive(ws)
+        except websockets.exceptions.ConnectionClosed:
+            # The plugin went away, e.g. because we stopped it
+            pass
+
+    async def _receive(self, ws):
+        async for msg in ws:
+            now = time.time()
+            jo = json.loads(msg)
+
+            async with self.arrived:
+                self.received.append((now, jo))
+                self.bytes_received += len(msg)
+                self.arrived.notify_all()
+
+            if jo.get('event') == 'registerPlugin':
+                self.registered.set()
+            elif jo.get('event') == 'getGlobalSettings':
+                await self.send('didReceiveGlobalSettings', context=self.plugin_uuid, payload={
+                    'settings': self.settings,
+                })
+            elif jo.get('event') == 'setGlobalSettings':
+                self.settings = jo['payload']
+
+    async def send(self, event, **kwargs):
+        '''
+        Send the plugin an event, returning the time that it was sent.
+        '''
+
+        await self.ws.send(json.dumps(dict(kwargs, event=event)))
+        return time.time()
+
+    async def set_global_settings(self, settings):
+        '''
+        Change the global settings as the Property Inspector would, and tell
+        the plugin.
+        '''
+
+        self.settings = settings
+        return await self.send(
+            'didReceiveGlobalSettings', context=self.plugin_uuid,
+            payload={'settings': settings})
+
+    async def appear(self, action, context, device='DECK1'):
+        return await self.send(
+            'willAppear', action=f'{PLUGIN_ID}.{action}', context=context,
+            device=device, payload={'settings': {}, 'coordinates': {'column': 0, 'row': 0}})
+
+    async def disappear(self, action, context, device='DECK1'):
+        return await self.send(
+            'willDisappear', action=f'{PLUGIN_ID}.{action}', context=context,
+            device=device, payload={'settings': {}, 'coordinates': {'column': 0, 'row': 0}})
+
+    async def press(self, action, context, device='DECK1', settings=None):
+        '''
+        Press and release the key for `context`, which has the per-key
+        `settings`, returning the time that it was released.
+        '''
+
+        payload = {'settings': settings or {}, 'coordinates': {'column': 0, 'row': 0}}
+        await self.send(
+            'keyDown', action=f'{PLUGIN_ID}.{action}', context=context,
+            device=device, payload=payload)
+        return await self.send(
+            'keyUp', action=f'{PLUGIN_ID}.{action}', context=context,
+            device=device, payload=payload)
+
+    async def wait_for(self, match, since=0, timeout=10):
+        '''
+        Wait for the plugin to send a message for which `match(message)` is
+        true, at or after time `since`, and return its (time, message) tuple.
+
+        Raises `asyncio.TimeoutError` if none arrives within `timeout` seconds.
+        '''
+
+        def find():
+            for t, msg in self.received:
+                if t >= since and match(msg):
+                    return (t, msg)
+
+            return None
+
+        async with self.arrived:
+            return await asyncio.wait_for(self.arrived.wait_for(find), timeout)
+
+
+async def main_async():
+    ap = ArgumentParser(
+        description='Run a Stream Deck plugin against a fake Stream Deck, '
+                    'printing everything that it sends.')
+    ap.add_argument(
+        '--appear', action='append', default=[], metavar='ACTION',
+        help='tell the plugin that a key for ACTION has appeared; may be repeated')
+    ap.add_argument(
+        'argv', nargs='+', metavar='CMD',
+        help='command to start the plugin')
+
+    args = ap.parse_args()
+
+    sd = FakeStreamDeck()
+    await sd.start()
+    try:
+        await sd.launch(args.argv)
+        for i, action in enumerate(args.appear):
+            await sd.appear(action, f'CONTEXT{i + 1}')
+
+        seen = 0
+        while sd.proc.returncode is None:
+            try:
+                async with sd.arrived:
+                    await asyncio.wait_for(
+                        sd.arrived.wait_for(lambda: len(sd.received) > seen), 1)
+            except asyncio.TimeoutError:
+                continue
+
+            for t, msg in sd.received[seen:]:
+                # Don't fill the terminal with images
+                if 'image' in msg.get('payload', {}):
+                    msg['payload']['image'] = msg['payload']['image'][:40] + '...'
+                sys.stdout.write(f'{t:.3f} {json.dumps(msg)}\n')
+            seen = len(sd.received)
+    finally:
+        await sd.stop()
+
+
+def main():
+    asyncio.run(main_async())
+
+
+if __name__ == '__main__':
+    main()
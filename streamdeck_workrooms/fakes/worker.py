@@ -0,0 +1,228 @@
+'''
+Fake browser worker.
+
+This speaks the same newline-delimited JSON protocol as `bin/browser_worker.js`
+but keeps the call state in memory rather than talking to Chrome. Installing
+the observer starts a thread which pushes state changes to the daemon just as
+observe.js would. Run it with `python -m streamdeck_workrooms.fakes.worker`
+and point the daemon at it using its `--browser-worker` option.
+'''
+
+from ..types import ACTIONS
+
+from argparse import ArgumentParser
+import json
+import os.path
+import sys
+import threading
+import time
+from websockets.sync.client import connect
+
+
+def read_state(args, state):
+    '''
+    Return the current state, re-reading it from `--state-file` if set.
+    '''
+
+    if args.state_file and os.path.exists(args.state_file):
+        with open(args.state_file, encoding='utf-8') as f:
+            return f.read().strip()
+
+    return state
+
+
+def write_state(args, state):
+    if args.state_file:
+        with open(args.state_file, 'w', encoding='utf-8') as f:
+            f.write(state)
+
+
+def query_result(state):
+    '''
+    Return what query.js would for `state`.
+
+    The state is "NONE" if there is no call tab, "SURVEY" for a post-call
+    screen, or else a status per action, e.g. "ON OFF NONE ON". Actions with
+    status NONE have no button on the page.
+    '''
+
+    if state == 'NONE':
+        return 'NONE'
+
+    if state == 'SURVEY':
+        return json.dumps({'state': 'NONE', 'reason': 'SURVEY'})
+
+    actions = {}
+    for name, status in zip(ACTIONS, state.split(' ')):
+        if status == 'NONE':
+            actions[name] = {'state': 'UNKNOWN', 'reason': 'NOT_FOUND'}
+        elif status == 'UNKNOWN':
+            actions[name] = {'state': 'UNKNOWN', 'reason': 'UNRECOGNIZED'}
+        else:
+            actions[name] = {'state': status, 'reason': 'OK'}
+
+    return json.dumps({'state': 'CALL', 'actions': actions})
+
+
+def toggle(state, target):
+    '''
+    Return `state` with the status of `target` flipped.
+    '''
+
+    if state in ['NONE', 'SURVEY']:
+        return state
+
+    statuses = state.split(' ')
+    index = ACTIONS.index(target)
+    statuses[index] = {'ON': 'OFF', 'OFF': 'ON'}.get(statuses[index], statuses[index])
+
+    return ' '.join(statuses)
+
+
+def ensure(state, targets):
+    '''
+    Bring each action in `targets`, a list of {"action", "state"} steps, to
+    its state as ensure.js would.
+
+    Returns the new state and what ensure.js would return.
+    '''
+
+    result = {}
+    for step in targets:
+        name = step['action']
+        status = 'NONE'
+        if state not in ['NONE', 'SURVEY'] and name in ACTIONS:
+            status = state.split(' ')[ACTIONS.index(name)]
+
+        if status == 'NONE':
+            result[name] = 'NOT_FOUND'
+        elif status == 'UNKNOWN':
+            result[name] = 'UNRECOGNIZED'
+        elif status == step['state']:
+            result[name] = 'ALREADY'
+        else:
+            state = toggle(state, name)
+            result[name] = 'CLICKED'
+
+    return state, json.dumps(result)
+
+
+def observe(current, tab, port, token, heartbeat_ms):
+    '''
+    Push the state returned by `current()` to the daemon whenever it changes,
+    emulating observe.js, until the daemon goes away.
+    '''
+
+    try:
+        with connect(f'ws://127.0.0.1:{port}/') as ws:
+            last = None
+            last_time = 0
+
+            while True:
+                state = current()
+                now = time.time()
+
+                if state != last or now > last_time + heartbeat_ms / 1000:
+                    last = state
+                    last_time = now
+                    ws.send(json.dumps(
+                        {'token': token, 'tab': tab, 'state': query_result(last)}))
+
+                time.sleep(0.05)
+    except Exception:
+        pass
+
+
+def main():
+    ap = ArgumentParser(description='Fake browser worker.')
+    ap.add_argument(
+        '--state', default='NONE',
+        help='initial state, e.g. "ON OFF NONE ON"; see query_result() '
+             '(default: %(default)s)')
+    ap.add_argument(
+        '--state-file',
+        help='file holding the state; re-read on every query and '
+             'updated by toggles so that the state can be scripted externally')
+    ap.add_argument(
+        '--delay', type=float, default=0,
+        help='seconds to wait before answering each request')
+    ap.add_argument(
+        '--hang-file',
+        help='don\'t answer requests while this file exists, like a worker '
+             'stuck waiting on Chrome')
+    ap.add_argument(
+        '--error',
+        help='fail every request with this error message')
+    ap.add_argument(
+        '--exit-after', type=int, default=0,
+        help='exit without responding after this many requests')
+
+    args = ap.parse_args()
+
+    state = args.state
+    write_state(args, read_state(args, state))
+
+    # The state as of the last request, for observers, and the observers
+    # running, by port and token
+    shared = {'state': state}
+    observers = {}
+
+    for count, line in enumerate(sys.stdin, start=1):
+        if not line.strip():
+            continue
+
+        req = json.loads(line)
+
+        if args.exit_after and count >= args.exit_after:
+            sys.exit(1)
+
+        if args.delay:
+            time.sleep(args.delay)
+
+        while args.hang_file and os.path.exists(args.hang_file):
+            time.sleep(0.05)
+
+        state = read_state(args, state)
+        resp = {'id': req['id'], 'ok': True, 'result': None}
+
+        if args.error:
+            resp = {'id': req['id'], 'ok': False, 'error': args.error}
+        elif req['op'] == 'query':
+            # A single call tab, if any
+            if state != 'NONE':
+                resp['result'] = [{'tab': '1:1', 'result': query_result(state)}]
+            else:
+                resp['result'] = []
+        elif req['op'] == 'toggle':
+            if state != 'NONE':
+                state = toggle(state, req['target'])
+                write_state(args, state)
+                resp['result'] = True
+        elif req['op'] == 'ensure':
+            if state != 'NONE':
+                state, resp['result'] = ensure(state, req['targets'])
+                write_state(args, state)
+        elif req['op'] == 'observe':
+            if state != 'NONE':
+                key = (req['port'], req['token'])
+                resp['result'] = 'RUNNING'
+                if key not in observers or not observers[key].is_alive():
+                    observers[key] = threading.Thread(
+                        target=observe,
+                        args=(lambda: read_state(args, shared['state']),
+                              req['tab'], req['port'], req['token'],
+                              req['heartbeatMs']),
+                        daemon=True)
+                    observers[key].start()
+                    resp['result'] = 'INSTALLED'
+        else:
+            resp = {'id': req['id'], 'ok': False, 'error': f'unknown op {req["op"]}'}
+
+        shared['state'] = state
+
+        sys.stdout.write(json.dumps(resp) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
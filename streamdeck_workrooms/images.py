@@ -0,0 +1,207 @@
+'''
+Key images.
+
+Stream Deck wants images sent to keys as data URLs. Encoding these is cheap
+but not free, so they are loaded on first use and kept in a cache file on disk
+so that we don't redo this every time the plugin starts.
+'''
+
+import asyncio
+import base64
+import hashlib
+import json
+from logging import exception, info
+import mimetypes
+import os
+import os.path
+import tempfile
+
+
+# Width in pixels of the keys on each type of device, from the Stream Deck SDK.
+# Devices without key displays (e.g. Pedal) are missing.
+DEVICE_KEY_PIXELS = {
+    0: 72,   # Stream Deck
+    1: 80,   # Stream Deck Mini
+    2: 96,   # Stream Deck XL
+    3: 72,   # Stream Deck Mobile
+    7: 120,  # Stream Deck +
+}
+
+
+def data_url(path, content):
+    '''
+    Return a data URL for the file `path` holding `content`.
+    '''
+
+    mt, _ = mimetypes.guess_type(path)
+    assert mt is not None
+
+    return 'data:{};base64,{}'.format(mt, base64.b64encode(content).decode())
+
+
+def scale_for_info(info_json):
+    '''
+    Return the asset scale (1 or 2) to use for the devices described by the
+    `-info` argument passed to the plugin.
+
+    We use the @2x assets if any connected device has keys larger than the
+    1x assets, since Stream Deck scales images down better than up.
+    '''
+
+    try:
+        devices = json.loads(info_json or '{}').get('devices', [])
+    except ValueError:
+        exception("couldn't parse device info")
+        return 1
+
+    for d in devices:
+        if DEVICE_KEY_PIXELS.get(d.get('type'), 0) > DEVICE_KEY_PIXELS[0]:
+            return 2
+
+    return 1
+
+
+class ImageCache:
+    '''
+    Data URLs for the images shown on keys.
+
+    Images are read from `asset_dir` when first asked for, using the @2x
+    variant if `scale` is 2 and it exists. Encoded images are saved to
+    `cache_path`, if set, along with the size, modification time and hash of
+    the file that they came from, so that later runs can skip re-encoding
+    files that haven't changed. While `preload()` runs, the file is written
+    once at the end rather than after each image.
+    '''
+
+    def __init__(self, asset_dir=os.path.curdir, scale=1, cache_path=None):
+        self.asset_dir = asset_dir
+        self.scale = scale
+        self.cache_path = cache_path
+
+        # Data URLs by asset name
+        self.urls = {}
+
+        # Cache file contents, by file name, loaded on first use, and whether
+        # they've changed since they were last written
+        self.disk = None
+        self.dirty = False
+        self.preloading = False
+
+    def _load_disk(self):
+        self.disk = {}
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                self.disk = json.load(f)
+        except (OSError, ValueError):
+            exception("couldn't read image cache")
+
+    def save(self):
+        '''
+        Write the cache file, if anything has changed.
+        '''
+
+        if self.cache_path is None or not self.dirty:
+            return
+
+        # Write to a temporary file of our own first so that we never leave a
+        # partially written cache behind, even with several of us running
+        cache_dir = os.path.dirname(self.cache_path) or os.path.curdir
+        tmp_path = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with open(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.disk, f)
+            os.replace(tmp_path, self.cache_path)
+            self.dirty = False
+        except OSError:
+            exception("couldn't write image cache")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _path(self, name):
+        if self.scale == 2:
+            path = os.path.join(self.asset_dir, f'{name}@2x.png')
+            if os.path.exists(path):
+                return path
+
+        return os.path.join(self.asset_dir, f'{name}.png')
+
+    def load(self, name):
+        '''
+        Return the data URL for the asset `name`, e.g. "state_mic_on".
+        '''
+
+        url = self.urls.get(name)
+        if url is not None:
+            return url
+
+        if self.disk is None:
+            self._load_disk()
+
+        path = self._path(name)
+        fn = os.path.basename(path)
+        st = os.stat(path)
+        entry = self.disk.get(fn)
+
+        # If the file looks untouched, trust the cache without even reading
+        # it; otherwise only re-encode it if its content has changed
+        if entry is not None and \
+                entry.get('size') == st.st_size and \
+                entry.get('mtime_ns') == st.st_mtime_ns:
+            url = entry['url']
+        else:
+            with open(path, 'rb') as f:
+                content = f.read()
+            digest = hashlib.sha256(content).hexdigest()
+
+            if entry is not None and entry.get('sha256') == digest:
+                url = entry['url']
+            else:
+                info(f'encoding image {path}')
+                url = data_url(path, content)
+
+            self.disk[fn] = {
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                'sha256': digest,
+                'url': url,
+            }
+            self.dirty = True
+            if not self.preloading:
+                self.save()
+
+        self.urls[name] = url
+        return url
+
+    def get(self, action, status):
+        '''
+        Return the data URL for the image of `action` in `status`.
+        '''
+
+        return self.load(f'state_{action}_{status.lower()}')
+
+    async def preload(self, actions, statuses=('ON', 'OFF', 'NONE')):
+        '''
+        Load the image of each of `actions` in each of `statuses`, letting
+        other tasks run in between, e.g. while waiting on Stream Deck during
+        startup.
+        '''
+
+        self.preloading = True
+        try:
+            for action in actions:
+                for status in statuses:
+                    try:
+                        self.get(action, status)
+                    except OSError:
+                        exception("couldn't load image")
+
+                    await asyncio.sleep(0)
+        finally:
+            self.preloading = False
+
+        self.save()
@@ -0,0 +1,219 @@
+'''
+Write the log without holding up the event loop.
+
+Log records are handed to a background thread through a queue, so that
+logging from a coroutine only costs merging the arguments into the message;
+tracebacks, e.g. from `logging.exception()`, are formatted by the thread. Code
+which formats a traceback itself, e.g. with `traceback.format_exc()`, pays for
+that on the event loop, so use `exception()` instead. The thread
+collapses warnings and errors that keep repeating, e.g. the same failed query
+every second while the browser won't talk to us, into a "repeated N times"
+line every so often, rate limits each category of messages, and writes what's
+left to stderr or to a file which it rotates once it gets too big.
+'''
+
+from . import metrics
+from .ratelimit import TokenBucket
+
+from logging import WARNING, Formatter, StreamHandler, getLevelName, getLogger, \
+    makeLogRecord
+from logging.handlers import QueueHandler, RotatingFileHandler
+import atexit
+from collections import Counter
+import copy
+import queue
+import sys
+import threading
+import time
+
+
+# Size at which the log file is rotated, and how many old ones are kept
+MAX_BYTES = 5 * 1024 * 1024
+BACKUP_COUNT = 3
+
+# Records waiting to be written; more than this are dropped
+QUEUE_MAX_RECORDS = 10000
+
+# How often to report repeated and rate limited messages
+REPORT_SECONDS = 60
+
+# Token bucket limits for each category of messages, by logger name or else
+# module, as (messages per second, burst size); those not listed use
+# DEFAULT_RATE_LIMIT
+RATE_LIMITS = {
+    # asyncio's slow callback warnings in --profile mode
+    'asyncio': (1 / 3, 20),
+}
+DEFAULT_RATE_LIMIT = (2, 120)
+
+FORMAT = '{asctime} {message}'
+
+
+class _Enqueuer(QueueHandler):
+    def prepare(self, record):
+        # The arguments may change once we return, so merge them into the
+        # message now, but leave any traceback for the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_SUPPRESSED.inc(reason='queue_full')
+
+
+class Writer:
+    '''
+    Write log records that are queued by `handler` to `target`, a
+    `logging.Handler`, from a background thread.
+
+    Install `handler` on a logger and call `start()`; `stop()` writes out
+    anything that's still queued and is called at exit.
+    '''
+
+    def __init__(self, target, report_seconds=REPORT_SECONDS):
+        self.target = target
+        self.report_seconds = report_seconds
+        self.queue = queue.Queue(QUEUE_MAX_RECORDS)
+        self.handler = _Enqueuer(self.queue)
+        self.thread = None
+
+        # Warnings and errors that we've written recently, by (level,
+        # category, message, traceback), with a count of how many times each has been
+        # repeated since
+        self.repeats = {}
+
+        # Rate limits, and how many messages they've dropped since the last
+        # report, by category
+        self.buckets = {}
+        self.dropped = Counter()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run, name='log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        next_report = time.monotonic() + self.report_seconds
+        while True:
+            try:
+                record = self.queue.get(
+                    timeout=max(0, next_report - time.monotonic()))
+            except queue.Empty:
+                record = False
+
+            now = time.monotonic()
+            if record is None or now >= next_report:
+                self.report()
+                next_report = now + self.report_seconds
+
+            if record is None:
+                return
+
+            if record:
+                self.write(record, now)
+
+    def write(self, record, now):
+        category = record.name if record.name != 'root' else record.module
+
+        # Only the first of a run of identical warnings or errors is written
+        # right away
+        if record.levelno >= WARNING:
+            if record.exc_info and not record.exc_text:
+                formatter = self.target.formatter or Formatter()
+                record.exc_text = formatter.formatException(record.exc_info)
+
+            key = (record.levelno, category, record.getMessage(), record.exc_text)
+            if key in self.repeats:
+                self.repeats[key] += 1
+                metrics.LOG_SUPPRESSED.inc(reason='repeated')
+                return
+
+            self.repeats[key] = 0
+
+        bucket = self.buckets.get(category)
+        if bucket is None:
+            bucket = self.buckets[category] = TokenBucket(
+                *RATE_LIMITS.get(category, DEFAULT_RATE_LIMIT))
+
+        if not bucket.take(now):
+            self.dropped[category] += 1
+            metrics.LOG_SUPPRESSED.inc(reason='rate_limited')
+            return
+
+        self._emit(record)
+
+    def report(self):
+        '''
+        Write how many times each warning or error has been repeated, and how
+        many messages have been rate limited, since the last report.
+
+        A message that wasn't repeated is forgotten, so that it's written in
+        full the next time it comes up.
+        '''
+
+        repeats, self.repeats = self.repeats, {}
+        for key, count in repeats.items():
+            if not count:
+                continue
+
+            levelno, category, msg, _ = key
+            first = msg.split('\n', 1)[0]
+            self._emit_new(levelno, category, f'repeated {count} times: {first}')
+            self.repeats[key] = 0
+
+        dropped, self.dropped = self.dropped, Counter()
+        for category, count in dropped.items():
+            self._emit_new(
+                WARNING, category,
+                f'dropped {count} messages from {category}; over the rate limit')
+
+    def _emit_new(self, levelno, category, msg):
+        self._emit(makeLogRecord({
+            'name': category, 'levelno': levelno, 'msg': msg,
+            'levelname': getLevelName(levelno)}))
+
+    def _emit(self, record):
+        try:
+            self.target.handle(record)
+        except Exception:
+            self.target.handleError(record)
+
+
+def configure(level, path=None, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+    '''
+    Send everything logged at `level` or above through a `Writer`, which
+    writes it to stderr or, if `path` is not None, to that file, rotating it
+    when it gets bigger than `max_bytes`.
+
+    Returns the `Writer`, which has been started.
+    '''
+
+    if path is None:
+        target = StreamHandler(sys.stderr)
+    else:
+        target = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+
+    target.setFormatter(Formatter(FORMAT, style='{'))
+
+    writer = Writer(target)
+    writer.start()
+
+    root = getLogger()
+    root.setLevel(level)
+    root.addHandler(writer.handler)
+
+    return writer
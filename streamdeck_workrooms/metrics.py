@@ -0,0 +1,300 @@
+'''
+Local metrics.
+
+Counters and histograms are kept in memory and can be scraped from a
+localhost HTTP endpoint in the Prometheus text format, or written to the log
+by sending the daemon SIGUSR1. Unlike analytics, nothing here leaves the
+machine.
+
+See https://prometheus.io/docs/instrumenting/exposition_formats/.
+'''
+
+import asyncio
+from logging import ERROR, INFO, exception, info, log
+import signal
+import time
+
+
+# Upper bounds of the default histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# How often to check how late the event loop is running
+LOOP_LAG_INTERVAL_SECONDS = 0.5
+
+# When we started, as near as we can tell
+START_TIME = time.time()
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+
+    pairs = ','.join(
+        '{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    '''
+    A count of things that have happened, optionally broken down by the
+    values of `labels`.
+    '''
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+        # Without labels, there's exactly one value; report it even if zero
+        if not self.labels:
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield (self.name, _labels(self.labels, key), value)
+
+
+class Gauge(Counter):
+    '''
+    A value that may go up or down, optionally broken down by the values of
+    `labels`.
+    '''
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[tuple(labels[n] for n in self.labels)] = value
+
+
+class Histogram:
+    '''
+    The distribution of some quantity, e.g. a duration in seconds, optionally
+    broken down by the values of `labels`.
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+
+        # Per label values: [count in each bucket, count, sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        v = self.values.get(key)
+        if v is None:
+            v = self.values[key] = [[0] * len(self.buckets), 0, 0]
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                v[0][i] += 1
+                break
+        v[1] += 1
+        v[2] += value
+
+    def samples(self):
+        for key, (counts, count, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                yield (
+                    f'{self.name}_bucket',
+                    _labels(self.labels + ('le',), key + (bound,)),
+                    cumulative)
+            yield (
+                f'{self.name}_bucket',
+                _labels(self.labels + ('le',), key + ('+Inf',)),
+                count)
+            yield (f'{self.name}_count', _labels(self.labels, key), count)
+            yield (f'{self.name}_sum', _labels(self.labels, key), total)
+
+
+class Registry:
+    '''
+    A set of metrics.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''
+        Return all metrics in the Prometheus text format.
+        '''
+
+        lines = []
+        for m in self.metrics:
+            lines.append(f'# HELP {m.name} {m.help}')
+            lines.append(f'# TYPE {m.name} {m.kind}')
+            for name, labels, value in m.samples():
+                lines.append(f'{name}{labels} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+QUERY_SECONDS = REGISTRY.add(Histogram(
+    'streamdeck_workrooms_query_seconds',
+    'Time taken to query the browser'))
+QUERY_ERRORS = REGISTRY.add(Counter(
+    'streamdeck_workrooms_query_errors_total',
+    'Browser queries that failed, by error code', labels=['ec']))
+QUERY_STALE = REGISTRY.add(Counter(
+    'streamdeck_workrooms_query_stale_total',
+    'Browser queries whose results were discarded because something newer '
+    'had already been seen'))
+TOGGLE_SECONDS = REGISTRY.add(Histogram(
+    'streamdeck_workrooms_toggle_seconds',
+    'Time taken to toggle an action in the browser', labels=['action']))
+MACRO_SECONDS = REGISTRY.add(Histogram(
+    'streamdeck_workrooms_macro_seconds',
+    'Time taken to carry out all of the steps of a macro in the browser'))
+MACROS = REGISTRY.add(Counter(
+    'streamdeck_workrooms_macros_total',
+    'Macro key presses, by outcome', labels=['outcome']))
+PRESS_TO_STATE_SECONDS = REGISTRY.add(Histogram(
+    'streamdeck_workrooms_press_to_state_seconds',
+    'Time from a key press until the browser reports the new state',
+    labels=['action']))
+SEND_SECONDS = REGISTRY.add(Histogram(
+    'streamdeck_workrooms_send_seconds',
+    'Time taken to send a round of messages to Stream Deck'))
+SEND_MESSAGES = REGISTRY.add(Counter(
+    'streamdeck_workrooms_send_messages_total',
+    'Messages sent to Stream Deck'))
+SEND_BYTES = REGISTRY.add(Counter(
+    'streamdeck_workrooms_send_bytes_total',
+    'Bytes sent to Stream Deck'))
+SEND_SUPPRESSED = REGISTRY.add(Counter(
+    'streamdeck_workrooms_send_suppressed_total',
+    'Messages to Stream Deck dropped because the key already showed them'))
+SEND_DROPPED = REGISTRY.add(Counter(
+    'streamdeck_workrooms_send_dropped_total',
+    'Messages to Stream Deck dropped because we weren\'t connected'))
+RECONNECTS = REGISTRY.add(Counter(
+    'streamdeck_workrooms_reconnects_total',
+    'Times that we reconnected to Stream Deck after losing the connection'))
+DISCONNECTED_SECONDS = REGISTRY.add(Counter(
+    'streamdeck_workrooms_disconnected_seconds_total',
+    'Time spent reconnecting to Stream Deck after losing the connection'))
+LOG_SUPPRESSED = REGISTRY.add(Counter(
+    'streamdeck_workrooms_log_suppressed_total',
+    'Log messages that weren\'t written, by reason', labels=['reason']))
+LOOP_LAG_SECONDS = REGISTRY.add(Histogram(
+    'streamdeck_workrooms_loop_lag_seconds',
+    'How late the event loop was in waking up a sleeping task'))
+STARTUP_SECONDS = REGISTRY.add(Gauge(
+    'streamdeck_workrooms_startup_seconds',
+    'Time from starting until each phase of startup was done', labels=['phase']))
+
+
+class StartupTimer:
+    '''
+    Record when each phase of startup is done, relative to `START_TIME`.
+
+    Phases are only recorded the first time that they're done. Each is kept in
+    `STARTUP_SECONDS` and logged at `level`. Since some phases run at the
+    same time, the log also shows the time since the phase before it.
+    '''
+
+    def __init__(self, start=START_TIME, level=INFO):
+        self.start = start
+        self.last = start
+        self.level = level
+        self.done = set()
+
+    def phase(self, name):
+        if name in self.done:
+            return
+
+        now = time.time()
+        self.done.add(name)
+        STARTUP_SECONDS.set(now - self.start, phase=name)
+        log(self.level, f'startup: {name} after {now - self.start:.3f}s (+{now - self.last:.3f}s)')
+        self.last = now
+
+
+STARTUP = StartupTimer()
+
+
+async def monitor_loop_lag(interval=LOOP_LAG_INTERVAL_SECONDS):
+    '''
+    Coroutine to measure how late the event loop is running, e.g. because
+    something is blocking it.
+    '''
+
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0, time.monotonic() - start - interval))
+
+
+def dump():
+    '''
+    Write all metrics to the log, at a level that shows up by default.
+    '''
+
+    log(ERROR, 'metrics:\n' + REGISTRY.render())
+
+
+def install_signal_handler():
+    '''
+    Dump metrics to the log when we get SIGUSR1.
+    '''
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, dump)
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+
+        # Skip over the headers; we don't care about them
+        while (await reader.readline()).strip():
+            pass
+
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1] == b'/metrics':
+            status = '200 OK'
+            body = REGISTRY.render().encode('utf-8')
+        else:
+            status = '404 Not Found'
+            body = b'not found\n'
+
+        writer.write(
+            f'HTTP/1.0 {status}\r\n'
+            f'Content-Type: text/plain; version=0.0.4\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii') + body)
+        await writer.drain()
+    except Exception:
+        exception('serving metrics failed')
+    finally:
+        writer.close()
+
+
+async def serve(port):
+    '''
+    Serve metrics at http://127.0.0.1:`port`/metrics.
+    '''
+
+    server = await asyncio.start_server(_handle, '127.0.0.1', port)
+    info(f'serving metrics on port {port}')
+    return server
@@ -0,0 +1,195 @@
+'''
+Send messages to Stream Deck.
+
+Key images are sent as base64 data URLs and are by far the largest thing that
+we send, so each one is serialized only once and only sent to keys that aren't
+already showing it.
+'''
+
+from . import clock
+from . import metrics
+
+import asyncio
+import json
+from logging import info
+from websockets.exceptions import ConnectionClosed
+
+
+# Stands for what a key shows before we've sent it anything
+_DEFAULT = object()
+
+
+class Outbox:
+    '''
+    Messages waiting to be sent to Stream Deck over `ws`.
+
+    Messages are queued by `set_image()`, `set_title()` and `send()` and then
+    written out together by `flush()`, typically once per round of updates. A
+    setImage or setTitle which wouldn't change what the key is already
+    showing is dropped.
+
+    While we're not connected to Stream Deck, `ws` is None and messages are
+    dropped rather than sent. The last setImage and setTitle dropped for each
+    key are kept so that `resend()` can bring the key up to date once we're
+    back, if they would change what it was showing when we lost the
+    connection.
+
+    The `messages` and `bytes` attributes count what has been sent, and
+    `suppressed` counts messages that were dropped as redundant.
+    '''
+
+    def __init__(self, ws, images):
+        self.ws = ws
+        self.images = images
+
+        # Serialized setImage payloads, by (action, status), from the
+        # `images.ImageCache`
+        self.image_payloads = {}
+
+        # What we last sent to each context, by event
+        self.last_sent = {}
+
+        self.queue = []
+
+        # The (context, event, key, message, previous key) of each setImage
+        # and setTitle in `queue`
+        self.queued_keys = []
+
+        # The (key, message, key shown) of the last setImage and setTitle for
+        # each context that were dropped, by context and event, where "key
+        # shown" is what the context showed before the first of them
+        self.unsent = {}
+
+        self.messages = 0
+        self.bytes = 0
+        self.suppressed = 0
+
+    def _put(self, event, context, payload, key):
+        last = self.last_sent.setdefault(context, {})
+        if event in last and last[event] == key:
+            self.suppressed += 1
+            metrics.SEND_SUPPRESSED.inc()
+            return
+
+        msg = (
+            f'{{"event": "{event}", "context": {json.dumps(context)}, '
+            f'"payload": {payload}}}')
+
+        self.queued_keys.append((context, event, key, msg, last.get(event, _DEFAULT)))
+        self.queue.append(msg)
+        last[event] = key
+
+    def set_image(self, contexts, action, status):
+        '''
+        Show the image for `action` in `status` on each of `contexts`.
+        '''
+
+        key = (action, status)
+        payload = self.image_payloads.get(key)
+        if payload is None:
+            payload = self.image_payloads[key] = json.dumps(
+                {'image': self.images.get(action, status)})
+
+        for context in contexts:
+            self._put('setImage', context, payload, key)
+
+    def set_title(self, contexts, title):
+        '''
+        Show `title` on each of `contexts`.
+        '''
+
+        payload = json.dumps({'title': title})
+        for context in contexts:
+            self._put('setTitle', context, payload, title)
+
+    def send(self, msg):
+        '''
+        Queue an arbitrary message, which is never dropped.
+        '''
+
+        self.queue.append(json.dumps(msg))
+
+    def forget(self, context=None):
+        '''
+        Forget what we've sent to `context`, or to all contexts if None, e.g.
+        because the key has re-appeared and is showing its default image.
+        '''
+
+        if context is None:
+            self.last_sent.clear()
+            self.unsent.clear()
+        else:
+            self.last_sent.pop(context, None)
+            self.unsent.pop(context, None)
+
+    def resend(self):
+        '''
+        Queue the last setImage and setTitle for each key that were dropped
+        because we weren't connected, if nothing has been queued for the key
+        since.
+        '''
+
+        unsent, self.unsent = self.unsent, {}
+        for context, events in unsent.items():
+            for event, (key, msg, shown) in events.items():
+                if key != shown:
+                    self.queued_keys.append((context, event, key, msg, shown))
+                    self.queue.append(msg)
+
+    def _drop(self, msgs, keys):
+        # What each context showed before the first of these messages
+        prevs = {}
+
+        for context, event, key, msg, prev in keys:
+            prev = prevs.setdefault((context, event), prev)
+
+            # Something newer has been queued since; it'll take care of this
+            if self.last_sent.get(context, {}).get(event, _DEFAULT) != key:
+                continue
+
+            events = self.unsent.setdefault(context, {})
+            shown = events[event][2] if event in events else prev
+            events[event] = (key, msg, shown)
+
+        metrics.SEND_DROPPED.inc(len(msgs))
+
+    def _sent(self, keys):
+        for context, event, key, msg, prev in keys:
+            events = self.unsent.get(context)
+            if events and self.last_sent[context].get(event, _DEFAULT) == key:
+                events.pop(event, None)
+
+    async def flush(self):
+        '''
+        Send all queued messages.
+        '''
+
+        msgs, self.queue = self.queue, []
+        keys, self.queued_keys = self.queued_keys, []
+        if not msgs:
+            return
+
+        if self.ws is None:
+            self._drop(msgs, keys)
+            return
+
+        size = sum(len(m) for m in msgs)
+        self.messages += len(msgs)
+        self.bytes += size
+        metrics.SEND_MESSAGES.inc(len(msgs))
+        metrics.SEND_BYTES.inc(size)
+
+        # We can't tell which messages made it before the connection dropped;
+        # treat them all as lost
+        start = clock.time()
+        try:
+            await asyncio.gather(*[self.ws.send(m) for m in msgs])
+        except ConnectionClosed:
+            info(f'connection closed; dropping {len(msgs)} messages')
+            self._drop(msgs, keys)
+            return
+
+        metrics.SEND_SECONDS.observe(clock.time() - start)
+
+        if self.unsent:
+            self._sent(keys)
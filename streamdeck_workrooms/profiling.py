@@ -0,0 +1,231 @@
+'''
+Find out where the daemon's time goes.
+
+This is used by the daemon's `--profile` option, to look into reports of keys
+being slow to respond. It can
+
+  - have asyncio log callbacks that block the event loop for too long
+  - sample, from a background thread, which coroutine the event loop is
+    running, to see how busy each part of the daemon is
+  - profile everything with cProfile, writing the stats every so often to a
+    rotating set of files that can be read with `pstats`
+  - log rounds of work that take too long, with a breakdown of where the
+    time went; see `Tick`
+
+Reports are written to the log at a level that shows up by default.
+'''
+
+import asyncio
+from collections import Counter
+import inspect
+from logging import ERROR, WARNING, getLogger, log
+import os
+import os.path
+import selectors
+import sys
+import threading
+import time
+
+
+# How often to sample what the event loop is doing
+SAMPLE_SECONDS = 0.01
+
+# How often to report samples and write profile stats
+REPORT_SECONDS = 60
+
+# Number of profile stats files to keep
+STATS_FILES = 5
+
+
+def enable_slow_callbacks(loop, seconds):
+    '''
+    Have asyncio log each callback or task step that runs on `loop` for
+    longer than `seconds`.
+
+    This puts the loop in debug mode, which also makes it slower.
+    '''
+
+    loop.set_debug(True)
+    loop.slow_callback_duration = seconds
+
+    # These are logged as warnings, which we'd otherwise drop
+    getLogger('asyncio').setLevel(WARNING)
+
+
+class Sampler:
+    '''
+    Sample what the event loop is doing every `interval_seconds`.
+
+    This must be created on the thread running the event loop, which it
+    looks at from a thread of its own. Each sample is attributed to the
+    innermost of the functions in `coroutines`, which maps labels to lists
+    of coroutine functions, that's running. Failing that, it's attributed to
+    the coroutine that the current task was started with, or to "idle" if
+    the loop is waiting for something to happen.
+    '''
+
+    def __init__(self, coroutines, interval_seconds=SAMPLE_SECONDS):
+        self.labels = {
+            f.__code__: label for label, fs in coroutines.items() for f in fs}
+        self.interval_seconds = interval_seconds
+        self.thread_id = threading.get_ident()
+        self.counts = Counter()
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(
+            target=self._run, name='profiling-sampler', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[self.label(frame)] += 1
+
+    def label(self, frame):
+        '''
+        Return the label for a sample of the stack ending at `frame`.
+        '''
+
+        if frame.f_code.co_filename == selectors.__file__:
+            return 'idle'
+
+        label = 'other'
+        while frame is not None:
+            code = frame.f_code
+            if code in self.labels:
+                return self.labels[code]
+
+            if code.co_flags & inspect.CO_COROUTINE:
+                label = getattr(code, 'co_qualname', code.co_name)
+
+            frame = frame.f_back
+
+        return label
+
+    def report(self):
+        '''
+        Log how the samples since the last report break down, busiest first.
+        '''
+
+        counts, self.counts = self.counts, Counter()
+        total = sum(counts.values())
+        if not total:
+            return
+
+        busy = ', '.join(
+            f'{label} {100 * count / total:.1f}%'
+            for label, count in counts.most_common())
+        log(ERROR, f'profile: event loop over {total} samples: {busy}')
+
+
+class StatsWriter:
+    '''
+    Profile everything that runs on the current thread, writing the stats
+    for each period to `path` when `rotate()` is called.
+
+    The stats from earlier periods are kept in `path`.1, `path`.2 and so on,
+    up to `keep` files in all.
+    '''
+
+    def __init__(self, path, keep=STATS_FILES):
+        self.path = path
+        self.keep = keep
+        self.profile = None
+
+    def start(self):
+        import cProfile
+
+        os.makedirs(os.path.dirname(self.path) or os.path.curdir, exist_ok=True)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def rotate(self):
+        import cProfile
+
+        self.profile.disable()
+
+        for i in range(self.keep - 1, 0, -1):
+            src = self.path if i == 1 else f'{self.path}.{i - 1}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.path}.{i}')
+
+        self.profile.dump_stats(self.path)
+        log(ERROR, f'profile: wrote stats to {self.path}')
+
+        # Only one profiler can be enabled on a thread at a time, and
+        # disabling any of them turns profiling off, so this has to wait
+        # until we're done with the old one
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+
+class Tick:
+    '''
+    Time the parts of a round of work.
+
+    Call `mark(part)` at the end of each part, which adds the time since the
+    previous mark to that part. Time spent in functions wrapped with `wrap()`
+    is counted towards their own part instead, and time spent elsewhere, e.g.
+    waiting on a subprocess, can be added with `add()`.
+    '''
+
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.nested = 0
+        self.parts = {}
+
+    def add(self, part, seconds):
+        self.parts[part] = self.parts.get(part, 0) + seconds
+
+    def mark(self, part):
+        now = time.perf_counter()
+        self.add(part, now - self.last - self.nested)
+        self.last = now
+        self.nested = 0
+
+    def wrap(self, part, f):
+        '''
+        Return coroutine function `f` wrapped so that its time goes to `part`.
+        '''
+
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                self.add(part, seconds)
+                self.nested += seconds
+
+        return timed
+
+    def total(self):
+        return sum(self.parts.values())
+
+    def check(self, what, budget):
+        '''
+        Log the breakdown if the round took longer than `budget` seconds.
+        '''
+
+        total = self.total()
+        if total <= budget:
+            return
+
+        parts = ', '.join(f'{p} {s:.3f}s' for p, s in self.parts.items())
+        log(ERROR, f'profile: slow {what}: {total:.3f}s ({parts})')
+
+
+async def report(sampler, stats, interval_seconds=REPORT_SECONDS):
+    '''
+    Coroutine to report samples from `sampler` and rotate `stats`, a
+    `StatsWriter`, every `interval_seconds`.
+    '''
+
+    while True:
+        await asyncio.sleep(interval_seconds)
+        sampler.report()
+        stats.rotate()
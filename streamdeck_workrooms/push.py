@@ -0,0 +1,105 @@
+'''
+Receive state updates pushed from the browser.
+
+The daemon injects `bin/observe.js` into the call tab, which registers a
+MutationObserver and sends the result of query.js to a WebSocket listener in
+this process whenever it changes. This lets us skip polling the browser
+altogether while the observer is alive.
+'''
+
+from . import clock
+
+import asyncio
+import json
+from logging import info
+import secrets
+import websockets
+
+
+# How often the observer re-sends its last state so that we know it's alive
+HEARTBEAT_SECONDS = 2
+
+# Consider the observer gone if we haven't heard from it in this long
+SILENCE_SECONDS = 5
+
+
+class PushListener:
+    '''
+    WebSocket listener for state updates pushed by the observer.
+
+    Only messages carrying our randomly generated `token` are accepted, since
+    any web page can open a WebSocket to localhost. Observers may be running
+    in several call tabs; only state from the one identified by `tab` is
+    passed on.
+    '''
+
+    def __init__(self):
+        self.token = secrets.token_hex(16)
+        self.port = None
+        self.server = None
+        self.queue = asyncio.Queue()
+        self.tab = None
+
+        # When we last heard from the observer in each tab
+        self.last_times = {}
+
+    async def start(self):
+        '''
+        Start listening on an ephemeral port on the loopback interface.
+        '''
+
+        self.server = await websockets.serve(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        info(f'listening for pushed browser state on port {self.port}')
+
+    async def _handle(self, ws):
+        tab = None
+
+        try:
+            async for msg in ws:
+                try:
+                    jo = json.loads(msg)
+                except ValueError:
+                    continue
+
+                if not isinstance(jo, dict) or jo.get('token') != self.token:
+                    continue
+
+                tab = jo.get('tab')
+                self.last_times[tab] = clock.time()
+                if tab == self.tab and jo.get('state') is not None:
+                    self.queue.put_nowait(jo['state'])
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            # The page went away or was reloaded. Stop waiting on it and wake
+            # up anyone in get() so that they poll instead.
+            if tab is not None:
+                self.last_times.pop(tab, None)
+                if tab == self.tab:
+                    self.queue.put_nowait(None)
+
+    def is_alive(self, now):
+        '''
+        Have we heard from the observer in `tab` recently?
+        '''
+
+        return now - self.last_times.get(self.tab, 0) < SILENCE_SECONDS
+
+    async def get(self, timeout):
+        '''
+        Wait up to `timeout` seconds for a pushed state and return it.
+
+        If several states have queued up, only the most recent one is returned.
+        Returns None on timeout or if the observer disconnected.
+        '''
+
+        try:
+            state = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        while not self.queue.empty():
+            state = self.queue.get_nowait()
+
+        return state
@@ -0,0 +1,30 @@
+'''
+Rate limiting, shared by analytics and logging.
+'''
+
+
+class TokenBucket:
+    '''
+    Allow up to `burst` hits at once, refilling at `rate` hits per second.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = None
+
+    def take(self, now):
+        '''
+        Take a token, returning False if there are none left.
+        '''
+
+        if self.time is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
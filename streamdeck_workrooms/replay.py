@@ -0,0 +1,336 @@
+'''
+Record and replay what the daemon sees.
+
+When started with `--record`, the daemon writes everything that drives its
+behavior to a file, one JSON object per line: each message from Stream Deck,
+each state that it got from the browser (or the failure to get one), and the
+outcome of each toggle and macro, all with the time that they happened.
+
+Running `python -m streamdeck_workrooms.replay RECORDING` feeds a recording
+back through the same code on a `clock.VirtualEventLoop`, so that hours of
+activity take seconds, and writes the messages that the daemon would have sent
+to Stream Deck, one JSON object per line, e.g. to compare them before and
+after a change. Key images are shown by name rather than as data URLs.
+'''
+
+from . import browser
+from . import clock
+from . import streamdeck
+from .outbox import Outbox
+from .settings import Settings
+from .types import new_action_metadata
+
+from argparse import ArgumentParser
+import asyncio
+from bisect import bisect_right
+import json
+from logging import ERROR, basicConfig, info
+import sys
+import time
+
+
+# Record format version, written to the header of each recording
+VERSION = 1
+
+# How long to keep running after the last record, so that grace periods and
+# confirmations which it started can play out
+TAIL_SECONDS = 10
+
+# How much earlier than a recorded poll a replayed one may start and still be
+# answered by it
+POLL_SLACK_SECONDS = 0.05
+
+
+class Recorder:
+    '''
+    Write records to the file `path`.
+
+    The first record is a header holding `options`, the options that the
+    daemon was started with that affect its behavior.
+    '''
+
+    def __init__(self, path, options):
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+        self.record('start', version=VERSION, options=options)
+        info(f'recording to {path}')
+
+    def record(self, kind, error=None, **kwargs):
+        '''
+        Write a record of type `kind` holding `kwargs`, and `error`, if it is
+        not None, which is an exception.
+        '''
+
+        rec = dict(kwargs, t=clock.time(), type=kind)
+        if error is not None:
+            rec['error'] = {'ec': getattr(error, 'ec', None), 'msg': str(error)}
+
+        self.file.write(json.dumps(rec) + '\n')
+        self.file.flush()
+
+
+def load(path):
+    '''
+    Read a recording, returning its header and the rest of its records.
+    '''
+
+    with open(path, encoding='utf-8') as f:
+        records = [json.loads(l) for l in f if l.strip()]
+
+    if not records or records[0]['type'] != 'start':
+        raise ValueError(f'{path} is not a recording')
+
+    header = records[0]
+    if header['version'] != VERSION:
+        raise ValueError(f'{path} has unsupported version {header["version"]}')
+
+    return header, records[1:]
+
+
+def _raise(err):
+    if err['ec'] is not None:
+        raise browser.BackendError(err['ec'], err['msg'])
+
+    raise RuntimeError(err['msg'])
+
+
+class ReplayBackend:
+    '''
+    Browser backend that answers from recorded `records`.
+
+    A query made while a recorded poll was in flight, or just before one
+    started, is answered by that poll once it finished, so polls take as long
+    as they did when recorded; this includes the first poll, which we wait
+    for rather than making up an answer. Other queries, e.g. those that stand
+    in for pushed states, return the last state recorded at or before the
+    current time straight away. Toggles of each action succeed, fail or find
+    no call tab in the order that they did when recorded, and macros get the
+    results that they got, in order.
+    '''
+
+    def __init__(self, records):
+        states = [r for r in records if r['type'] == 'browser']
+        self.times = [r['t'] for r in states]
+        self.states = states
+
+        # Recorded polls in the order that they finished, and the next one
+        # that may answer a query
+        self.polls = [r for r in states if r.get('start') is not None]
+        self.next_poll = 0
+
+        self.toggles = {}
+        for r in records:
+            if r['type'] == 'toggle':
+                self.toggles.setdefault(r['action'], []).append(r)
+
+        self.ensures = [r for r in records if r['type'] == 'ensure']
+
+        self.tabs = []
+        self.tab = None
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def _poll_at(self, now):
+        '''
+        Return the recorded poll that was in flight at `now`, or started just
+        after it, or None.
+        '''
+
+        while self.next_poll < len(self.polls) and \
+                self.polls[self.next_poll]['t'] < now:
+            self.next_poll += 1
+
+        if self.next_poll == len(self.polls):
+            return None
+
+        poll = self.polls[self.next_poll]
+        if poll['start'] > now + POLL_SLACK_SECONDS:
+            return None
+
+        self.next_poll += 1
+        return poll
+
+    async def query(self):
+        now = clock.time()
+        state = self._poll_at(now)
+
+        if state is None:
+            i = bisect_right(self.times, now)
+            if i > 0:
+                state = self.states[i - 1]
+            elif self.states:
+                # We're still starting up; see what the browser said first
+                state = self.states[0]
+            else:
+                return 'NONE'
+
+        await asyncio.sleep(max(0, state['t'] - now))
+
+        if 'error' in state:
+            _raise(state['error'])
+
+        return state['result']
+
+    async def toggle(self, target):
+        outcomes = self.toggles.get(target)
+        r = outcomes.pop(0) if outcomes else {}
+        if 'error' in r:
+            _raise(r['error'])
+
+        return r.get('toggled', True)
+
+    async def ensure(self, targets):
+        if not self.ensures:
+            return None
+
+        r = self.ensures.pop(0)
+        if 'error' in r:
+            _raise(r['error'])
+
+        return r['result']
+
+    async def observe(self, port, token, heartbeat_seconds):
+        return None
+
+
+class ImageNames:
+    '''
+    Stand-in for `images.ImageCache` which names images rather than loading
+    them.
+    '''
+
+    def get(self, action, status):
+        return f'{action}:{status}'
+
+
+class Transcript:
+    '''
+    Stand-in for the WebSocket to Stream Deck which writes each message that
+    is sent to `out`, along with the time since `start`.
+    '''
+
+    def __init__(self, out, start):
+        self.out = out
+        self.start = start
+        self.messages = 0
+
+    async def send(self, msg):
+        jo = dict(t=round(clock.time() - self.start, 3), **json.loads(msg))
+        self.out.write(json.dumps(jo) + '\n')
+        self.messages += 1
+
+
+async def _ignore(**kwargs):
+    pass
+
+
+async def replay(header, records, out, tail_seconds=TAIL_SECONDS):
+    '''
+    Replay `records`, writing what would have been sent to Stream Deck to
+    `out`. This must run on a `clock.VirtualEventLoop` started at the time
+    of the `header`.
+
+    Returns the number of messages written.
+    '''
+
+    options = header['options']
+
+    action_metadata = new_action_metadata()
+    toggle_queues = streamdeck.new_toggle_queues(options['toggle_window'])
+
+    scheduler = browser.PollScheduler(
+        fast_seconds=options['poll_fast'],
+        normal_seconds=options['poll_normal'],
+        idle_max_seconds=options['poll_idle_max'])
+
+    # Changes to the global settings are in the recording as messages from
+    # Stream Deck
+    settings = Settings(scheduler, defaults={
+        'poll_fast': options['poll_fast'],
+        'poll_normal': options['poll_normal'],
+        'poll_idle_max': options['poll_idle_max'],
+    })
+
+    backend = ReplayBackend(records)
+    transcript = Transcript(out, header['t'])
+    outbox = Outbox(transcript, ImageNames())
+
+    # Observers can't be replayed; pushed states are answered from polls
+    # instead, which we make happen at the same time
+    listener = asyncio.create_task(browser.listen(
+        outbox, _ignore, action_metadata, backend, None, scheduler))
+
+    prev = None
+    for r in records:
+        await asyncio.sleep(max(0, r['t'] - clock.time()))
+
+        if r['type'] == 'streamdeck':
+            await streamdeck.process_message(
+                r['msg'], clock.time(), outbox, _ignore, action_metadata,
+                toggle_queues, backend, scheduler,
+                optimistic=options['optimistic'], settings=settings)
+            await outbox.flush()
+
+        # Look at each new pushed state as soon as it appears; polls happen
+        # by themselves
+        elif r['type'] == 'browser':
+            state = (r.get('result'), r.get('error'))
+            if state != prev and r.get('start') is None:
+                scheduler.wake()
+            prev = state
+
+    await asyncio.sleep(tail_seconds)
+
+    listener.cancel()
+    try:
+        await listener
+    except asyncio.CancelledError:
+        pass
+
+    return transcript.messages
+
+
+def main():
+    ap = ArgumentParser(
+        description='Replay a recording made with the daemon\'s --record '
+                    'option, writing the messages that it would send to '
+                    'Stream Deck to stdout.')
+    ap.add_argument(
+        '-v', action='count', default=0,
+        help='increase logging verbosity; can be used multiple times')
+    ap.add_argument(
+        '--tail', type=float, default=TAIL_SECONDS, metavar='SECONDS',
+        help='how long to keep going after the last record (default: %(default)s)')
+    ap.add_argument(
+        'recording',
+        help='file written by the daemon\'s --record option')
+
+    args = ap.parse_args()
+
+    basicConfig(
+        style='{', format='{message}', level=ERROR - args.v * 10,
+        stream=sys.stderr)
+
+    header, records = load(args.recording)
+
+    loop = clock.VirtualEventLoop(header['t'])
+    start = time.time()
+    try:
+        messages = loop.run_until_complete(
+            replay(header, records, sys.stdout, tail_seconds=args.tail))
+    finally:
+        loop.close()
+
+    elapsed = time.time() - start
+    recorded = loop.time()
+    sys.stderr.write(
+        f'replayed {recorded:.1f}s in {elapsed:.2f}s '
+        f'({recorded / max(elapsed, 1e-6):.0f}x); {messages} messages\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+'''
+Settings that users can change while we're running.
+
+These are kept in the plugin's global settings in Stream Deck, alongside the
+client ID that we use for analytics, and are edited in the Property Inspector
+(`propertyinspector/settings.html`). Stream Deck sends us the global settings
+with didReceiveGlobalSettings when we start and whenever they change, and
+they take effect right away. That way, e.g. a laptop on battery can poll less
+often than a desk machine.
+'''
+
+from collections import namedtuple
+from logging import error, info
+
+
+# A setting, which is a number between `min` and `max`, or a bool
+Setting = namedtuple('Setting', ['type', 'default', 'min', 'max', 'help'], defaults=[None, None, ''])
+
+# Every setting, by the name that it's kept under in the global settings.
+# Keep this in sync with the Property Inspector.
+SCHEMA = {
+    'poll_fast': Setting(
+        float, 0.1, 0.05, 5,
+        'Seconds between polls of the browser while waiting for a toggle to '
+        'take effect'),
+    'poll_normal': Setting(
+        float, 1, 0.1, 60,
+        'Seconds between polls of the browser during a call'),
+    'poll_idle_max': Setting(
+        float, 8, 0.1, 300,
+        'Most seconds between polls of the browser when there is no call'),
+    'error_grace_period': Setting(
+        float, 5, 0, 60,
+        'Seconds that an error must last before it is shown on a key'),
+    'analytics_enabled': Setting(
+        bool, True, help='Whether to send anonymized analytics'),
+    'query_sample_rate': Setting(
+        float, 0.01, 0, 1,
+        'Fraction of browser query timings that are sent to analytics'),
+}
+
+# Poll intervals which must not decrease from one to the next; otherwise e.g.
+# backing off while idle would poll faster rather than slower
+POLL_ORDER = ['poll_fast', 'poll_normal', 'poll_idle_max']
+
+
+def validate(raw, defaults, previous=None):
+    '''
+    Return the value of each setting in `raw`, the global settings from
+    Stream Deck, and a list of problems with them.
+
+    Settings that are missing or invalid take their value from `defaults`.
+    Numbers may be given as strings, as they are by HTML forms. If the poll
+    intervals would be out of `POLL_ORDER`, all of them keep their value from
+    `previous`, or else `defaults`.
+    '''
+
+    values = dict(defaults)
+    problems = []
+
+    for name, setting in SCHEMA.items():
+        if name not in raw:
+            continue
+
+        value = raw[name]
+        if setting.type is bool:
+            if not isinstance(value, bool):
+                problems.append(f'{name}: {value!r} is not true or false')
+                continue
+        else:
+            try:
+                if isinstance(value, bool):
+                    raise ValueError()
+                value = setting.type(value)
+            except (TypeError, ValueError):
+                problems.append(f'{name}: {value!r} is not a number')
+                continue
+
+            if not setting.min <= value <= setting.max:
+                problems.append(
+                    f'{name}: {value!r} is not between {setting.min} and '
+                    f'{setting.max}')
+                continue
+
+        values[name] = value
+
+    polls = [values[name] for name in POLL_ORDER]
+    if polls != sorted(polls):
+        problems.append(
+            ' <= '.join(POLL_ORDER) + ' does not hold for ' +
+            ', '.join(f'{name}={values[name]!r}' for name in POLL_ORDER))
+        for name in POLL_ORDER:
+            values[name] = (previous or defaults)[name]
+
+    return values, problems
+
+
+class Settings:
+    '''
+    The current value of each setting in `SCHEMA`, which are applied to
+    `scheduler`, a `browser.PollScheduler`, and `policy`, an
+    `analytics.Policy`, if not None.
+
+    Settings that aren't in the global settings take their value from
+    `defaults`, e.g. from the command line, or else from `SCHEMA`.
+    '''
+
+    def __init__(self, scheduler, policy=None, defaults=None):
+        self.scheduler = scheduler
+        self.policy = policy
+
+        self.defaults = {name: s.default for name, s in SCHEMA.items()}
+        self.defaults.update(defaults or {})
+
+        self.values = dict(self.defaults)
+        self._apply()
+
+    def update(self, raw):
+        '''
+        Apply `raw`, the global settings from Stream Deck, returning a dict
+        of the settings which changed.
+        '''
+
+        values, problems = validate(raw, self.defaults, self.values)
+        for p in problems:
+            error(f'ignoring setting {p}')
+
+        changed = {
+            name: value for name, value in values.items()
+            if value != self.values[name]}
+        if not changed:
+            return changed
+
+        info(f'settings changed: {changed}')
+        self.values = values
+        self._apply()
+
+        return changed
+
+    def _apply(self):
+        values = self.values
+
+        scheduler = self.scheduler
+        scheduler.fast_seconds = values['poll_fast']
+        scheduler.normal_seconds = values['poll_normal']
+        scheduler.idle_max_seconds = values['poll_idle_max']
+        scheduler.grace_seconds = values['error_grace_period']
+
+        # Start backing off again from the new normal interval
+        scheduler.idle_seconds = None
+
+        if self.policy is not None:
+            self.policy.enabled = values['analytics_enabled']
+            self.policy.sample_rates = dict(
+                self.policy.sample_rates,
+                **{'timing:Query': values['query_sample_rate']})
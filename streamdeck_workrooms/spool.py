@@ -0,0 +1,248 @@
+'''
+Append-only on-disk spool of timestamped records.
+
+Each record is written as a frame consisting of a header holding the length
+and CRC-32 of its payload, followed by the payload, which is the JSON encoding
+of [sequence number, time, value]. If we crash part way through writing a
+frame, the damaged frame and anything after it are discarded the next time
+the spool is opened.
+
+Writing, and syncing what was written to disk, happens in a thread from the
+event loop's default executor so that a slow disk doesn't hold up the loop.
+'''
+
+from collections import deque, namedtuple
+import asyncio
+import json
+from logging import error, exception, info
+import os
+import os.path
+import struct
+import time
+import zlib
+
+
+# Frame header: payload length and CRC-32, both big-endian
+HEADER = struct.Struct('>II')
+
+# A record in the spool. The sequence number identifies it even once it has
+# been copied, or read back from disk.
+Record = namedtuple('Record', ['seq', 'time', 'value'])
+
+
+def decode_frames(data):
+    '''
+    Decode the frames in `data`, returning a list of (`Record`, frame) tuples
+    and the number of bytes of `data` which held valid frames.
+    '''
+
+    records = []
+    offset = 0
+
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        payload = data[start:start + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            break
+
+        try:
+            seq, t, value = json.loads(payload)
+        except ValueError:
+            break
+
+        records.append((Record(seq, t, value), data[offset:start + length]))
+        offset = start + length
+
+    return records, offset
+
+
+def encode_frame(record):
+    payload = json.dumps(list(record)).encode('utf-8')
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _rewrite(path, frames):
+    '''
+    Replace the file `path` with one holding `frames`, syncing it to disk.
+    '''
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(frames))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _append(path, frames):
+    '''
+    Append `frames` to the file `path`, syncing it to disk.
+    '''
+
+    with open(path, 'ab') as f:
+        f.write(b''.join(frames))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Spool:
+    '''
+    Bounded spool of records kept in the file `path`.
+
+    The spool holds at most `max_bytes` of frames; adding more drops the
+    oldest records. Records older than `max_age_seconds` are dropped too. A
+    copy of the records is kept in memory, so reading doesn't touch the disk.
+    '''
+
+    def __init__(self, path, max_bytes=1024 * 1024, max_age_seconds=4 * 60 * 60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+
+        # (Record, frame) tuples, oldest first
+        self.records = deque()
+        self.size = 0
+        self.dropped = 0
+        self.next_seq = 0
+
+        # Whether the file holds records that we've since dropped, and must
+        # be rewritten
+        self.stale = False
+
+        # Held while writing, so that writes reach the file in order
+        self.lock = asyncio.Lock()
+
+        try:
+            os.makedirs(os.path.dirname(path) or os.path.curdir, exist_ok=True)
+        except OSError:
+            exception("couldn't create spool directory")
+
+        self._load()
+
+    def __len__(self):
+        return len(self.records)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            exception("couldn't read spool")
+            return
+
+        records, valid = decode_frames(data)
+        self.records.extend(records)
+        self.size = valid
+        self.next_seq = max((r.seq for r, _ in records), default=-1) + 1
+
+        if valid != len(data):
+            error(f'discarding {len(data) - valid} damaged bytes at the end of {self.path}')
+            self.stale = True
+
+        info(f'loaded {len(records)} records from {self.path}')
+        self._expire(time.time())
+
+        # We haven't started running yet, so there's nothing to hold up
+        if self.stale:
+            self.stale = not self._try(_rewrite, [f for _, f in self.records])
+
+    def _try(self, write, frames):
+        try:
+            write(self.path, frames)
+            return True
+        except OSError:
+            exception("couldn't write spool")
+            return False
+
+    async def _write(self, write, frames):
+        '''
+        Call `write(self.path, frames)` in the default executor, after any
+        writes that are already waiting. Returns whether it worked.
+        '''
+
+        async with self.lock:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._try, write, frames)
+
+    async def _rewrite(self):
+        '''
+        Rewrite the file to hold exactly our records.
+        '''
+
+        self.stale = False
+        if not await self._write(_rewrite, [f for _, f in self.records]):
+            self.stale = True
+
+    def _expire(self, now):
+        '''
+        Drop records that are too old or don't fit, oldest first.
+        '''
+
+        # Records aren't necessarily in time order, e.g. if a batch failed
+        # after a later one was spooled, so look at all of them
+        dropped = 0
+        cutoff = now - self.max_age_seconds
+        if any(r.time < cutoff for r, _ in self.records):
+            fresh = deque((r, f) for r, f in self.records if r.time >= cutoff)
+            dropped = len(self.records) - len(fresh)
+            self.records = fresh
+            self.size = sum(len(f) for _, f in fresh)
+
+        while self.records and self.size > self.max_bytes:
+            self.size -= len(self.records.popleft()[1])
+            dropped += 1
+
+        if dropped:
+            info(f'dropped {dropped} records from {self.path}')
+            self.dropped += dropped
+            self.stale = True
+
+    async def append(self, items):
+        '''
+        Add the (time, value) tuples in `items` to the end of the spool.
+        '''
+
+        added = []
+        for t, value in items:
+            record = Record(self.next_seq, t, value)
+            self.next_seq += 1
+            added.append((record, encode_frame(record)))
+
+        self.records.extend(added)
+        self.size += sum(len(f) for _, f in added)
+        self._expire(time.time())
+
+        # Making room means rewriting the file anyway
+        if self.stale:
+            await self._rewrite()
+            return
+
+        if not await self._write(_append, [f for _, f in added]):
+            # Don't leave a partial frame in the way of later appends
+            await self._rewrite()
+
+    def peek(self, n):
+        '''
+        Return up to `n` of the oldest `Record`s.
+        '''
+
+        self._expire(time.time())
+        return [r for r, _ in list(self.records)[:n]]
+
+    async def consume(self, records):
+        '''
+        Remove `records`, as returned by `peek()`, e.g. once they've been
+        delivered. Any that have since been dropped are skipped.
+        '''
+
+        seqs = set(r.seq for r in records)
+        before = len(self.records)
+        self.records = deque((r, f) for r, f in self.records if r.seq not in seqs)
+        self.size = sum(len(f) for _, f in self.records)
+
+        if len(self.records) != before or self.stale:
+            await self._rewrite()
@@ -4,149 +4,459 @@ Communicate with Stream Deck.
 See https://developer.elgato.com/documentation/stream-deck/sdk.
 '''
 
-from .types import ActionState
+from . import clock
+from . import engine
+from . import metrics
+from .browser import BackendError
+from .types import ACTIONS, DEFAULT_MACRO_STEPS, MACRO
 
 import asyncio
-import base64
+from functools import partial
 import json
-from logging import error, info
-import mimetypes
-import os.path
-import time
-import traceback
+from logging import error, exception, info
+import websockets
+from websockets.exceptions import WebSocketException
 
-async def process_message(msg, now, ws, analytics_collect, action_metadata):
+
+# Bounds on the interval between attempts to reconnect to Stream Deck
+RECONNECT_MIN_SECONDS = 0.1
+RECONNECT_MAX_SECONDS = 5
+
+# How long to keep trying to connect before giving up. Stream Deck starts us
+# again when it comes back, so there's no point in lingering once it's gone.
+RECONNECT_GIVE_UP_SECONDS = 60
+
+
+async def process_message(msg, now, outbox, analytics_collect, action_metadata, toggle_queues, backend, scheduler, optimistic=False, recorder=None, settings=None):
     '''
-    Process a single Stream Deck message.
+    Process a single Stream Deck message, queueing any replies in `outbox`.
+
+    Toggles are handed to the `ToggleQueue` for the action in
+    `toggle_queues`, and macros to the `MacroQueue` for `MACRO`. If
+    `optimistic` is True, keys are updated as soon as a toggle succeeds rather
+    than waiting for the browser to report the new state. If `recorder` is
+    not None, the outcome of any toggle or macro is written to it. Changes to
+    the global settings are applied to `settings`, a `settings.Settings`, if
+    it's not None.
     '''
 
+    event = msg.get('event')
+
+    # The global settings have changed, e.g. in the Property Inspector. Poll
+    # right away so that new intervals take effect now rather than after
+    # the old one.
+    if event == 'didReceiveGlobalSettings':
+        if settings is not None and settings.update(msg['payload']['settings']):
+            if scheduler is not None:
+                scheduler.wake()
+
+        return
+
     # Some global messages like 'deviceDidConnect' don't have an action. At this
     # point, we don't care about any of them so just ignore
     if 'action' not in msg:
         return
 
-    event = msg.get('event')
     action = msg['action'].split('.')[-1]
+
+    # Macro keys don't show any state of their own, so all that we care about
+    # is them being pressed. Their steps come with the press, in the key's
+    # settings.
+    if action == MACRO:
+        if event == 'keyUp':
+            steps = parse_steps(msg.get('payload', {}).get('settings', {}))
+            toggle_queues[MACRO].press(
+                now,
+                partial(
+                    macro, msg['context'], steps, outbox, analytics_collect,
+                    action_metadata, backend, scheduler, optimistic, recorder))
+
+        return
+
     data = action_metadata[action]
 
     # This messages signifies that an instance of the given action is going to
     # appear on the screen. Stash away its context so that we can use it
     # communicate with the Stream Deck later.
     #
-    # XXX: This assumes that we only have one action of a given type
-    #      active at once. I don't think that is actually the case.
+    # If we don't know the state of the action yet, look at the browser now
+    # rather than leaving the key blank until the next poll.
     if event == 'willAppear':
-        data['context'] = msg['context']
+        action_metadata[action], effects = engine.appear(action, data, msg['context'])
+        await engine.perform(effects, outbox, analytics_collect)
+
+        if data.current.status is None and scheduler is not None:
+            scheduler.wake()
+
         return
 
     # This message signifies that an instance of the given action is going to be
-    # removed from the screen. Clear out our metadata so that things will
-    # initialize correctly the next time we get a willAppear message.
-    #
-    # XXX: As with 'willAppear', this assumes that there is a single instance of
-    #      this action.
+    # removed from the screen. Forget its context.
     if event == 'willDisappear':
-        data['context'] = None
-        data['current'] = ActionState()
-        data['next'] = ActionState()
-        data['next_time'] = now
-        data['action_time'] = None
+        action_metadata[action], effects = engine.disappear(action, data, msg['context'], now)
+        await engine.perform(effects, outbox, analytics_collect)
         return
 
     if event == 'keyUp':
-        context = data['context']
-        state = data['current']
+        effects = engine.press(action, data, msg['context'])
+        await engine.perform(effects, outbox, analytics_collect)
 
-        # We have no idea what the current state is; do nothing
-        if state.status is None:
-            return
+        # Hand the toggle off to the queue for this action, which serializes
+        # and coalesces them. This returns immediately so that a slow browser
+        # doesn't hold up processing of other messages.
+        if engine.Toggle(action) in effects:
+            toggle_queues[action].press(
+                now,
+                partial(
+                    toggle, action, outbox, analytics_collect, action_metadata,
+                    backend, scheduler, optimistic, recorder))
 
-        # We haven't been appeared, so we have no context; do nothing
-        if context is None:
-            return
 
-        # We have an error; direct the user to the help page for this error
-        if state.error is not None:
-            info('opening up the help page for error {}'.format(state.error))
-            await ws.send(json.dumps({
-                'event': 'openUrl',
-                'context': context,
-                'payload': {
-                    'url': 'https://github.com/pgriess/streamdeck-workrooms/wiki/Errors#{}'.format(state.error.lower())
-                }
-            }))
+async def toggle(action, outbox, analytics_collect, action_metadata, backend, scheduler, optimistic, recorder, now):
+    '''
+    Toggle the state of `action` in the browser.
 
-            return
+    The `now` argument is the time at which the user pressed the key.
+    '''
 
-        # We have an unexpected status; direct the user to the help page for this status
-        if state.status in ['NONE', 'UNKNOWN']:
-            info('opening up the help page')
-            await ws.send(json.dumps({
-                'event': 'openUrl',
-                'context': context,
-                'payload': {
-                    'url': 'https://github.com/pgriess/streamdeck-workrooms/wiki/Help'
-                }
-            }))
+    state = action_metadata[action].current
 
-            return
+    # Things may have changed since the key was pressed
+    if state.status not in ['ON', 'OFF'] or state.error is not None:
+        info(f'not toggling {action} in status {state.status}')
+        return
 
-        # NOTE: It's safe to use analytics here because we're guaranteed that
-        #       this action is in a valid {ON, OFF} state, and thus we're in a
-        #       call.  It would be great to be more careful about this. It's
-        #       pretty fragile.
+    # NOTE: It's safe to use analytics here because we're guaranteed that
+    #       this action is in a valid {ON, OFF} state, and thus we're in a
+    #       call.  It would be great to be more careful about this. It's
+    #       pretty fragile.
 
-        info('toggling {} status'.format(action))
+    info('toggling {} status'.format(action))
+    try:
+        start = clock.time()
         try:
-            proc = await asyncio.create_subprocess_exec(
-                os.path.join(os.path.curdir, 'toggle_browser_state.osa'),
-                action,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE)
-
-            out, err = await proc.communicate()
-            out = out.decode('utf-8').strip()
-            err = err.decode('utf-8').strip()
-
-            if proc.returncode != 0:
-                error('toggle failed with status {}\nstdout={}\nstderr={}'.format(
-                    proc.returncode,
-                    out,
-                    err))
-                await analytics_collect(t='exception', exd='ToggleError', exf=0)
-            else:
-                data['action_time'] = now
+            toggled = await backend.toggle(action)
+        except Exception as e:
+            if recorder is not None:
+                recorder.record('toggle', action=action, error=e)
+            raise
 
-        except Exception:
-            error(traceback.format_exc())
+        if recorder is not None:
+            recorder.record('toggle', action=action, toggled=toggled)
+
+        # The call went away in the meantime
+        if not toggled:
+            info(f'not toggling {action}; there is no call tab')
+            return
+
+        done = clock.time()
+        metrics.TOGGLE_SECONDS.observe(done - start, action=action)
+
+        action_metadata[action], effects = engine.toggled(
+            action, action_metadata[action], state.status, now, done, optimistic)
+        await engine.perform(effects, outbox, analytics_collect)
+        await outbox.flush()
+
+        # Look for the new state sooner rather than later
+        if scheduler is not None:
+            scheduler.wake()
+
+    except BackendError as e:
+        error(f'toggle failed with error {e.ec}: {e}')
+        if analytics_collect:
+            await analytics_collect(t='exception', exd='ToggleError', exf=0)
+
+    except Exception:
+        exception('toggle failed')
+        if analytics_collect:
             await analytics_collect(t='exception', exd='ToggleException', exf=0)
 
+    if analytics_collect:
+        await analytics_collect(t='event', ec='Actions', ea=action.title())
+
+
+def parse_steps(settings):
+    '''
+    Return the steps of a macro key with the given per-key `settings`, as a
+    list of (action, status) pairs.
+
+    The settings hold a list of {"action", "state"} steps under "steps", as
+    written by the macro Property Inspector; keys that have never been
+    configured get `DEFAULT_MACRO_STEPS`. Steps that we don't understand are
+    logged and skipped.
+    '''
+
+    raw = settings.get('steps')
+    if raw is None:
+        return DEFAULT_MACRO_STEPS
+
+    steps = []
+    for step in raw if isinstance(raw, list) else [raw]:
+        if not isinstance(step, dict) or \
+                step.get('action') not in ACTIONS or \
+                step.get('state') not in ['ON', 'OFF']:
+            error(f'ignoring invalid macro step {step!r}')
+            continue
+
+        steps.append((step['action'], step['state']))
+
+    return steps
+
+
+async def macro(context, steps, outbox, analytics_collect, action_metadata, backend, scheduler, optimistic, recorder, now):
+    '''
+    Carry out the `steps` of the macro key `context` in the browser.
+
+    Rather than toggling each action in turn, all of the steps are sent to the
+    browser in one request which clicks only the buttons that need it, and
+    every key that this changes is updated in one round of messages. We then
+    wait up to `scheduler.confirm_seconds` for the browser to report that the
+    steps took effect, and show the outcome on the macro key.
+
+    The `now` argument is the time at which the user pressed the key.
+    '''
+
+    # Steps for actions that aren't in a call, or are in error, can't be
+    # carried out
+    targets = engine.macro_targets(action_metadata, steps)
+    if not targets:
+        info(f'not running macro with steps {steps}; nothing to change')
+        metrics.MACROS.inc(outcome='skipped')
+        outbox.send({'event': 'showAlert', 'context': context})
+        await outbox.flush()
+        return
+
+    info(f'running macro {targets}')
+    ok = False
+    try:
+        start = clock.time()
+        try:
+            result = await backend.ensure(targets)
+        except Exception as e:
+            if recorder is not None:
+                recorder.record('ensure', targets=targets, error=e)
+            raise
+
+        if recorder is not None:
+            recorder.record('ensure', targets=targets, result=result)
+
+        done = clock.time()
+        metrics.MACRO_SECONDS.observe(done - start)
+        info(f'macro result: {result}')
+
+        result = result or {}
+        effects = []
+        for name, status in targets:
+            if result.get(name) == 'CLICKED':
+                action_metadata[name], e = engine.ensured(
+                    name, action_metadata[name], status, now, done, optimistic)
+                effects += e
+
+        await engine.perform(effects, outbox, analytics_collect)
+        await outbox.flush()
+
+        ok = all(result.get(name) in ['CLICKED', 'ALREADY'] for name, _ in targets)
+
+        # Check the outcome against what the browser tells us next, rather
+        # than trusting the clicks
+        if scheduler is not None:
+            scheduler.wake()
+
+            deadline = done + scheduler.confirm_seconds
+            while ok and not engine.macro_done(action_metadata, targets):
+                remaining = deadline - clock.time()
+                if remaining <= 0 or not await scheduler.wait_processed(remaining):
+                    info(f'macro {targets} not confirmed by the browser')
+                    ok = False
+
+    except BackendError as e:
+        error(f'macro failed with error {e.ec}: {e}')
+        if analytics_collect:
+            await analytics_collect(t='exception', exd='MacroError', exf=0)
+
+    except Exception:
+        exception('macro failed')
         if analytics_collect:
-            await analytics_collect(t='event', ec='Actions', ea=action.title())
+            await analytics_collect(t='exception', exd='MacroException', exf=0)
+
+    metrics.MACROS.inc(outcome='ok' if ok else 'failed')
+    outbox.send({'event': 'showOk' if ok else 'showAlert', 'context': context})
+    await outbox.flush()
+
+    if analytics_collect:
+        await analytics_collect(t='event', ec='Actions', ea='Macro')
+
+
+class ToggleQueue:
+    '''
+    Serialize and coalesce toggles of a single action.
+
+    Presses are collected for `window_seconds` after the first one and then
+    collapsed into their net effect, i.e. an even number of presses is a
+    no-op. Presses that arrive while a toggle is in flight are dropped, since
+    we can't tell what state the user was looking at when they pressed.
+    '''
+
+    def __init__(self, window_seconds=0.15):
+        self.window_seconds = window_seconds
+        self.presses = 0
+        self.in_flight = False
+        self.task = None
+
+    def press(self, now, run):
+        '''
+        Record a key press at time `now`.
+
+        When the window closes, `run` is awaited with the time of the first
+        press if the presses don't cancel each other out. Returns False if the
+        press was dropped.
+        '''
+
+        if self.in_flight:
+            info('dropping key press while a toggle is in flight')
+            return False
+
+        self.presses += 1
+        if self.task is None:
+            self.task = asyncio.create_task(self._run(now, run))
+
+        return True
 
+    async def _run(self, now, run):
+        try:
+            if self.window_seconds > 0:
+                await asyncio.sleep(self.window_seconds)
+
+            presses, self.presses = self.presses, 0
+            if presses % 2 == 0:
+                info(f'coalesced {presses} key presses into a no-op')
+                return
+
+            self.in_flight = True
+            await run(now)
+        except Exception:
+            exception('toggle failed')
+        finally:
+            self.in_flight = False
+            self.task = None
+
+
+class MacroQueue:
+    '''
+    Run macros one at a time.
 
-async def listen(ws, analytics_collect, action_metadata):
+    Presses that arrive while a macro is running are dropped. Macros bring
+    actions to a given status rather than toggling them, so running the same
+    one again straight away wouldn't do anything.
+    '''
+
+    def __init__(self):
+        self.task = None
+
+    def press(self, now, run):
+        '''
+        Record a key press at time `now`, awaiting `run` with it unless a
+        macro is already running. Returns False if the press was dropped.
+        '''
+
+        if self.task is not None:
+            info('dropping macro key press while a macro is running')
+            return False
+
+        self.task = asyncio.create_task(self._run(now, run))
+        return True
+
+    async def _run(self, now, run):
+        try:
+            await run(now)
+        except Exception:
+            exception('macro failed')
+        finally:
+            self.task = None
+
+
+def new_toggle_queues(window_seconds):
+    '''
+    Return the queues for key presses to hand to `process_message()`: a
+    `ToggleQueue` for each action and a `MacroQueue` for `MACRO`.
+    '''
+
+    queues = {name: ToggleQueue(window_seconds) for name in ACTIONS}
+    queues[MACRO] = MacroQueue()
+    return queues
+
+
+async def listen(ws, outbox, analytics_collect, action_metadata, toggle_queues, backend, scheduler, optimistic=False, recorder=None, settings=None):
     '''
     Coroutine to listen for Stream Deck commands.
+
+    If `recorder` is not None, it is a `replay.Recorder` to which every
+    message is written. Changes to the global settings are applied to
+    `settings`, if it's not None.
     '''
 
     # Process live messages from Stream Deck
     while True:
         msg = json.loads(await ws.recv())
-        now = time.time()
-        await process_message(msg, now, ws, analytics_collect, action_metadata)
+        now = clock.time()
+        if recorder is not None:
+            recorder.record('streamdeck', msg=msg)
 
+        await process_message(
+            msg, now, outbox, analytics_collect, action_metadata,
+            toggle_queues, backend, scheduler, optimistic=optimistic,
+            recorder=recorder, settings=settings)
+        await outbox.flush()
 
-def load_image_string(asset_name):
+
+async def supervise(url, session, analytics_collect=None):
     '''
-    Return a string-ified representation of the given asset, suitable for
-    passing to SD via setImage command.
+    Coroutine to stay connected to Stream Deck at `url`.
+
+    Once connected, `session(ws)` is awaited with the WebSocket; it should
+    register with Stream Deck and then handle messages until the connection
+    drops. When that happens we reconnect, backing off exponentially between
+    attempts, and start a new session. Everything else keeps running in the
+    meantime, so that we don't lose any state.
+
+    If we can't connect for `RECONNECT_GIVE_UP_SECONDS`, the last error is
+    raised.
     '''
 
-    fp = os.path.join(os.path.curdir, asset_name)
-    mt, _ = mimetypes.guess_type(fp)
-    assert mt is not None
+    delay = RECONNECT_MIN_SECONDS
+    connected = False
+
+    # When we lost the connection, or started trying to make it, or None
+    # while we're connected
+    lost = clock.time()
+
+    while True:
+        try:
+            async with websockets.connect(url) as ws:
+                if connected:
+                    downtime = clock.time() - lost
+                    info(f'reconnected to Stream Deck after {downtime:.3f}s')
+                    metrics.RECONNECTS.inc()
+                    metrics.DISCONNECTED_SECONDS.inc(downtime)
+                    if analytics_collect:
+                        await analytics_collect(
+                            t='timing', utc='StreamDeck', utv='Reconnect',
+                            utt=int(downtime * 1000))
+
+                connected = True
+                lost = None
+                delay = RECONNECT_MIN_SECONDS
+
+                await session(ws)
+
+            error('Stream Deck session ended')
+        except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+            error(f'connection to Stream Deck failed: {e!r}')
+            if lost is not None and clock.time() - lost > RECONNECT_GIVE_UP_SECONDS:
+                raise
+
+        if lost is None:
+            lost = clock.time()
 
-    with open(fp, 'rb') as f:
-        content = base64.b64encode(f.read()).decode()
-        return 'data:{};base64,{}'.format(mt, content)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RECONNECT_MAX_SECONDS)
@@ -5,4 +5,41 @@ Common types.
 from collections import namedtuple
 
 # State of an action
-ActionState = namedtuple('ActionStatus', ['status', 'error'], defaults=[None, None])
\ No newline at end of file
+ActionState = namedtuple('ActionStatus', ['status', 'error'], defaults=[None, None])
+
+# Everything that we know about an action. These are never changed in place;
+# see `engine` for how they move from one to the next.
+#
+#   contexts     Stream Deck contexts of the keys showing the action, in the
+#                order that they appeared
+#   current      ActionState that the keys are showing
+#   next         ActionState that we've seen most recently, which becomes
+#                current once it has been stable for long enough
+#   next_time    when we first saw `next`
+#   action_time  when the user last toggled the action, until we see its
+#                effect
+#   pending      status that we're showing optimistically, until the browser
+#                confirms it
+Action = namedtuple(
+    'Action',
+    ['contexts', 'current', 'next', 'next_time', 'action_time', 'pending'],
+    defaults=[(), ActionState(), ActionState(), 0, None, None])
+
+# Actions that the plugin provides
+ACTIONS = ['mic', 'camera', 'hand', 'call']
+
+# Action for keys which bring several actions to a given status at once. Its
+# steps are configured per key; see `streamdeck.parse_steps()`.
+MACRO = 'macro'
+
+# Steps of a macro key that hasn't been configured, as (action, status)
+# pairs: leave the call quietly
+DEFAULT_MACRO_STEPS = [('mic', 'OFF'), ('camera', 'OFF'), ('hand', 'OFF'), ('call', 'OFF')]
+
+
+def new_action_metadata():
+    '''
+    Return the initial state of each action, keyed by action name.
+    '''
+
+    return {name: Action() for name in ACTIONS}
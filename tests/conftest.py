@@ -0,0 +1,18 @@
+'''
+Fixtures shared by the tests.
+'''
+
+import socket
+
+import pytest
+
+
+@pytest.fixture
+def unused_port():
+    '''
+    A local TCP port that nothing is listening on.
+    '''
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
@@ -0,0 +1,72 @@
+'''
+Batching of analytics hits, checked by the fake collector.
+'''
+
+from streamdeck_workrooms import analytics
+from streamdeck_workrooms.fakes import analytics as fake
+
+from aiohttp import ClientSession, web
+from argparse import Namespace
+import asyncio
+import time
+
+
+async def send(port, hits, delay=0):
+    '''
+    Send `hits`, a list of params, through the fake collector on `port`
+    answering after `delay` seconds, and return its stats once it has them
+    all.
+    '''
+
+    runner = web.AppRunner(fake.make_app(Namespace(delay=delay)))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    queue = asyncio.Queue()
+    for params in hits:
+        queue.put_nowait((time.time(), params))
+
+    task = asyncio.create_task(analytics.listen(
+        queue, True, 'UA-TEST', 'test', endpoint=f'http://127.0.0.1:{port}'))
+    try:
+        async with ClientSession() as cs:
+            for _ in range(100):
+                async with cs.get(f'http://127.0.0.1:{port}/stats') as resp:
+                    stats = await resp.json()
+                if stats['hits'] + stats['rejected'] >= len(hits):
+                    return stats
+                await asyncio.sleep(0.1)
+
+        raise AssertionError(f'collector got {stats}')
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await runner.cleanup()
+
+
+def test_max_hits(unused_port):
+    hits = [{'t': 'event', 'ec': 'Test', 'ea': str(i)} for i in range(50)]
+    stats = asyncio.run(send(unused_port, hits))
+
+    assert stats['rejected'] == 0
+    assert stats['hits'] == 50
+    assert stats['batches'] == 3
+    assert stats['max_batch_hits'] == analytics.BATCH_MAX_HITS
+
+
+def test_max_bytes(unused_port):
+    # Five of these, at a little over 3 KB each, fit in a batch
+    hits = [{'t': 'event', 'ec': 'Test', 'el': str(i) * 3000} for i in range(10)]
+    stats = asyncio.run(send(unused_port, hits))
+
+    assert stats['rejected'] == 0
+    assert stats['hits'] == 10
+    assert stats['batches'] == 2
+
+
+def test_max_concurrent(unused_port):
+    hits = [{'t': 'event', 'ec': 'Test', 'ea': str(i)} for i in range(200)]
+    stats = asyncio.run(send(unused_port, hits, delay=0.3))
+
+    assert stats['hits'] == 200
+    assert stats['max_in_flight'] == analytics.MAX_CONCURRENT_BATCHES
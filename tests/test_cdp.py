@@ -0,0 +1,142 @@
+'''
+CDPBackend against the fake DevTools server.
+'''
+
+from streamdeck_workrooms import browser
+from streamdeck_workrooms.browser import BackendError
+from streamdeck_workrooms.cdp import CDPBackend
+from streamdeck_workrooms.fakes import cdp
+
+from aiohttp import web
+from argparse import Namespace
+import asyncio
+import json
+import os.path
+
+import pytest
+
+
+BIN_DIR = os.path.join(os.path.dirname(__file__), os.path.pardir, 'bin')
+
+
+async def with_fake(port, fn, **kwargs):
+    '''
+    Run the fake server on `port` with the given options, and return what
+    `fn(backend)` does with a backend connected to it.
+    '''
+
+    args = Namespace(**dict({
+        'url': 'https://fb.workplace.com/groupcall/LINK:fake/',
+        'state': 'ON OFF NONE ON',
+        'extra_tab': [],
+        'state_file': None,
+        'delay': 0,
+        'error': None,
+    }, **kwargs))
+
+    runner = web.AppRunner(cdp.make_app(args))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    backend = CDPBackend(port=port, bin_dir=BIN_DIR, timeout_seconds=2)
+    try:
+        return await fn(backend)
+    finally:
+        await backend.close()
+        await runner.cleanup()
+
+
+def test_query(unused_port):
+    result = json.loads(asyncio.run(with_fake(unused_port, CDPBackend.query)))
+
+    assert result['state'] == 'CALL'
+    assert result['actions']['mic']['state'] == 'ON'
+    assert result['actions']['camera']['state'] == 'OFF'
+
+
+def test_query_picks_tab_in_call(unused_port):
+    async def query(backend):
+        return json.loads(await backend.query()), backend.tab
+
+    result, tab = asyncio.run(with_fake(
+        unused_port, query, state='ON OFF NONE OFF', extra_tab=['OFF OFF NONE ON']))
+
+    assert result['actions']['call']['state'] == 'ON'
+    assert tab == 'TAB2'
+
+
+def test_toggle(unused_port):
+    async def toggle(backend):
+        # We haven't found a call tab yet
+        assert not await backend.toggle('camera')
+
+        await backend.query()
+        assert await backend.toggle('camera')
+        return json.loads(await backend.query())
+
+    result = asyncio.run(with_fake(unused_port, toggle))
+
+    assert result['actions']['camera']['state'] == 'ON'
+
+
+def test_evaluate_error(unused_port):
+    with pytest.raises(BackendError) as e:
+        asyncio.run(with_fake(unused_port, CDPBackend.query, error='TypeError: boom'))
+
+    assert e.value.ec == browser.EC_QUERY_SUBPROCESS_FAILED_STATUS
+    assert str(e.value) == 'TypeError: boom'
+
+
+def test_no_browser(unused_port):
+    backend = CDPBackend(port=unused_port, bin_dir=BIN_DIR)
+
+    assert asyncio.run(backend.query()) == 'NONE'
+
+
+async def with_broken(port, fn, hang):
+    '''
+    Run a server on `port` which hangs answering /json/version if `hang`, or
+    else refuses the WebSocket upgrade, and return what `fn(backend)` does
+    with a backend pointed at it.
+    '''
+
+    released = asyncio.Event()
+
+    async def handle_version(request):
+        if hang:
+            await released.wait()
+        return web.json_response({
+            'webSocketDebuggerUrl': f'ws://{request.host}/devtools/browser/FAKE'})
+
+    async def handle_browser(request):
+        return web.Response(status=403, text='not now')
+
+    app = web.Application()
+    app.router.add_get('/json/version', handle_version)
+    app.router.add_get('/devtools/browser/{id}', handle_browser)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    backend = CDPBackend(port=port, bin_dir=BIN_DIR, timeout_seconds=0.5)
+    try:
+        return await fn(backend)
+    finally:
+        released.set()
+        await backend.close()
+        await runner.cleanup()
+
+
+def test_version_hangs(unused_port):
+    with pytest.raises(BackendError) as e:
+        asyncio.run(with_broken(unused_port, CDPBackend.query, hang=True))
+
+    assert e.value.ec == browser.EC_QUERY_TIMEOUT
+
+
+def test_upgrade_refused(unused_port):
+    with pytest.raises(BackendError) as e:
+        asyncio.run(with_broken(unused_port, CDPBackend.query, hang=False))
+
+    assert e.value.ec == browser.EC_QUERY_SUBPROCESS_FAILED_EXCEPTION
@@ -0,0 +1,196 @@
+'''
+Transitions between action states.
+'''
+
+from streamdeck_workrooms import browser, engine
+from streamdeck_workrooms.engine import (
+    Collect, Forget, OpenUrl, PressToState, SetImage, SetTitle, Toggle)
+from streamdeck_workrooms.fakes.worker import query_result
+from streamdeck_workrooms.types import ACTIONS, Action, ActionState, new_action_metadata
+
+
+CONFIRM = 3
+GRACE = 5
+
+
+def with_keys(*names):
+    '''
+    Return action metadata with a key showing each of `names`.
+    '''
+
+    actions = new_action_metadata()
+    for name in names:
+        actions[name], _ = engine.appear(name, actions[name], name.upper())
+
+    return actions
+
+
+def observe(actions, state, now):
+    '''
+    Observe the fake worker's `state`, e.g. "ON OFF NONE ON", at time `now`.
+    '''
+
+    return engine.observe(
+        actions, browser.parse_result(query_result(state)), now, CONFIRM, GRACE)
+
+
+def images(effects):
+    return [(e.contexts, e.status) for e in effects if type(e) is SetImage]
+
+
+def collected(effects):
+    return [e.params for e in effects if type(e) is Collect]
+
+
+def test_appear_keeps_order():
+    action = Action()
+    for context in ['B', 'A', 'C', 'A']:
+        action, effects = engine.appear('mic', action, context)
+
+    assert action.contexts == ('B', 'A', 'C')
+    assert effects == [Forget('A')]
+
+
+def test_appear_shows_known_state():
+    action = Action(current=ActionState('ON'))
+    _, effects = engine.appear('mic', action, 'MIC')
+
+    assert effects == [Forget('MIC'), SetImage(('MIC',), 'mic', 'ON'), SetTitle(('MIC',), None)]
+
+
+def test_disappear_last_key_resets():
+    action = Action(contexts=('A', 'B'), current=ActionState('ON'))
+
+    action, _ = engine.disappear('mic', action, 'A', 10)
+    assert action.contexts == ('B',)
+    assert action.current.status == 'ON'
+
+    action, effects = engine.disappear('mic', action, 'B', 11)
+    assert action == Action(next_time=11)
+    assert effects == [Forget('B')]
+
+
+def test_press():
+    assert engine.press('mic', Action(), 'MIC') == []
+    assert engine.press('mic', Action(current=ActionState('ON')), 'MIC') == [Toggle('mic')]
+    assert engine.press('mic', Action(current=ActionState('NONE')), 'MIC') == [
+        OpenUrl('MIC', engine.HELP_URL)]
+    assert engine.press('mic', Action(current=ActionState('UNKNOWN', 'E2')), 'MIC') == [
+        OpenUrl('MIC', f'{engine.ERRORS_URL}#e2')]
+
+
+def test_call_begins_and_ends():
+    actions = with_keys(*ACTIONS)
+
+    actions, effects = observe(actions, 'ON OFF OFF ON', 0)
+    assert ((('MIC',), 'ON')) in images(effects)
+    assert {'t': 'event', 'ec': 'Call', 'ea': 'Begin', 'sc': 'start'} in collected(effects)
+
+    actions, effects = observe(actions, 'NONE', 1)
+    assert images(effects) == [((name.upper(),), 'NONE') for name in ACTIONS]
+    assert {'t': 'event', 'ec': 'Call', 'ea': 'End', 'sc': 'end'} in collected(effects)
+
+
+def test_nothing_changes():
+    actions, _ = observe(with_keys('mic'), 'ON OFF OFF ON', 0)
+    new_actions, effects = observe(actions, 'ON OFF OFF ON', 1)
+
+    assert effects == []
+    assert new_actions['mic'] is actions['mic']
+
+
+def test_no_keys_no_effects():
+    actions, effects = observe(new_action_metadata(), 'ON OFF OFF ON', 0)
+
+    assert images(effects) == []
+    assert actions['mic'].current == ActionState()
+
+
+def test_error_waits_for_grace_period():
+    actions, _ = observe(with_keys('mic'), 'ON OFF OFF ON', 0)
+
+    actions, effects = observe(actions, 'UNKNOWN OFF OFF ON', 1)
+    assert effects == []
+    assert actions['mic'].current == ActionState('ON')
+
+    actions, effects = observe(actions, 'UNKNOWN OFF OFF ON', 1 + GRACE + 0.1)
+    assert images(effects) == [(('MIC',), 'NONE')]
+    assert SetTitle(('MIC',), browser.EC_QUERY_DOM_FAILED) in effects
+    assert actions['mic'].current == ActionState('UNKNOWN', browser.EC_QUERY_DOM_FAILED)
+
+
+def test_error_clears_at_once():
+    actions, _ = observe(with_keys('mic'), 'UNKNOWN OFF OFF ON', 0)
+    actions, _ = observe(actions, 'UNKNOWN OFF OFF ON', GRACE + 1)
+
+    actions, effects = observe(actions, 'OFF OFF OFF ON', GRACE + 2)
+    assert images(effects) == [(('MIC',), 'OFF')]
+    assert SetTitle(('MIC',), None) in effects
+
+
+def test_brief_error_is_never_shown():
+    actions, _ = observe(with_keys('mic'), 'ON OFF OFF ON', 0)
+    actions, _ = observe(actions, 'UNKNOWN OFF OFF ON', 1)
+
+    actions, effects = observe(actions, 'ON OFF OFF ON', 2)
+    assert effects == []
+    assert actions['mic'].next == ActionState('ON')
+
+
+def test_missing_hand_is_none():
+    actions, effects = observe(with_keys('hand'), 'ON OFF NONE ON', 0)
+
+    assert images(effects) == [(('HAND',), 'NONE')]
+    assert actions['hand'].current == ActionState('NONE')
+
+
+def test_missing_hand_outside_call_is_an_error():
+    actions, _ = observe(with_keys('hand'), 'ON OFF NONE UNKNOWN', 0)
+
+    assert actions['hand'].next.error == browser.EC_QUERY_DOM_FAILED
+
+
+def test_toggle_reports_latency():
+    actions, _ = observe(with_keys('mic'), 'ON OFF OFF ON', 0)
+    actions['mic'], effects = engine.toggled('mic', actions['mic'], 'ON', 10, 10.2, False)
+    assert effects == []
+
+    actions, effects = observe(actions, 'OFF OFF OFF ON', 10.5)
+    assert images(effects) == [(('MIC',), 'OFF')]
+    assert PressToState('mic', 0.5) in effects
+    assert actions['mic'].action_time is None
+
+
+def test_optimistic_confirmed():
+    actions, _ = observe(with_keys('mic'), 'ON OFF OFF ON', 0)
+    actions['mic'], effects = engine.toggled('mic', actions['mic'], 'ON', 10, 10.2, True)
+    assert images(effects) == [(('MIC',), 'OFF')]
+    assert actions['mic'].pending == 'OFF'
+
+    # The browser hasn't caught up yet; hold the optimistic status
+    actions, effects = observe(actions, 'ON OFF OFF ON', 10.3)
+    assert effects == []
+    assert not engine.macro_done(actions, [('mic', 'OFF')])
+
+    actions, effects = observe(actions, 'OFF OFF OFF ON', 10.5)
+    assert images(effects) == []
+    assert PressToState('mic', 0.5) in effects
+    assert actions['mic'].pending is None
+    assert engine.macro_done(actions, [('mic', 'OFF')])
+
+
+def test_optimistic_rolled_back():
+    actions, _ = observe(with_keys('mic'), 'ON OFF OFF ON', 0)
+    actions['mic'], _ = engine.toggled('mic', actions['mic'], 'ON', 10, 10.2, True)
+
+    actions, effects = observe(actions, 'ON OFF OFF ON', 10 + CONFIRM + 0.1)
+    assert images(effects) == [(('MIC',), 'ON')]
+    assert {'t': 'event', 'ec': 'Optimistic', 'ea': 'Rollback', 'el': 'Mic'} in collected(effects)
+    assert actions['mic'].pending is None
+
+
+def test_macro_done_call_gone():
+    actions, _ = observe(with_keys(*ACTIONS), 'NONE', 0)
+
+    assert engine.macro_done(actions, [('mic', 'OFF'), ('call', 'OFF')])
+    assert not engine.macro_done(actions, [('mic', 'ON')])
@@ -0,0 +1,131 @@
+'''
+Sending messages to Stream Deck.
+'''
+
+from streamdeck_workrooms.outbox import Outbox
+
+import asyncio
+import json
+from websockets.exceptions import ConnectionClosed
+
+
+class Images:
+    def get(self, action, status):
+        return f'{action}:{status}'
+
+
+class WebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    async def send(self, msg):
+        if self.closed:
+            raise ConnectionClosed(None, None)
+        self.sent.append(json.loads(msg))
+
+
+def shown(ws):
+    return [
+        (m['context'], m['payload'].get('image', m['payload'].get('title')))
+        for m in ws.sent]
+
+
+def flush(outbox):
+    asyncio.run(outbox.flush())
+
+
+def test_redundant_updates_dropped():
+    ws = WebSocket()
+    outbox = Outbox(ws, Images())
+
+    outbox.set_image(['A', 'B'], 'mic', 'ON')
+    outbox.set_title(['A'], None)
+    flush(outbox)
+    outbox.set_image(['A', 'B'], 'mic', 'ON')
+    outbox.set_title(['A'], None)
+    outbox.set_image(['B'], 'mic', 'OFF')
+    flush(outbox)
+
+    assert shown(ws) == [('A', 'mic:ON'), ('B', 'mic:ON'), ('A', None), ('B', 'mic:OFF')]
+    assert outbox.suppressed == 3
+
+
+def test_forget_sends_again():
+    ws = WebSocket()
+    outbox = Outbox(ws, Images())
+
+    outbox.set_image(['A'], 'mic', 'ON')
+    flush(outbox)
+    outbox.forget('A')
+    outbox.set_image(['A'], 'mic', 'ON')
+    flush(outbox)
+
+    assert shown(ws) == [('A', 'mic:ON'), ('A', 'mic:ON')]
+
+
+def test_send_is_never_dropped():
+    ws = WebSocket()
+    outbox = Outbox(ws, Images())
+
+    outbox.send({'event': 'showOk', 'context': 'A'})
+    outbox.send({'event': 'showOk', 'context': 'A'})
+    flush(outbox)
+
+    assert [m['event'] for m in ws.sent] == ['showOk', 'showOk']
+
+
+def test_resend_latest_after_reconnect():
+    outbox = Outbox(None, Images())
+
+    outbox.set_image(['A'], 'mic', 'ON')
+    outbox.set_image(['B'], 'mic', 'ON')
+    flush(outbox)
+    outbox.set_image(['A'], 'mic', 'OFF')
+    flush(outbox)
+
+    outbox.ws = ws = WebSocket()
+    outbox.resend()
+    flush(outbox)
+
+    assert shown(ws) == [('A', 'mic:OFF'), ('B', 'mic:ON')]
+
+    # Nothing is left to resend
+    outbox.resend()
+    flush(outbox)
+    assert len(ws.sent) == 2
+
+
+def test_no_resend_when_back_to_what_was_shown():
+    ws = WebSocket()
+    outbox = Outbox(ws, Images())
+
+    outbox.set_image(['A'], 'mic', 'ON')
+    flush(outbox)
+
+    outbox.ws = None
+    outbox.set_image(['A'], 'mic', 'OFF')
+    flush(outbox)
+    outbox.set_image(['A'], 'mic', 'ON')
+    flush(outbox)
+
+    outbox.ws = ws
+    outbox.resend()
+    flush(outbox)
+
+    assert shown(ws) == [('A', 'mic:ON')]
+
+
+def test_connection_closed_while_sending():
+    ws = WebSocket()
+    outbox = Outbox(ws, Images())
+
+    ws.closed = True
+    outbox.set_image(['A'], 'mic', 'ON')
+    flush(outbox)
+
+    ws.closed = False
+    outbox.resend()
+    flush(outbox)
+
+    assert shown(ws) == [('A', 'mic:ON')]
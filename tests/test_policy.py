@@ -0,0 +1,76 @@
+'''
+Deciding which analytics hits to send.
+'''
+
+from streamdeck_workrooms.analytics import Policy
+
+import random
+
+
+START = {'t': 'event', 'ec': 'Call', 'ea': 'Begin', 'sc': 'start'}
+END = {'t': 'event', 'ec': 'Call', 'ea': 'End', 'sc': 'end'}
+TOGGLE = {'t': 'event', 'ec': 'Actions', 'ea': 'Mic'}
+
+
+def policy(**kwargs):
+    return Policy(**dict({'rate_limits': {}, 'default_rate_limit': (1000, 1000)}, **kwargs))
+
+
+def test_only_in_session():
+    p = policy()
+
+    assert not p.admit(TOGGLE, 0)
+    assert p.admit(START, 0)
+    assert p.admit(TOGGLE, 0)
+    assert p.admit(END, 0)
+    assert not p.admit(TOGGLE, 0)
+    assert p.counts['no_session'] == 2
+
+
+def test_disabled():
+    p = policy(enabled=False)
+
+    assert not p.admit(START, 0)
+    assert not p.admit(TOGGLE, 0)
+
+    # Turning it back on picks up the session that's already going
+    p.enabled = True
+    assert p.admit(TOGGLE, 0)
+
+
+def test_budget_reserved_for_high_value():
+    p = policy(session_max_hits=10, reserved_hits=3, high_value={'event:Call'})
+
+    assert p.admit(START, 0)
+    assert sum(p.admit(TOGGLE, 0) for _ in range(20)) == 6
+    assert p.counts['over_budget'] == 14
+
+    # The rest are kept for the end of the call
+    assert p.admit({'t': 'event', 'ec': 'Call', 'ea': 'Other'}, 0)
+    assert p.admit(END, 0)
+
+    # A new session starts a new budget
+    assert p.admit(START, 0)
+    assert p.admit(TOGGLE, 0)
+
+
+def test_sampling():
+    random.seed(1)
+    p = policy(sample_rates={'timing:Query': 0.25, 'event:Actions': 0})
+    p.admit(START, 0)
+
+    sent = sum(p.admit({'t': 'timing', 'utc': 'Query'}, 0) for _ in range(400))
+    assert 70 < sent < 130
+    assert not p.admit(TOGGLE, 0)
+
+    # Session boundaries are never sampled out
+    assert p.admit(END, 0)
+
+
+def test_rate_limited():
+    p = policy(rate_limits={'event:Actions': (1, 2)})
+    p.admit(START, 0)
+
+    assert [p.admit(TOGGLE, 0) for _ in range(3)] == [True, True, False]
+    assert p.admit(TOGGLE, 1.1)
+    assert p.counts['rate_limited'] == 1
@@ -0,0 +1,174 @@
+'''
+Replaying a recording should send Stream Deck what the daemon sent live.
+'''
+
+from streamdeck_workrooms import clock, replay
+from streamdeck_workrooms.fakes.streamdeck import FakeStreamDeck
+from streamdeck_workrooms.images import ImageCache
+from streamdeck_workrooms.types import ACTIONS
+
+import asyncio
+import glob
+import io
+import json
+import os.path
+import shlex
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+# Messages that show something on a key
+SHOWN = ['setImage', 'setTitle', 'openUrl', 'showOk', 'showAlert']
+
+
+def image_names():
+    '''
+    Return the name that replay gives each image, by its data URL.
+    '''
+
+    names = {}
+    for scale in [1, 2]:
+        images = ImageCache(os.path.join(ROOT_DIR, 'assets'), scale=scale)
+        for action in ACTIONS:
+            for status in ['ON', 'OFF', 'NONE', 'UNKNOWN']:
+                names[images.get(action, status)] = f'{action}:{status}'
+
+    return names
+
+
+def by_context(msgs, names):
+    '''
+    Return what was shown on each key, in order, by context.
+    '''
+
+    shown = {}
+    for msg in msgs:
+        if msg['event'] not in SHOWN:
+            continue
+
+        payload = msg.get('payload')
+        if msg['event'] == 'setImage':
+            payload = names.get(payload['image'], payload['image'])
+
+        shown.setdefault(msg['context'], []).append((msg['event'], payload))
+
+    return shown
+
+
+async def run_live(plugin_dir, daemon_args):
+    '''
+    Run the daemon through a call against the fake Stream Deck and worker,
+    recording it, and return the messages that it sent.
+    '''
+
+    for fn in glob.glob(os.path.join(ROOT_DIR, 'assets', '*.png')):
+        shutil.copy(fn, plugin_dir)
+    shutil.copy(os.path.join(ROOT_DIR, 'manifest.json'), plugin_dir)
+
+    state_file = os.path.join(plugin_dir, 'state')
+    with open(state_file, 'w') as f:
+        f.write('NONE')
+
+    def set_state(state):
+        with open(state_file, 'w') as f:
+            f.write(state)
+
+    worker = [
+        sys.executable, '-m', 'streamdeck_workrooms.fakes.worker',
+        '--state-file', state_file, '--delay', '0.02']
+    argv = [
+        sys.executable, os.path.join(ROOT_DIR, 'daemon.py'),
+        '--browser-worker', shlex.join(worker),
+        '--no-push',
+        '--image-cache', '',
+        '--analytics-spool', '',
+        '--analytics-endpoint', 'http://127.0.0.1:1',
+        '--record', os.path.join(plugin_dir, 'recording.jsonl'),
+    ] + daemon_args
+
+    sd = FakeStreamDeck(settings={'client_id': 'test', 'error_grace_period': 1})
+    await sd.start()
+    try:
+        await asyncio.wait_for(sd.launch(
+            argv, cwd=plugin_dir, env=dict(os.environ, PYTHONPATH=ROOT_DIR),
+            stderr=open(os.path.join(plugin_dir, 'daemon.log'), 'w')), 10)
+
+        # Two keys for some actions, so that fan-out order matters
+        for action in ACTIONS:
+            await sd.appear(action, f'{action.upper()}1')
+        await sd.appear('mic', 'MIC2')
+        await sd.appear('camera', 'CAMERA2')
+        await asyncio.sleep(1)
+
+        set_state('ON OFF NONE ON')
+        await asyncio.sleep(1.5)
+
+        await sd.press('mic', 'MIC1')
+        await asyncio.sleep(1)
+
+        # A double press, which comes to nothing
+        await sd.press('camera', 'CAMERA2')
+        await asyncio.sleep(0.05)
+        await sd.press('camera', 'CAMERA2')
+        await asyncio.sleep(1)
+
+        # An error which outlasts the grace period
+        set_state('OFF OFF NONE UNKNOWN')
+        await asyncio.sleep(2.5)
+
+        await sd.press('call', 'CALL1')
+        await sd.disappear('mic', 'MIC2')
+        await asyncio.sleep(0.5)
+
+        set_state('SURVEY')
+        await asyncio.sleep(1.5)
+
+        return [msg for _, msg in sd.received]
+    finally:
+        await sd.stop()
+
+
+def run_replay(path):
+    '''
+    Replay the recording `path`, returning the messages that it sent.
+    '''
+
+    header, records = replay.load(path)
+    out = io.StringIO()
+
+    loop = clock.VirtualEventLoop(header['t'])
+    try:
+        loop.run_until_complete(replay.replay(header, records, out))
+    finally:
+        loop.close()
+
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+@pytest.mark.parametrize('daemon_args', [[], ['--optimistic']])
+def test_replay_matches_live(tmp_path, daemon_args):
+    live = asyncio.run(run_live(str(tmp_path), daemon_args))
+    replayed = run_replay(str(tmp_path / 'recording.jsonl'))
+
+    assert by_context(replayed, {}) == by_context(live, image_names())
+
+
+def test_replay_is_deterministic(tmp_path):
+    asyncio.run(run_live(str(tmp_path), []))
+
+    # Iteration order over sets and dicts of strings follows the hash seed
+    outputs = set()
+    for seed in ['1', '2', '3']:
+        outputs.add(subprocess.run(
+            [sys.executable, '-m', 'streamdeck_workrooms.replay',
+             str(tmp_path / 'recording.jsonl')],
+            env=dict(os.environ, PYTHONPATH=ROOT_DIR, PYTHONHASHSEED=seed),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            check=True).stdout)
+
+    assert len(outputs) == 1
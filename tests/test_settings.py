@@ -0,0 +1,67 @@
+'''
+Settings that users can change while we're running.
+'''
+
+from streamdeck_workrooms.browser import PollScheduler
+from streamdeck_workrooms.settings import SCHEMA, Settings, validate
+
+
+DEFAULTS = {name: s.default for name, s in SCHEMA.items()}
+
+
+def test_missing_take_defaults():
+    values, problems = validate({}, DEFAULTS)
+
+    assert values == DEFAULTS
+    assert problems == []
+
+
+def test_numbers_from_strings():
+    values, problems = validate({'poll_normal': '2.5'}, DEFAULTS)
+
+    assert values['poll_normal'] == 2.5
+    assert problems == []
+
+
+def test_invalid_take_defaults():
+    values, problems = validate({
+        'poll_normal': 'often',
+        'error_grace_period': 100,
+        'analytics_enabled': 'no',
+        'query_sample_rate': True,
+    }, DEFAULTS)
+
+    assert values == DEFAULTS
+    assert len(problems) == 4
+
+
+def test_polls_out_of_order_keep_previous():
+    previous = dict(DEFAULTS, poll_fast=0.2, poll_normal=2, poll_idle_max=10)
+    values, problems = validate(
+        {'poll_fast': 3, 'poll_normal': 2, 'error_grace_period': 1}, DEFAULTS, previous)
+
+    assert [values[n] for n in ['poll_fast', 'poll_normal', 'poll_idle_max']] == [0.2, 2, 10]
+    assert values['error_grace_period'] == 1
+    assert len(problems) == 1
+
+
+def test_update_applies_changes():
+    scheduler = PollScheduler()
+    settings = Settings(scheduler, defaults={'poll_normal': 2})
+    assert scheduler.normal_seconds == 2
+
+    changed = settings.update({'poll_normal': 4, 'poll_fast': 0.1})
+    assert changed == {'poll_normal': 4}
+    assert scheduler.normal_seconds == 4
+
+    assert settings.update({'poll_normal': 4}) == {}
+
+
+def test_update_rejects_polls_out_of_order():
+    scheduler = PollScheduler()
+    settings = Settings(scheduler)
+    settings.update({'poll_normal': 4})
+
+    assert settings.update({'poll_normal': 20, 'poll_idle_max': 10}) == {}
+    assert scheduler.normal_seconds == 4
+    assert scheduler.idle_max_seconds == 8
@@ -0,0 +1,118 @@
+'''
+On-disk spool of analytics hits.
+'''
+
+from streamdeck_workrooms.spool import HEADER, Record, Spool, decode_frames, encode_frame
+
+import asyncio
+import time
+
+
+def test_frames_round_trip():
+    records = [Record(0, 1.5, {'t': 'event'}), Record(1, 2.5, {'t': 'timing'})]
+    data = b''.join(encode_frame(r) for r in records)
+
+    decoded, valid = decode_frames(data)
+    assert [r for r, _ in decoded] == records
+    assert valid == len(data)
+
+
+def test_damaged_frame_ends_decoding():
+    first = encode_frame(Record(0, 1.5, 'a'))
+    second = bytearray(encode_frame(Record(1, 2.5, 'b')))
+    second[-1] ^= 0xff
+
+    decoded, valid = decode_frames(first + bytes(second) + encode_frame(Record(2, 3.5, 'c')))
+    assert [r.value for r, _ in decoded] == ['a']
+    assert valid == len(first)
+
+
+def test_truncated_frame_ends_decoding():
+    first = encode_frame(Record(0, 1.5, 'a'))
+
+    for data in [first + b'\0\0', first + encode_frame(Record(1, 2.5, 'b'))[:-1]]:
+        decoded, valid = decode_frames(data)
+        assert [r.value for r, _ in decoded] == ['a']
+        assert valid == len(first)
+
+
+def test_reload(tmp_path):
+    path = str(tmp_path / 'spool')
+    now = time.time()
+
+    async def main():
+        spool = Spool(path)
+        await spool.append([(now, 'a'), (now, 'b'), (now, 'c')])
+        await spool.consume(spool.peek(1))
+
+    asyncio.run(main())
+
+    spool = Spool(path)
+    assert [r.value for r in spool.peek(10)] == ['b', 'c']
+
+    # New records don't reuse sequence numbers
+    asyncio.run(spool.append([(now, 'd')]))
+    assert [r.seq for r in spool.peek(10)] == [1, 2, 3]
+
+
+def test_damaged_tail_is_discarded(tmp_path):
+    path = str(tmp_path / 'spool')
+    now = time.time()
+
+    asyncio.run(Spool(path).append([(now, 'a'), (now, 'b')]))
+
+    # As if we crashed part way through writing a frame
+    with open(path, 'ab') as f:
+        f.write(HEADER.pack(100, 0) + b'{"partial')
+
+    spool = Spool(path)
+    assert [r.value for r in spool.peek(10)] == ['a', 'b']
+    assert not spool.stale
+
+    with open(path, 'rb') as f:
+        decoded, valid = decode_frames(f.read())
+    assert valid == spool.size
+    assert len(decoded) == 2
+
+
+def test_consume_copies(tmp_path):
+    now = time.time()
+
+    async def main():
+        spool = Spool(str(tmp_path / 'spool'))
+        await spool.append([(now, 'a'), (now, 'b')])
+
+        # Records that have been copied, e.g. into a batch, still match
+        await spool.consume([r._replace() for r in spool.peek(1)])
+        return spool
+
+    spool = asyncio.run(main())
+    assert [r.value for r in spool.peek(10)] == ['b']
+
+
+def test_oldest_dropped_when_full(tmp_path):
+    path = str(tmp_path / 'spool')
+    now = time.time()
+    frame_size = len(encode_frame(Record(0, now, 'x' * 100)))
+
+    async def main():
+        spool = Spool(path, max_bytes=frame_size * 3)
+        await spool.append([(now, str(i) * 100) for i in range(5)])
+        return spool
+
+    spool = asyncio.run(main())
+    assert [r.value[0] for r in spool.peek(10)] == ['2', '3', '4']
+    assert spool.dropped == 2
+    assert [r.value[0] for r in Spool(path).peek(10)] == ['2', '3', '4']
+
+
+def test_old_records_dropped(tmp_path):
+    now = time.time()
+
+    async def main():
+        spool = Spool(str(tmp_path / 'spool'), max_age_seconds=60)
+        await spool.append([(now - 120, 'old'), (now, 'new')])
+        return spool
+
+    spool = asyncio.run(main())
+    assert [r.value for r in spool.peek(10)] == ['new']
@@ -0,0 +1,102 @@
+'''
+Handling of key presses.
+'''
+
+from streamdeck_workrooms import browser
+from streamdeck_workrooms.browser import BackendError
+from streamdeck_workrooms.streamdeck import ToggleQueue, toggle
+from streamdeck_workrooms.types import ActionState, new_action_metadata
+
+import asyncio
+
+
+async def presses(queue, delays, toggle_seconds=0):
+    '''
+    Press the key of `queue` after each of `delays`, in seconds since the
+    previous press, and return the times passed to each toggle and whether
+    each press was accepted.
+    '''
+
+    runs = []
+
+    async def run(now):
+        runs.append(now)
+        await asyncio.sleep(toggle_seconds)
+
+    accepted = []
+    for i, delay in enumerate(delays):
+        await asyncio.sleep(delay)
+        accepted.append(queue.press(i, run))
+
+    while queue.task is not None:
+        await asyncio.sleep(0.01)
+
+    return runs, accepted
+
+
+def test_single_press_toggles():
+    runs, accepted = asyncio.run(presses(ToggleQueue(0.05), [0]))
+
+    assert runs == [0]
+    assert accepted == [True]
+
+
+def test_double_press_is_a_no_op():
+    runs, accepted = asyncio.run(presses(ToggleQueue(0.1), [0, 0.01]))
+
+    assert runs == []
+    assert accepted == [True, True]
+
+
+def test_triple_press_toggles_once():
+    runs, _ = asyncio.run(presses(ToggleQueue(0.1), [0, 0.01, 0.01]))
+
+    # With the time of the first press
+    assert runs == [0]
+
+
+def test_press_while_in_flight_is_dropped():
+    runs, accepted = asyncio.run(presses(
+        ToggleQueue(0.05), [0, 0.1], toggle_seconds=0.2))
+
+    assert runs == [0]
+    assert accepted == [True, False]
+
+
+def test_press_after_toggle_toggles_again():
+    runs, accepted = asyncio.run(presses(
+        ToggleQueue(0.05), [0, 0.2], toggle_seconds=0.05))
+
+    assert runs == [0, 1]
+    assert accepted == [True, True]
+
+
+class FailingBackend:
+    async def toggle(self, target):
+        raise BackendError(browser.EC_QUERY_TIMEOUT, 'timed out')
+
+
+class NoCallBackend:
+    async def toggle(self, target):
+        return False
+
+
+def test_failed_toggle_without_analytics():
+    # As before the settings arrive, when analytics_collect is None
+    action_metadata = new_action_metadata()
+    action_metadata['mic'] = action_metadata['mic']._replace(current=ActionState('ON'))
+
+    asyncio.run(toggle(
+        'mic', None, None, action_metadata, FailingBackend(), None, False, None, 0))
+
+
+def test_toggle_without_call_tab():
+    # In optimistic mode, the key must not show a toggle that didn't happen
+    action_metadata = new_action_metadata()
+    action_metadata['mic'] = action = action_metadata['mic']._replace(
+        contexts=('MIC',), current=ActionState('ON'))
+
+    asyncio.run(toggle(
+        'mic', None, None, action_metadata, NoCallBackend(), None, True, None, 0))
+
+    assert action_metadata['mic'] is action
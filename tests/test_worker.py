@@ -0,0 +1,153 @@
+'''
+WorkerBackend against the fake browser worker.
+'''
+
+from streamdeck_workrooms import browser
+from streamdeck_workrooms.browser import BackendError, WorkerBackend
+from streamdeck_workrooms.push import PushListener
+
+import asyncio
+import json
+import sys
+
+import pytest
+
+
+def worker(*args):
+    return [sys.executable, '-m', 'streamdeck_workrooms.fakes.worker', *args]
+
+
+async def query(backend):
+    try:
+        return json.loads(await backend.query())
+    finally:
+        await backend.close()
+
+
+def test_query():
+    backend = WorkerBackend(worker('--state', 'ON OFF NONE ON'))
+    result = asyncio.run(query(backend))
+
+    assert result['state'] == 'CALL'
+    assert result['actions']['mic']['state'] == 'ON'
+
+
+def test_crash_restarts_and_retries_once():
+    async def main():
+        # The worker answers one request, then dies on the next
+        backend = WorkerBackend(worker('--state', 'ON OFF NONE ON', '--exit-after', '2'))
+        await backend.query()
+        return backend, await query(backend)
+
+    backend, result = asyncio.run(main())
+
+    assert result['state'] == 'CALL'
+    assert backend.starts == 2
+
+
+def test_crash_on_retry_fails():
+    backend = WorkerBackend(worker('--exit-after', '1'))
+
+    with pytest.raises(BackendError) as e:
+        asyncio.run(query(backend))
+
+    assert e.value.ec == browser.EC_QUERY_SUBPROCESS_FAILED_EXCEPTION
+    assert backend.starts == 2
+
+
+def test_deadline_kills_worker(tmp_path):
+    hang_file = tmp_path / 'hang'
+    hang_file.touch()
+
+    async def main():
+        backend = WorkerBackend(
+            worker('--state', 'ON OFF NONE ON', '--hang-file', str(hang_file)),
+            timeout_seconds=0.5)
+
+        await backend.start()
+        proc = backend.proc
+        with pytest.raises(BackendError) as e:
+            await backend.query()
+
+        assert e.value.ec == browser.EC_QUERY_TIMEOUT
+        assert proc.returncode is not None
+
+        # The next request gets a new worker
+        hang_file.unlink()
+        return backend, await query(backend)
+
+    backend, result = asyncio.run(main())
+
+    assert result['state'] == 'CALL'
+    assert backend.starts == 2
+
+
+def test_error():
+    backend = WorkerBackend(
+        worker('--error', 'Executing JavaScript through AppleScript is turned off'))
+
+    with pytest.raises(BackendError) as e:
+        asyncio.run(query(backend))
+
+    assert e.value.ec == browser.EC_CHROME_APPLESCRIPT_DISABLED
+
+
+def test_spawn_failure(tmp_path):
+    backend = WorkerBackend([str(tmp_path / 'missing')])
+
+    for _ in range(2):
+        with pytest.raises(BackendError) as e:
+            asyncio.run(query(backend))
+
+        assert e.value.ec == browser.EC_QUERY_SUBPROCESS_FAILED_EXCEPTION
+
+
+def test_toggle():
+    async def main(state):
+        backend = WorkerBackend(worker('--state', state))
+        try:
+            await backend.query()
+            return await backend.toggle('mic'), await backend.query()
+        finally:
+            await backend.close()
+
+    toggled, result = asyncio.run(main('ON OFF NONE ON'))
+    assert toggled
+    assert json.loads(result)['actions']['mic']['state'] == 'OFF'
+
+    # There's no call tab to toggle in
+    toggled, result = asyncio.run(main('NONE'))
+    assert not toggled
+    assert result == 'NONE'
+
+
+def test_observe_pushes_state(tmp_path):
+    state_file = tmp_path / 'state'
+    state_file.write_text('ON OFF NONE ON')
+
+    async def main():
+        push = PushListener()
+        await push.start()
+        backend = WorkerBackend(worker('--state-file', str(state_file)))
+        try:
+            await backend.query()
+            push.tab = backend.tab
+
+            assert await backend.observe(push.port, push.token, 2) == 'INSTALLED'
+            first = json.loads(await push.get(2))
+
+            # Changes are pushed without polling
+            state_file.write_text('OFF OFF NONE ON')
+            second = json.loads(await push.get(2))
+
+            assert await backend.observe(push.port, push.token, 2) == 'RUNNING'
+            return first, second
+        finally:
+            await backend.close()
+            push.server.close()
+            await push.server.wait_closed()
+
+    first, second = asyncio.run(main())
+
+    assert first['actions']['mic']['state'] == 'ON'
+    assert second['actions']['mic']['state'] == 'OFF'